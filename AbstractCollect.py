@@ -30,6 +30,7 @@ import errno
 import abc
 import collections
 import gevent
+import collect_metadata
 from HardwareRepository.TaskUtils import *
 
 __copyright__ = "Copyright 2012, ESRF"
@@ -76,6 +77,9 @@ class AbstractCollect(object, metaclass=abc.ABCMeta):
         self.sample_changer_hwobj = None
         self.transmission_hwobj = None
 
+        self.current_metadata = None
+        self.frame_metadata = collect_metadata.FrameMetadataCache(self)
+
         self.ready_event = gevent.event.Event()
 
     def set_beamline_configuration(self, **configuration_parameters):
@@ -158,30 +162,11 @@ class AbstractCollect(object, metaclass=abc.ABCMeta):
                self.current_dc_parameters["detdistance"])
             self.move_detector(self.current_dc_parameters["detdistance"])
   
+        self.current_metadata = self.get_beamline_metadata()
+        self.frame_metadata.reset()
         if self.lims_client_hwobj:
-            self.current_dc_parameters["flux"] = self.get_flux()
-            self.current_dc_parameters["wavelength"] = self.get_wavelength()
-            self.current_dc_parameters["detectorDistance"] =  self.get_detector_distance()
-            self.current_dc_parameters["resolution"] = self.get_resolution()
-            self.current_dc_parameters["transmission"] = self.get_transmission()
-            beam_centre_x, beam_centre_y = self.get_beam_centre()
-            self.current_dc_parameters["xBeam"] = beam_centre_x
-            self.current_dc_parameters["yBeam"] = beam_centre_y
-            und = self.get_undulators_gaps()
-            i = 1
-            for jj in self.bl_config.undulators:
-                key = jj.type
-                if key in und:
-                    self.current_dc_parameters["undulatorGap%d" % (i)] = und[key]
-                    i += 1
-            self.current_dc_parameters["resolutionAtCorner"] = self.get_resolution_at_corner()
-            beam_size_x, beam_size_y = self.get_beam_size()
-            self.current_dc_parameters["beamSizeAtSampleX"] = beam_size_x
-            self.current_dc_parameters["beamSizeAtSampleY"] = beam_size_y
-            self.current_dc_parameters["beamShape"] = self.get_beam_shape()
-            hor_gap, vert_gap = self.get_slit_gaps()
-            self.current_dc_parameters["slitGapHorizontal"] = hor_gap
-            self.current_dc_parameters["slitGapVertical"] = vert_gap
+            collect_metadata.update_lims_parameters(self.current_dc_parameters,
+                 self.current_metadata, self.bl_config.undulators)
 
         self.data_collection_hook()
 
@@ -276,6 +261,13 @@ class AbstractCollect(object, metaclass=abc.ABCMeta):
         """
         pass
 
+    def get_beamline_metadata(self):
+        """
+        Descript. : returns beamline values stored in LIMS and image
+                    headers, read in parallel, as one immutable record
+        """
+        return collect_metadata.get_beamline_metadata(self)
+
     def get_flux(self):
         """
         Descript. :
@@ -472,11 +464,9 @@ class AbstractCollect(object, metaclass=abc.ABCMeta):
             lims_image = {'dataCollectionId': self.current_dc_parameters["collection_id"],
                           'fileName': filename,
                           'fileLocation': file_location,
-                          'imageNumber': frame_number,
-                          'measuredIntensity': self.get_measured_intensity(),
-                          'synchrotronCurrent': self.get_machine_current(),
-                          'machineMessage': self.get_machine_message(),
-                          'temperature': self.get_cryo_temperature()}
+                          'imageNumber': frame_number}
+            lims_image.update(collect_metadata.get_lims_image_metadata(\
+                 self.frame_metadata.get()))
             archive_directory = self.current_dc_parameters['fileinfo']['archive_directory']
             if archive_directory:
                 jpeg_filename = "%s.jpeg" % os.path.splitext(image_file_template)[0]
@@ -8,6 +8,7 @@ import abc
 import collections
 import gevent
 import autoprocessing
+import collect_metadata
 from HardwareRepository.TaskUtils import *
 
 BeamlineControl = collections.namedtuple('BeamlineControl',
@@ -45,6 +46,14 @@ BeamlineConfig = collections.namedtuple('BeamlineConfig',
                                          'polarisation',
                                          'input_files_server'])
 
+# Collection setup steps and the steps they have to wait for:
+# resolution (given in A) needs the final energy, the others are independent
+SETUP_DEPENDENCIES = {"transmission": (),
+                      "energy": (),
+                      "resolution": ("energy",),
+                      "detector_distance": (),
+                      "detector_mode": ()}
+
 
 class AbstractMultiCollect(object, metaclass=abc.ABCMeta):
     def __init__(self):
@@ -55,6 +64,8 @@ class AbstractMultiCollect(object, metaclass=abc.ABCMeta):
         self.current_lims_sample = None
         self.__safety_shutter_close_task = None
         self.run_without_loop = None
+        self.current_metadata = None
+        self.frame_metadata = collect_metadata.FrameMetadataCache(self)
 
 
     def setControlObjects(self, **control_objects):
@@ -294,6 +305,32 @@ class AbstractMultiCollect(object, metaclass=abc.ABCMeta):
         pass
     
 
+    def get_beamline_metadata(self):
+        """Returns beamline values stored in LIMS and image headers,
+        read in parallel, as one immutable record"""
+        return collect_metadata.get_beamline_metadata(self)
+
+
+    def store_image_in_lims_queue(self, lims_image):
+        """Hands the image over to the LIMS write-behind queue if the
+        LIMS client has one, stores it synchronously otherwise"""
+        queue_image = getattr(self.bl_control.lims, "queue_image", None)
+        if queue_image is not None:
+            queue_image(lims_image)
+        else:
+            self.bl_control.lims.store_image(lims_image)
+
+
+    def flush_lims_image_queue(self, timeout=30):
+        """Waits for the images queued for LIMS to be stored"""
+        flush_image_queue = getattr(self.bl_control.lims, "flush_image_queue", None)
+        if flush_image_queue is not None:
+            try:
+                flush_image_queue(timeout)
+            except:
+                logging.getLogger("HWR").exception("Could not flush LIMS image queue")
+
+
     def get_sample_info_from_parameters(self, parameters):
         """Returns sample_id, sample_location and sample_code from data collection parameters"""
         sample_info = parameters.get("sample_reference")
@@ -404,6 +441,78 @@ class AbstractMultiCollect(object, metaclass=abc.ABCMeta):
     def execute_collect_without_loop(self, data_collect_parameters):
         return
 
+    def get_setup_dependencies(self):
+        """
+        Descript. : returns dict step name -> steps it has to wait for.
+                    Defaults can be changed per beamline with the
+                    setup_dependencies property, for example
+                    {"transmission": ["energy"], "detector_mode": []}
+        """
+        dependencies = dict(SETUP_DEPENDENCIES)
+        try:
+            beamline_dependencies = self.getProperty("setup_dependencies")
+        except AttributeError:
+            beamline_dependencies = None
+        if beamline_dependencies:
+            try:
+                dependencies.update(eval(beamline_dependencies))
+            except:
+                logging.getLogger("HWR").exception(\
+                    "Could not read setup_dependencies, using defaults")
+                return dict(SETUP_DEPENDENCIES)
+
+        #A dependency cycle would make the setup wait forever
+        done = set()
+        def check_cycle(name, path):
+            if name in path:
+                raise ValueError("setup dependency cycle: %s" % " -> ".join(path + (name,)))
+            if name not in done:
+                for dependency in dependencies.get(name, ()):
+                    check_cycle(dependency, path + (name,))
+                done.add(name)
+        try:
+            for name in dependencies:
+                check_cycle(name, ())
+        except ValueError:
+            logging.getLogger("HWR").exception("Wrong setup_dependencies, using defaults")
+            return dict(SETUP_DEPENDENCIES)
+        return dependencies
+
+
+    def run_setup_steps(self, setup_steps):
+        """
+        Descript. : runs collection setup steps concurrently, each step
+                    starting when the steps it depends on are done.
+                    The first error is raised (other steps are killed)
+        Args.     : setup_steps (ordered dict step name -> (setter, value))
+        """
+        dependencies = self.get_setup_dependencies()
+        step_tasks = {}
+        timings = []
+        setup_start = time.time()
+
+        def run_step(name, setter, value):
+            for dependency in dependencies.get(name, ()):
+                if dependency in step_tasks:
+                    step_tasks[dependency].get()
+            step_start = time.time()
+            setter(value)
+            timings.append((name, step_start - setup_start, time.time() - step_start))
+
+        for name, (setter, value) in setup_steps.items():
+            step_tasks[name] = gevent.spawn(run_step, name, setter, value)
+
+        try:
+            gevent.joinall(list(step_tasks.values()), raise_error=True)
+        except:
+            gevent.killall(list(step_tasks.values()))
+            raise
+        finally:
+            for name, started, duration in sorted(timings, key=lambda timing: timing[1]):
+                logging.getLogger("HWR").info("Collection setup: %s started at +%.2f s, took %.2f s", name, started, duration)
+            logging.getLogger("HWR").info("Collection setup done in %.2f s", time.time() - setup_start)
+
+
     def do_collect(self, owner, data_collect_parameters):
         if self.__safety_shutter_close_task is not None:
             self.__safety_shutter_close_task.kill()
@@ -623,27 +732,30 @@ class AbstractMultiCollect(object, metaclass=abc.ABCMeta):
         # data collection
         self.data_collection_hook(data_collect_parameters)
 
+        setup_steps = collections.OrderedDict()
         if 'transmission' in data_collect_parameters:
           logging.getLogger("user_level_log").info("Setting transmission to %f", data_collect_parameters["transmission"])
-          self.set_transmission(data_collect_parameters["transmission"])
+          setup_steps["transmission"] = (self.set_transmission, data_collect_parameters["transmission"])
 
         if 'wavelength' in data_collect_parameters:
           logging.getLogger("user_level_log").info("Setting wavelength to %f", data_collect_parameters["wavelength"])
-          self.set_wavelength(data_collect_parameters["wavelength"])
+          setup_steps["energy"] = (self.set_wavelength, data_collect_parameters["wavelength"])
         elif 'energy' in data_collect_parameters:
           logging.getLogger("user_level_log").info("Setting energy to %f", data_collect_parameters["energy"])
-          self.set_energy(data_collect_parameters["energy"])
+          setup_steps["energy"] = (self.set_energy, data_collect_parameters["energy"])
 
         if 'resolution' in data_collect_parameters:
           resolution = data_collect_parameters["resolution"]["upper"]
           logging.getLogger("user_level_log").info("Setting resolution to %f", resolution)
-          self.set_resolution(resolution)
+          setup_steps["resolution"] = (self.set_resolution, resolution)
         elif 'detdistance' in oscillation_parameters:
-          logging.getLogger("user_level_log").info("Moving detector to %f", data_collect_parameters["detdistance"])
-          self.move_detector(oscillation_parameters["detdistance"])
+          logging.getLogger("user_level_log").info("Moving detector to %f", oscillation_parameters["detdistance"])
+          setup_steps["detector_distance"] = (self.move_detector, oscillation_parameters["detdistance"])
 
         # 0: software binned, 1: unbinned, 2:hw binned
-        self.set_detector_mode(data_collect_parameters["detector_mode"])
+        setup_steps["detector_mode"] = (self.set_detector_mode, data_collect_parameters["detector_mode"])
+
+        self.run_setup_steps(setup_steps)
 
         with cleanup(self.data_collection_cleanup):
             if not self.safety_shutter_opened():
@@ -658,35 +770,18 @@ class AbstractMultiCollect(object, metaclass=abc.ABCMeta):
             exptime = oscillation_parameters["exposure_time"]
             npass = oscillation_parameters["number_of_passes"]
 
+            logging.getLogger("user_level_log").info("Reading beamline metadata")
+            self.current_metadata = self.get_beamline_metadata()
+            self.frame_metadata.reset()
+            if self.getProperty("frame_metadata_ttl") is not None:
+                self.frame_metadata.ttl = float(self.getProperty("frame_metadata_ttl"))
+
             # update LIMS
             if self.bl_control.lims:
                   try:
-                    logging.getLogger("user_level_log").info("Gathering data for LIMS update")
-                    data_collect_parameters["flux"] = self.get_flux()
+                    collect_metadata.update_lims_parameters(data_collect_parameters,
+                         self.current_metadata, self.bl_config.undulators)
                     data_collect_parameters["flux_end"] = data_collect_parameters["flux"]
-                    data_collect_parameters["wavelength"]= self.get_wavelength()
-                    data_collect_parameters["detectorDistance"] =  self.get_detector_distance()
-                    data_collect_parameters["resolution"] = self.get_resolution()
-                    data_collect_parameters["transmission"] = self.get_transmission()
-                    beam_centre_x, beam_centre_y = self.get_beam_centre()
-                    data_collect_parameters["xBeam"] = beam_centre_x
-                    data_collect_parameters["yBeam"] = beam_centre_y
-
-                    und = self.get_undulators_gaps()
-                    i = 1
-                    for jj in self.bl_config.undulators:
-                        key = jj.type
-                        if key in und:
-                            data_collect_parameters["undulatorGap%d" % (i)] = und[key]
-                            i += 1
-                    data_collect_parameters["resolutionAtCorner"] = self.get_resolution_at_corner()
-                    beam_size_x, beam_size_y = self.get_beam_size()
-                    data_collect_parameters["beamSizeAtSampleX"] = beam_size_x
-                    data_collect_parameters["beamSizeAtSampleY"] = beam_size_y
-                    data_collect_parameters["beamShape"] = self.get_beam_shape()
-                    hor_gap, vert_gap = self.get_slit_gaps()
-                    data_collect_parameters["slitGapHorizontal"] = hor_gap
-                    data_collect_parameters["slitGapVertical"] = vert_gap
 
                     logging.getLogger("user_level_log").info("Updating data collection in LIMS")
                     self.bl_control.lims.update_data_collection(data_collect_parameters, wait=True)
@@ -754,18 +849,16 @@ class AbstractMultiCollect(object, metaclass=abc.ABCMeta):
                               lims_image={'dataCollectionId': self.collection_id,
                                           'fileName': filename,
                                           'fileLocation': file_location,
-                                          'imageNumber': frame,
-                                          'measuredIntensity': self.get_measured_intensity(),
-                                          'synchrotronCurrent': self.get_machine_current(),
-                                          'machineMessage': self.get_machine_message(),
-                                          'temperature': self.get_cryo_temperature()}
+                                          'imageNumber': frame}
+                              lims_image.update(collect_metadata.get_lims_image_metadata(\
+                                   self.frame_metadata.get()))
 
                               if archive_directory:
                                 lims_image['jpegFileFullPath'] = jpeg_full_path
                                 lims_image['jpegThumbnailFileFullPath'] = jpeg_thumbnail_full_path
 
                               try:
-                                  self.bl_control.lims.store_image(lims_image)
+                                  self.store_image_in_lims_queue(lims_image)
                               except:
                                   logging.getLogger("HWR").exception("Could not store image in LIMS")
                           
@@ -852,6 +945,8 @@ class AbstractMultiCollect(object, metaclass=abc.ABCMeta):
                                                       data_collect_parameters["residues"],
                                                       "reference_interval" in data_collect_parameters["oscillation_sequence"][0],
                                                       data_collect_parameters["do_inducedraddam"]))
+
+                self.frame_metadata.log_statistics()
   
                 if self.bl_control.lims:    
                   data_collect_parameters["flux_end"]=self.get_flux()
@@ -871,6 +966,7 @@ class AbstractMultiCollect(object, metaclass=abc.ABCMeta):
             except:
               logging.exception("Could not close safety shutter")
         finally:
+           self.flush_lims_image_queue()
            self.emit("collectEnded", owner, not failed, failed_msg if failed else "Data collection successful")
            self.emit("collectReady", (True, ))
 
@@ -925,7 +1021,7 @@ class AbstractMultiCollect(object, metaclass=abc.ABCMeta):
         Description    : executes a script after the data collection has finished
         Type           : method
     """
-    def trigger_auto_processing(self, process_event, xds_dir, EDNA_files_dir=None, anomalous=None, residues=200, do_inducedraddam=False, spacegroup=None, cell=None, frame=None):
+    def trigger_auto_processing(self, process_event, xds_dir, EDNA_files_dir=None, anomalous=None, residues=200, do_inducedraddam=False, spacegroup=None, cell=None, frame=None, number_of_images=None):
       # quick fix for anomalous, do_inducedraddam... passed as a string!!!
       # (comes from the queue)
       if type(anomalous) == bytes:
@@ -956,6 +1052,8 @@ class AbstractMultiCollect(object, metaclass=abc.ABCMeta):
         processAnalyseParams['residues'] = residues
         processAnalyseParams["spacegroup"]=spacegroup
         processAnalyseParams["cell"]=cell
+        processAnalyseParams["frame"]=frame
+        processAnalyseParams["number_of_images"]=number_of_images
       except Exception as msg:
         logging.getLogger().exception("DataCollect:processing: %r" % msg)
       else:
@@ -19,7 +19,8 @@ import numpy
 import abc
 from HardwareRepository.TaskUtils import cleanup	
 from matplotlib.figure import Figure
-from matplotlib.backends.backend_agg import FigureCanvasAgg
+from scan_output import calibrate_channels, format_points, write_copies, \
+     write_png_in_background
 
 
 class AbstractXRFSpectrum(object, metaclass=abc.ABCMeta):
@@ -37,6 +38,7 @@ class AbstractXRFSpectrum(object, metaclass=abc.ABCMeta):
         self.spectrum_data = None
         self.mca_calib = (10, 20, 0)
         self.spectrum_running = None
+        self.png_task = None
 
         self.energy_hwobj = None
         self.transmission_hwobj = None
@@ -162,39 +164,28 @@ class AbstractXRFSpectrum(object, metaclass=abc.ABCMeta):
 
             xmin = 0
             xmax = 0
-            mca_data = []
-            calibrated_data = []
+
+            spectrum_data = numpy.asarray(self.spectrum_data)
+            energies = calibrate_channels(len(spectrum_data), self.mca_calib)
+            selected = numpy.nonzero(energies < 13)[0]
+            energies = energies[selected]
+            values = spectrum_data[selected]
+            for energy, value in zip(energies.tolist(), values.tolist()):
+                if energy > xmax:
+                    xmax = value
+                if energy < xmin:
+                    xmin = value
+            mca_data = list(zip((selected / 1000.0).tolist(), values.tolist()))
 
             try:
-               spectrum_file_raw = open(self.spectrum_info["scanFileFullPath"], "w")
-               archive_file_raw = open(self.spectrum_info["scanFilePath"], "w")
+                write_copies(format_points(energies, values),
+                             (self.spectrum_info["scanFileFullPath"],
+                              self.spectrum_info["scanFilePath"]))
             except:
                logging.getLogger("HWR").exception(
                  "XRFSpectrum: could not create spectrum result raw file %s" % \
                  self.spectrum_info["scanFileFullPath"])
 
-            for n, value in enumerate(self.spectrum_data):
-                energy = (self.mca_calib[2] + \
-                          self.mca_calib[1] * n + \
-                          self.mca_calib[0] * n * n) / 1000
-                if energy < 13:
-                    if energy > xmax:
-                        xmax = value
-                    if energy < xmin:
-                        xmin = value
-                    calibrated_data.append([energy, value])
-                    mca_data.append((n / 1000.0, value))
-                    if spectrum_file_raw:
-                        spectrum_file_raw.write("%f,%f\r\n" % (energy, value))
-                    if archive_file_raw:
-                        archive_file_raw.write("%f,%f\r\n" % (energy, value))
-            if spectrum_file_raw:
-                spectrum_file_raw.close()
-            if archive_file_raw:
-                archive_file_raw.close()
-
-            calibrated_array = numpy.array(calibrated_data)
-
             self.spectrum_info["beamTransmission"] = self.transmission_hwobj.getAttFactor()
             self.spectrum_info["energy"] = self.get_current_energy()
             beam_size = self.beam_info_hwobj.get_beam_size()
@@ -215,13 +206,14 @@ class AbstractXRFSpectrum(object, metaclass=abc.ABCMeta):
             ax.set_title(self.spectrum_info["jpegScanFileFullPath"])
             ax.grid(True)
 
-            ax.plot(*(list(zip(*calibrated_array))), **{"color" : 'black'})
+            ax.plot(energies, values, **{"color" : 'black'})
             ax.set_xlabel("Energy")
             ax.set_ylabel("Counts")
-            canvas = FigureCanvasAgg(fig)
             logging.getLogger().info("XRFSpectrum: Rendering spectrum to PNG file : %s", \
                                      self.spectrum_info["jpegScanFileFullPath"])
-            canvas.print_figure(self.spectrum_info["jpegScanFileFullPath"], dpi = 80)
+            # rendered in a thread, the result is emitted meanwhile
+            self.png_task = write_png_in_background(fig,
+                 (self.spectrum_info["jpegScanFileFullPath"], ), dpi=80)
             #logging.getLogger().debug("Copying .fit file to: %s", a_dir)
             #tmpname=filename.split(".")
             #logging.getLogger().debug("finished %r", self.spectrum_info)
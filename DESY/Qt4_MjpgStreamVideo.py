@@ -24,6 +24,8 @@ __copyright__ = "(c)2015 DESY, FS-PE, P11"
 __license__ = "GPL"
 
 
+import time
+import logging
 import gevent
 import http.client
 import json
@@ -34,6 +36,64 @@ from PyQt4 import QtCore
 from HardwareRepository.BaseHardwareObjects import Device
 
 
+class MjpgStreamParser(object):
+    """
+    Incremental parser for the multipart/x-mixed-replace stream sent by
+    mjpg-streamer on ?action=stream. Data is fed as it arrives from the
+    socket, complete JPEG frames are returned as soon as they are known.
+    """
+
+    def __init__(self, boundary):
+        self.boundary = b"--" + boundary.strip('"').lstrip("-").encode()
+        self.buffer = bytearray()
+        self.headers = None
+
+    def feed(self, data):
+        """Adds data to the internal buffer and returns the list of
+        completed frames (bytes), oldest first.
+        """
+        self.buffer.extend(data)
+        frames = []
+        while True:
+            if self.headers is None:
+                start = self.buffer.find(self.boundary)
+                if start < 0:
+                    # keep the tail, it may hold the start of a boundary
+                    del self.buffer[:max(0, len(self.buffer) - len(self.boundary))]
+                    break
+                end = self.buffer.find(b"\r\n\r\n", start)
+                if end < 0:
+                    del self.buffer[:start]
+                    break
+                self.headers = {}
+                header_lines = bytes(self.buffer[start + len(self.boundary):end])
+                for line in header_lines.split(b"\r\n"):
+                    if b":" in line:
+                        key, value = line.split(b":", 1)
+                        self.headers[key.strip().lower()] = value.strip()
+                del self.buffer[:end + 4]
+
+            length = self.headers.get(b"content-length")
+            if length is not None:
+                length = int(length)
+                if len(self.buffer) < length:
+                    break
+                frames.append(bytes(self.buffer[:length]))
+                del self.buffer[:length]
+            else:
+                # no content length: frame ends with the next boundary
+                end = self.buffer.find(self.boundary)
+                if end < 0:
+                    break
+                frame = bytes(self.buffer[:end])
+                if frame.endswith(b"\r\n"):
+                    frame = frame[:-2]
+                frames.append(frame)
+                del self.buffer[:end]
+            self.headers = None
+        return frames
+
+
 class Qt4_MjpgStreamVideo(Device):
     """
     Hardware object to capture images using mjpg-streamer
@@ -260,6 +320,10 @@ class Qt4_MjpgStreamVideo(Device):
         self.plugin = 0
         self.updateControls = None
         self.inputAvt = None
+        self.stream_mode = True
+        self.stream_connection = None
+        self.stream_statistics = {"connects": 0, "received": 0,
+                                  "decoded": 0, "skipped": 0}
 
     def init(self):
         """
@@ -275,6 +339,9 @@ class Qt4_MjpgStreamVideo(Device):
         self.port = int(self.getProperty("port"))
         self.path = "/"
         self.plugin = 0
+        # stream: one connection to ?action=stream, snapshot: one
+        # ?action=snapshot request per frame
+        self.stream_mode = self.getProperty("mode") != "snapshot"
         self.updateControls = self.hasUpdateControls()
         self.inputAvt = self.isInputAvt()
         self.image = self.get_new_image()
@@ -297,18 +364,19 @@ class Qt4_MjpgStreamVideo(Device):
         if(port is None): port = self.port
         if(path is None): path = self.path
         # send get request and return response
-        http = http.client.HTTPConnection(host, port, timeout=3)
+        connection = http.client.HTTPConnection(host, port, timeout=3)
         try:
-            http.request("GET", path+query)
-            response = http.getresponse()
+            connection.request("GET", path+query)
+            response = connection.getresponse()
         except:
             logging.getLogger().error("MjpgStreamVideo: Connection to http://{0}:{1}{2}{3} refused".format(host, port, path, query))
             return None
         if response.status != 200:
             logging.getLogger().error("MjpgStreamVideo: Error {0}, {1}".format(response.status, response.reason))
+            connection.close()
             return None
         data = response.read()
-        http.close()
+        connection.close()
         return data
 
     def sendCmd(self, value, cmd, group=None, plugin=None, dest=None):
@@ -480,7 +548,10 @@ class Qt4_MjpgStreamVideo(Device):
 
     def start_camera(self):
         if self.image_polling is None:
-            self.image_polling = gevent.spawn(self._do_imagePolling, 1.0 / self.sleep_time)
+            if self.stream_mode:
+                self.image_polling = gevent.spawn(self._do_imageStreaming, 1.0 / self.sleep_time)
+            else:
+                self.image_polling = gevent.spawn(self._do_imagePolling, 1.0 / self.sleep_time)
 
     def get_image_dimensions(self):
         return self.image_dimensions
@@ -638,6 +709,163 @@ class Qt4_MjpgStreamVideo(Device):
         while True:
             image = self.get_new_image()
             if image is not None:
-                self.image = QtGui.QPixmap.fromImage(image.scaled(self.width, self.height))
+                self.image = QtGui.QPixmap.fromImage(image.scaled(self.getWidth(), self.getHeight()))
                 self.emit("imageReceived", self.image)
             gevent.sleep(sleep_time)
+
+    def open_stream(self):
+        """Opens the ?action=stream connection.
+
+        Return value:
+        a (connection, response, parser) tuple or None on error
+
+        """
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=3)
+        try:
+            connection.request("GET", self.path+"?action=stream")
+            response = connection.getresponse()
+        except:
+            logging.getLogger().error("MjpgStreamVideo: Connection to http://{0}:{1}{2}?action=stream refused".format(self.host, self.port, self.path))
+            connection.close()
+            return None
+        content_type = response.getheader("Content-Type", "")
+        if response.status != 200 or "boundary=" not in content_type:
+            logging.getLogger().error("MjpgStreamVideo: Error {0}, {1} ({2})".format(response.status, response.reason, content_type))
+            connection.close()
+            return None
+        boundary = content_type.split("boundary=")[1].split(";")[0]
+        self.stream_statistics["connects"] += 1
+        return connection, response, MjpgStreamParser(boundary)
+
+    def _do_imageStreaming(self, sleep_time):
+        """
+        Descript. : reads the multipart stream on a single connection.
+                    Only the newest frame is decoded when frames arrive
+                    faster than sleep_time, the connection is reopened with
+                    an increasing delay if it fails.
+        """
+        retry_delay = 0.5
+        while True:
+            stream = self.open_stream()
+            if stream is None:
+                # snapshot mode as long as the stream is not available
+                image = self.get_new_image()
+                if image is not None:
+                    self.image = QtGui.QPixmap.fromImage(image.scaled(self.getWidth(), self.getHeight()))
+                    self.emit("imageReceived", self.image)
+                gevent.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 10)
+                continue
+
+            retry_delay = 0.5
+            connection, response, parser = stream
+            last_frame = None
+            next_update = time.time()
+            try:
+                while True:
+                    data = response.read1(65536)
+                    if not data:
+                        logging.getLogger().warning("MjpgStreamVideo: stream closed by server")
+                        break
+                    frames = parser.feed(data)
+                    if frames:
+                        self.stream_statistics["received"] += len(frames)
+                        if last_frame is not None:
+                            self.stream_statistics["skipped"] += 1
+                        self.stream_statistics["skipped"] += len(frames) - 1
+                        last_frame = frames[-1]
+                    if last_frame is not None and time.time() >= next_update:
+                        image = QtGui.QImage.fromData(last_frame).mirrored(self.flip["h"], self.flip["v"])
+                        last_frame = None
+                        next_update = time.time() + sleep_time
+                        self.stream_statistics["decoded"] += 1
+                        self.image = QtGui.QPixmap.fromImage(image.scaled(self.getWidth(), self.getHeight()))
+                        self.emit("imageReceived", self.image)
+            except:
+                logging.getLogger().exception("MjpgStreamVideo: error reading stream")
+            finally:
+                connection.close()
+            gevent.sleep(retry_delay)
+
+    def get_stream_statistics(self):
+        """
+        Descript. : number of connections, received, decoded and skipped frames
+        """
+        return dict(self.stream_statistics)
+
+
+def make_test_stream(frames, boundary="boundarydonotcross"):
+    """Returns the multipart stream mjpg-streamer sends for frames, with a
+    Content-Length header for every other frame.
+    """
+    stream = b"--" + boundary.encode() + b"\r\n"
+    for index, frame in enumerate(frames):
+        stream += b"Content-Type: image/jpeg\r\n"
+        if index % 2 == 0:
+            stream += b"Content-Length: " + str(len(frame)).encode() + b"\r\n"
+        stream += b"X-Timestamp: 0.000000\r\n\r\n" + frame + \
+                  b"\r\n--" + boundary.encode() + b"\r\n"
+    return stream
+
+
+def check_stream_parser(number_of_frames=50, chunk_sizes=(1, 7, 4096)):
+    """Parses a canned multipart stream fed in chunks of chunk_sizes bytes,
+    then read through open_stream from a local stub mjpg-streamer server.
+
+    Return value:
+    number of parses (one per chunk size and one for the server) that did
+    not return exactly the sent frames
+    """
+    import threading
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+    boundary = "boundarydonotcross"
+    # frames holding CR/LF and dashes, as JPEG data can
+    frames = [b"\xff\xd8" + (b"\r\n--%d\r\n" % index) * (index + 1) + \
+              b"\xff\xd9" for index in range(number_of_frames)]
+    stream = make_test_stream(frames, boundary)
+
+    failed = 0
+    for chunk_size in chunk_sizes:
+        parser = MjpgStreamParser(boundary)
+        received = []
+        for start in range(0, len(stream), chunk_size):
+            received.extend(parser.feed(stream[start:start + chunk_size]))
+        if received != frames:
+            logging.getLogger().error("MjpgStreamVideo: wrong frames parsed in chunks of %d bytes (%d received, %d sent)" % (chunk_size, len(received), len(frames)))
+            failed += 1
+
+    class StubStreamHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "multipart/x-mixed-replace;boundary=%s" % boundary)
+            self.end_headers()
+            self.wfile.write(stream)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), StubStreamHandler)
+    server_thread = threading.Thread(target=server.handle_request)
+    server_thread.daemon = True
+    server_thread.start()
+    video = Qt4_MjpgStreamVideo("check_stream_parser")
+    video.host, video.port = server.server_address
+    received = []
+    try:
+        connection, response, parser = video.open_stream()
+        while True:
+            data = response.read1(65536)
+            if not data:
+                break
+            received.extend(parser.feed(data))
+        connection.close()
+    except:
+        logging.getLogger().exception("MjpgStreamVideo: error reading the stub server stream")
+    finally:
+        server_thread.join(3)
+        server.server_close()
+    if received != frames:
+        logging.getLogger().error("MjpgStreamVideo: wrong frames read from the stub server (%d received, %d sent)" % (len(received), len(frames)))
+        failed += 1
+    return failed
@@ -741,6 +741,13 @@ class DiffractometerMockup(Equipment):
             pos = self.convert_from_obj_to_name(pos)
         return pos
 
+    def get_centred_points_from_coord(self, coord_list, return_by_names=None):
+        """
+        Descript. :
+        """
+        return [self.get_centred_point_from_coord(x, y, return_by_names) \
+                for x, y in coord_list]
+
     def convert_from_obj_to_name(self, motor_pos):
         motors = {}
         for motor_role in ('phiy', 'phiz', 'sampx', 'sampy', 'zoom',
@@ -461,6 +461,21 @@ class EMBLMiniDiff(GenericDiffractometer):
             pos = self.convert_from_obj_to_name(pos)
         return pos
 
+    def get_centred_points_from_coord(self, coord_list, return_by_names=None):
+        """
+        Descript. : converts a list of (x, y) screen coordinates to
+                    centring points with one centring math call
+        """
+        self.centring_hwobj.initCentringProcedure()
+        self.omega_reference_add_constraint()
+        pos_list = self.centring_hwobj.centeredPositions(\
+             [{"X" : (x - self.beam_position[0]) / self.pixels_per_mm_x,
+               "Y" : (y - self.beam_position[1]) / self.pixels_per_mm_y} \
+              for x, y in coord_list])
+        if return_by_names:
+            pos_list = [self.convert_from_obj_to_name(pos) for pos in pos_list]
+        return pos_list
+
     def move_to_beam(self, x, y, omega=None):
         """
         Descript. : function to create a centring point based on all motors
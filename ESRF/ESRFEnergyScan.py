@@ -7,8 +7,10 @@ import os
 import http.client
 import math
 import PyChooch
+import numpy
 from matplotlib.figure import Figure
-from matplotlib.backends.backend_agg import FigureCanvasAgg
+from scan_output import load_raw_scan, format_points, write_copies, \
+     write_png_in_background
 
 
 class FixedEnergy:
@@ -87,6 +89,7 @@ class ESRFEnergyScan(AbstractEnergyScan, HardwareObject):
         AbstractEnergyScan.__init__(self)
         HardwareObject.__init__(self, name)
         self._tunable_bl = tunable_bl
+        self.png_task = None
         
     def execute_command(self, command_name, *args, **kwargs): 
         wait = kwargs.get("wait", True)
@@ -228,41 +231,25 @@ class ESRFEnergyScan(AbstractEnergyScan, HardwareObject):
         if not os.path.exists(os.path.dirname(scanArchiveFilePrefix)):
             os.makedirs(os.path.dirname(scanArchiveFilePrefix))
         
+        raw_data_file = os.path.join(os.path.dirname(scanFilePrefix), 'data.raw')
         try:
-            f=open(rawScanFile, "w")
-            pyarch_f=open(archiveRawScanFile, "w")
+            x, y = load_raw_scan(raw_data_file)
+        except:
+            logging.getLogger("HWR").exception("could not read raw scan data %s" % raw_data_file)
+            self.storeEnergyScan()
+            self.emit("energyScanFailed", ())
+            return
+        #x = x < 1000 and x*1000.0 or x
+        scanData = list(zip(x.tolist(), y.tolist()))
+
+        try:
+            write_copies(format_points(x, y), (rawScanFile, archiveRawScanFile))
         except:
             logging.getLogger("HWR").exception("could not create raw scan files")
             self.storeEnergyScan()
             self.emit("energyScanFailed", ())
             return
-        else:
-            scanData = []
-            
-            raw_data_file = os.path.join(os.path.dirname(scanFilePrefix), 'data.raw')
-
-            try:
-                raw_file = open(raw_data_file, 'r')
-            except:
-                self.storeEnergyScan()
-                self.emit("energyScanFailed", ())
-                return
-            for line in raw_file.readlines()[2:]:
-                try:
-                    (x, y) = line.split('\t')
-                except:
-                    (x, y) = line.split()
-                x = float(x.strip())
-                y = float(y.strip())
-                #x = x < 1000 and x*1000.0 or x
-                scanData.append((x, y))
-                f.write("%f,%f\r\n" % (x, y))
-                pyarch_f.write("%f,%f\r\n"% (x, y))
-
-
-            f.close()
-            pyarch_f.close()
-            self.energy_scan_parameters["scanFileFullPath"]=str(archiveRawScanFile)
+        self.energy_scan_parameters["scanFileFullPath"]=str(archiveRawScanFile)
         pk, fppPeak, fpPeak, ip, fppInfl, fpInfl, chooch_graph_data = PyChooch.calc(scanData, elt, edge, scanFile)
         rm=(pk+30)/1000.0
         pk=pk/1000.0
@@ -305,9 +292,7 @@ class ESRFEnergyScan(AbstractEnergyScan, HardwareObject):
         self.energy_scan_parameters["comments"] = comm
 
         chooch_graph_x, chooch_graph_y1, chooch_graph_y2 = list(zip(*chooch_graph_data))
-        chooch_graph_x = list(chooch_graph_x)
-        for i in range(len(chooch_graph_x)):
-          chooch_graph_x[i]=chooch_graph_x[i]/1000.0
+        chooch_graph_x = (numpy.array(chooch_graph_x) / 1000.0).tolist()
 
         logging.getLogger("HWR").info("<chooch> Saving png" )
         # prepare to save png files
@@ -316,7 +301,7 @@ class ESRFEnergyScan(AbstractEnergyScan, HardwareObject):
         ax=fig.add_subplot(211)
         ax.set_title("%s\n%s" % (scanFile, title))
         ax.grid(True)
-        ax.plot(*(list(zip(*scanData))), **{"color":'black'})
+        ax.plot(x, y, **{"color":'black'})
         ax.set_xlabel("Energy")
         ax.set_ylabel("MCA counts")
         ax2=fig.add_subplot(212)
@@ -326,21 +311,13 @@ class ESRFEnergyScan(AbstractEnergyScan, HardwareObject):
         handles = []
         handles.append(ax2.plot(chooch_graph_x, chooch_graph_y1, color='blue'))
         handles.append(ax2.plot(chooch_graph_x, chooch_graph_y2, color='red'))
-        canvas=FigureCanvasAgg(fig)
 
         escan_png = os.path.extsep.join((scanFilePrefix, "png"))
         escan_archivepng = os.path.extsep.join((scanArchiveFilePrefix, "png")) 
         self.energy_scan_parameters["jpegChoochFileFullPath"]=str(escan_archivepng)
-        try:
-          logging.getLogger("HWR").info("Rendering energy scan and Chooch graphs to PNG file : %s", escan_png)
-          canvas.print_figure(escan_png, dpi=80)
-        except:
-          logging.getLogger("HWR").exception("could not print figure")
-        try:
-          logging.getLogger("HWR").info("Saving energy scan to archive directory for ISPyB : %s", escan_archivepng)
-          canvas.print_figure(escan_archivepng, dpi=80)
-        except:
-          logging.getLogger("HWR").exception("could not save figure")
+        # rendered once in a thread, results are emitted meanwhile
+        logging.getLogger("HWR").info("Rendering energy scan and Chooch graphs to PNG files : %s, %s", escan_png, escan_archivepng)
+        self.png_task = write_png_in_background(fig, (escan_png, escan_archivepng), dpi=80)
 
         self.storeEnergyScan()
 
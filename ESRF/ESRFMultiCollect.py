@@ -1,6 +1,7 @@
 from HardwareRepository.BaseHardwareObjects import HardwareObject
 from AbstractMultiCollect import *
 from gevent.event import AsyncResult
+import gevent
 import logging
 import time
 import os
@@ -8,6 +9,9 @@ import http.client
 import urllib.request, urllib.parse, urllib.error
 import math
 from queue_model_objects_v1 import PathTemplate
+from ESRF.input_files import InputFilesClient, INPUT_FILES_POOL_SIZE, \
+     write_file_atomic, to_text
+from image_preview import get_preview_engine
 
 class FixedEnergy:
     def __init__(self, wavelength, energy):
@@ -174,6 +178,10 @@ class PixelDetector:
         else:
             self.execute_command("prepare_acquisition", take_dark, start, osc_range, exptime, npass, comment)
         
+    def prepare_directories(self, directories):
+        if self._detector and hasattr(self._detector, "prepare_directories"):
+            return self._detector.prepare_directories(directories)
+
     @task
     def set_detector_filenames(self, frame_number, start, filename, jpeg_full_path, jpeg_thumbnail_full_path):
       if self.shutterless and not self.new_acquisition:
@@ -268,6 +276,8 @@ class ESRFMultiCollect(AbstractMultiCollect, HardwareObject):
         self._detector = detector
         self._tunable_bl = tunable_bl
         self._centring_status = None
+        self._input_files_client = None
+        self._preview_engine = None
 
     def execute_command(self, command_name, *args, **kwargs): 
       wait = kwargs.get("wait", True)
@@ -321,6 +331,15 @@ class ESRFMultiCollect(AbstractMultiCollect, HardwareObject):
         self._detector.init(self.bl_control.detector, self)
         self._tunable_bl.bl_control = self.bl_control
 
+        # jpeg previews are made by BES, unless jpeg_engine is "local":
+        # jpeg_workers processes of this computer (CBF images)
+        if self.getProperty("jpeg_engine") == "local":
+            try:
+                self._preview_engine = get_preview_engine(self.getProperty("jpeg_workers"))
+            except RuntimeError:
+                logging.getLogger("HWR").exception("Local jpeg previews " + \
+                     "disabled, no preview will be generated")
+
         self.emit("collectConnected", (True,))
         self.emit("collectReady", (True, ))
 
@@ -508,68 +527,62 @@ class ESRFMultiCollect(AbstractMultiCollect, HardwareObject):
     @task
     def write_input_files(self, collection_id):
         # assumes self.xds_directory and self.mosflm_directory are valid
-        conn = http.client.HTTPConnection(self.bl_config.input_files_server)
+        if self._input_files_client is None or \
+           self._input_files_client.server != self.bl_config.input_files_server:
+            self._input_files_client = InputFilesClient(self.bl_config.input_files_server,
+                 self.getProperty("input_files_pool_size") or INPUT_FILES_POOL_SIZE)
+
+        # hkl, xds and mosflm input files: (file path, request path, error message)
+        input_files = []
+        for input_file_dir, file_prefix in ((self.raw_hkl2000_dir, "../.."), (self.hkl2000_directory, "../links")):
+            input_files.append((os.path.join(input_file_dir, "def.site"),
+                                "/def.site/%d?basedir=%s" % (collection_id, file_prefix),
+                                "Could not create hkl input file"))
+        for input_file_dir, file_prefix in ((self.raw_data_input_file_dir, "../.."), (self.xds_directory, "../links")):
+            input_files.append((os.path.join(input_file_dir, "XDS.INP"),
+                                "/xds.inp/%d?basedir=%s" % (collection_id, file_prefix),
+                                "Could not create xds input file"))
+        for input_file_dir, file_prefix in ((self.mosflm_raw_data_input_file_dir, "../.."), (self.mosflm_directory, "../links")):
+            input_files.append((os.path.join(input_file_dir, "mosflm.inp"),
+                                "/mosflm.inp/%d?basedir=%s" % (collection_id, file_prefix),
+                                "Could not create mosflm input file"))
+        stac_request = "/stac.descr/%d" % collection_id
+
+        # motor positions are read while the requests are running
+        diffractometer = self.bl_control.diffractometer
+        positions_task = gevent.spawn(lambda: dict(phi=diffractometer.phiMotor.getPosition(),
+                                                   sampx=diffractometer.sampleXMotor.getPosition(),
+                                                   sampy=diffractometer.sampleYMotor.getPosition(),
+                                                   phiy=diffractometer.phiyMotor.getPosition()))
+        responses = self._input_files_client.get_all([request for _, request, _ in input_files] + [stac_request])
+
+        for input_file_path, request, error_message in input_files:
+            if responses[request] is None:
+                logging.error(error_message)
+            write_file_atomic(input_file_path, to_text(responses[request]))
 
-        # hkl input files 
-        for input_file_dir, file_prefix in ((self.raw_hkl2000_dir, "../.."), (self.hkl2000_directory, "../links")): 
-            hkl_file_path = os.path.join(input_file_dir, "def.site")
-            conn.request("GET", "/def.site/%d?basedir=%s" % (collection_id, file_prefix))
-            hkl_file = open(hkl_file_path, "w")
-            r = conn.getresponse()
-
-            if r.status != 200:
-                logging.error("Could not create hkl input file")
-            else:
-                hkl_file.write(r.read())
-            hkl_file.close()
-            os.chmod(hkl_file_path, 0o666)
-
-        for input_file_dir, file_prefix in ((self.raw_data_input_file_dir, "../.."), (self.xds_directory, "../links")): 
-	  xds_input_file = os.path.join(input_file_dir, "XDS.INP")
-          conn.request("GET", "/xds.inp/%d?basedir=%s" % (collection_id, file_prefix))
-          xds_file = open(xds_input_file, "w")
-          r = conn.getresponse()
-          if r.status != 200:
-            logging.error("Could not create xds input file")
-          else:
-            xds_file.write(r.read())
-          xds_file.close()
-          os.chmod(xds_input_file, 0o666)
-
-        for input_file_dir, file_prefix in ((self.mosflm_raw_data_input_file_dir, "../.."), (self.mosflm_directory, "../links")): 
-	  mosflm_input_file = os.path.join(input_file_dir, "mosflm.inp")
-          conn.request("GET", "/mosflm.inp/%d?basedir=%s" % (collection_id, file_prefix))
-          mosflm_file = open(mosflm_input_file, "w")
-          mosflm_file.write(conn.getresponse().read()) 
-          mosflm_file.close()
-          os.chmod(mosflm_input_file, 0o666)
-        
         # also write input file for STAC
-        for stac_om_input_file_name, stac_om_dir in (("mosflm.descr", self.mosflm_directory), 
+        if responses[stac_request] is None:
+            logging.error("Could not create STAC input files")
+        stac_template = to_text(responses[stac_request])
+        positions = positions_task.get()
+        for stac_om_input_file_name, stac_om_dir in (("mosflm.descr", self.mosflm_directory),
                                                      ("xds.descr", self.xds_directory),
                                                      ("mosflm.descr", self.mosflm_raw_data_input_file_dir),
                                                      ("xds.descr", self.raw_data_input_file_dir)):
-          stac_om_input_file = os.path.join(stac_om_dir, stac_om_input_file_name)
-          conn.request("GET", "/stac.descr/%d" % collection_id)
-          stac_om_file = open(stac_om_input_file, "w")
-          stac_template = conn.getresponse().read()
-          if stac_om_input_file_name.startswith("xds"):
-            om_type="xds"
-            if stac_om_dir == self.raw_data_input_file_dir:
-              om_filename=os.path.join(stac_om_dir, "CORRECT.LP")
+            stac_om_input_file = os.path.join(stac_om_dir, stac_om_input_file_name)
+            if stac_om_input_file_name.startswith("xds"):
+                om_type = "xds"
+                if stac_om_dir == self.raw_data_input_file_dir:
+                    om_filename = os.path.join(stac_om_dir, "CORRECT.LP")
+                else:
+                    om_filename = os.path.join(stac_om_dir, "xds_fastproc", "CORRECT.LP")
             else:
-              om_filename=os.path.join(stac_om_dir, "xds_fastproc", "CORRECT.LP")
-          else:
-            om_type="mosflm"
-            om_filename=os.path.join(stac_om_dir, "bestfile.par")
-       
-          stac_om_file.write(stac_template.format(omfilename=om_filename, omtype=om_type, 
-                             phi=self.bl_control.diffractometer.phiMotor.getPosition(), 
-                             sampx=self.bl_control.diffractometer.sampleXMotor.getPosition(), 
-                             sampy=self.bl_control.diffractometer.sampleYMotor.getPosition(), 
-                             phiy=self.bl_control.diffractometer.phiyMotor.getPosition()))
-          stac_om_file.close()
-          os.chmod(stac_om_input_file, 0o666)
+                om_type = "mosflm"
+                om_filename = os.path.join(stac_om_dir, "bestfile.par")
+
+            write_file_atomic(stac_om_input_file,
+                              stac_template.format(omfilename=om_filename, omtype=om_type, **positions))
 
 
     def get_wavelength(self):
@@ -713,6 +726,18 @@ class ESRFMultiCollect(AbstractMultiCollect, HardwareObject):
 
     @task
     def generate_image_jpeg(self, filename, jpeg_path, jpeg_thumbnail_path):
+        if self.getProperty("jpeg_engine") == "local":
+            if self._preview_engine is None:
+                # could not be created, reported by init
+                return
+            if filename.endswith(".cbf"):
+                try:
+                    self._preview_engine.convert(filename, jpeg_path,
+                                                 jpeg_thumbnail_path)
+                except:
+                    logging.getLogger("HWR").exception("Could not create jpeg " + \
+                         "previews of %s" % filename)
+                return
         directories = filename.split(os.path.sep)
         try:
             if directories[1] == "data" and directories[2] == "gz":
@@ -790,6 +815,27 @@ class ESRFMultiCollect(AbstractMultiCollect, HardwareObject):
         self.getChannelObject('helical_pos').setValue(helical_oscil_pos)
 
 
+    def collect(self, owner, data_collect_parameters_list):
+        self.prepare_detector_directories(data_collect_parameters_list)
+        return AbstractMultiCollect.collect(self, owner, data_collect_parameters_list)
+
+
+    def prepare_detector_directories(self, data_collect_parameters_list):
+        """Starts creating detector directories of all queued collections"""
+        if not hasattr(self._detector, "prepare_directories"):
+            return
+        directories = []
+        for data_collect_parameters in data_collect_parameters_list:
+            pt = PathTemplate()
+            pt.set_from_dict(data_collect_parameters.get("fileinfo", {}))
+            if pt.directory and pt.directory not in directories:
+                directories.append(pt.directory)
+        try:
+            self._detector.prepare_directories(directories)
+        except:
+            logging.getLogger("HWR").exception("Could not prepare detector directories")
+
+
     def get_archive_directory(self, directory):
         pt = PathTemplate()
         pt.directory = directory
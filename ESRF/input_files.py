@@ -0,0 +1,131 @@
+"""
+Client of the ESRF input files server (def.site, XDS.INP, mosflm.inp and
+STAC descriptions of a data collection).
+
+InputFilesClient keeps a small pool of keep-alive http connections to
+the server and issues the GET requests of a collection concurrently (one
+greenlet per request, needs the gevent monkey patched socket module as
+in mxcube). write_file_atomic writes a file next to its destination and
+renames it, so processing programs never read a partially written file.
+"""
+
+import os
+import time
+import logging
+import tempfile
+import http.client
+
+import gevent
+import gevent.queue
+
+
+INPUT_FILES_POOL_SIZE = 4
+
+
+class InputFilesClient(object):
+
+    def __init__(self, server, pool_size=INPUT_FILES_POOL_SIZE, timeout=10):
+        """
+        Args.     : server (host:port), pool_size (max. number of
+                    simultaneous connections), timeout (s)
+        """
+        self.server = server
+        self.timeout = timeout
+        self.pool_size = max(int(pool_size), 1)
+        self.connections = gevent.queue.Queue()
+        self.created_connections = 0
+
+    def get_connection(self):
+        if self.connections.empty() and self.created_connections < self.pool_size:
+            self.created_connections += 1
+            return http.client.HTTPConnection(self.server, timeout=self.timeout)
+        return self.connections.get()
+
+    def release_connection(self, connection):
+        self.connections.put(connection)
+
+    def discard_connection(self, connection):
+        try:
+            connection.close()
+        except:
+            pass
+        #Reopened on next request
+        self.release_connection(http.client.HTTPConnection(self.server,
+                                                          timeout=self.timeout))
+
+    def close(self):
+        while not self.connections.empty():
+            try:
+                self.connections.get_nowait().close()
+            except:
+                pass
+        self.created_connections = 0
+
+    def get(self, path):
+        """
+        Descript. : GET request on a pooled connection. A kept alive
+                    connection closed by the server is retried once
+        Return.   : response body, None if the request failed
+        """
+        for attempt in range(2):
+            connection = self.get_connection()
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, IOError, OSError):
+                self.discard_connection(connection)
+                if attempt:
+                    logging.getLogger("HWR").exception(\
+                        "Input files server %s: GET %s failed" % (self.server, path))
+                    return None
+                continue
+            if response.will_close:
+                self.discard_connection(connection)
+            else:
+                self.release_connection(connection)
+            if response.status != 200:
+                logging.getLogger("HWR").error("Input files server %s: GET %s " \
+                     % (self.server, path) + "returned %d" % response.status)
+                return None
+            return body
+
+    def get_all(self, paths):
+        """
+        Descript. : issues all GET requests concurrently
+        Return.   : dict path -> response body (None if failed)
+        """
+        start = time.time()
+        paths = list(set(paths))
+        get_tasks = [gevent.spawn(self.get, path) for path in paths]
+        gevent.joinall(get_tasks)
+        logging.getLogger("HWR").debug("Input files server: %d requests " \
+             % len(paths) + "in %.3f s" % (time.time() - start))
+        return dict([(path, get_task.value) for path, get_task \
+                     in zip(paths, get_tasks)])
+
+
+def to_text(content):
+    if content is None:
+        return ""
+    if not isinstance(content, str):
+        return content.decode("utf-8")
+    return content
+
+
+def write_file_atomic(filename, content, mode=0o666):
+    """Writes content (str) in filename through a temporary file and rename"""
+    directory, basename = os.path.split(filename)
+    fd, temp_filename = tempfile.mkstemp(prefix=".%s." % basename,
+                                         dir=directory or ".")
+    try:
+        with os.fdopen(fd, "w") as temp_file:
+            temp_file.write(content)
+        os.chmod(temp_filename, mode)
+        os.rename(temp_filename, filename)
+    except:
+        try:
+            os.unlink(temp_filename)
+        except OSError:
+            pass
+        raise
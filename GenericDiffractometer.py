@@ -655,6 +655,15 @@ class GenericDiffractometer(HardwareObject):
     def get_centred_point_from_coord(self):
         raise NotImplementedError
 
+    def get_centred_points_from_coord(self, coord_list, return_by_names=None):
+        """
+        Returns a list of centring points, one per (x, y) screen coordinate
+        in coord_list. Diffractometers with a centring math object
+        should overload it to convert all points in one go.
+        """
+        return [self.get_centred_point_from_coord(x, y, return_by_names) \
+                for x, y in coord_list]
+
     def get_point_between_two_points(self, point_one, point_two, frame_num, frame_total):
         """
         Method returns a centring point between two centring points
@@ -4,6 +4,7 @@ A client for ISPyB Webservices.
 
 import logging
 import gevent
+import gevent.queue
 import suds; logging.getLogger("suds").setLevel(logging.INFO)
 import os
 import itertools
@@ -37,6 +38,13 @@ _CONNECTION_ERROR_MSG = "Could not connect to ISPyB, please verify that " + \
                         "the server is running and that your " + \
                         "configuration is correct"
 
+# Defaults for the image write-behind queue, can be overriden in the
+# HardwareObject XML file (image_queue_size, image_batch_size,
+# image_store_retries).
+_IMAGE_QUEUE_SIZE = 2000
+_IMAGE_BATCH_SIZE = 20
+_IMAGE_STORE_RETRIES = 3
+
 
 SampleReference = namedtuple('SampleReference', ['code',
                                                  'container_reference',
@@ -122,6 +130,20 @@ class ISPyBClient2(HardwareObject):
         self.ws_username = None
         self.ws_password = None
 
+        self.__image_queue = None
+        self.__image_queue_task = None
+        self.__image_batch_size = _IMAGE_BATCH_SIZE
+        self.__image_store_retries = _IMAGE_STORE_RETRIES
+        self.__image_queue_info = {'queued': 0,
+                                   'stored': 0,
+                                   'failed': 0,
+                                   'dropped': 0,
+                                   'retries': 0,
+                                   'last_latency': None,
+                                   'max_latency': None}
+        # (sample changer, inventory generation, sample_refs, index)
+        self.__inventory_references = None
+
     def init(self):
         """
         Init method declared by HardwareObject.
@@ -145,6 +167,13 @@ class ISPyBClient2(HardwareObject):
         if not self.ws_password:
             self.ws_password = _WS_PASSWORD
 
+        self.__image_queue = gevent.queue.JoinableQueue(\
+             self.getProperty('image_queue_size') or _IMAGE_QUEUE_SIZE)
+        self.__image_batch_size = self.getProperty('image_batch_size') or \
+             _IMAGE_BATCH_SIZE
+        self.__image_store_retries = self.getProperty('image_store_retries') or \
+             _IMAGE_STORE_RETRIES
+
         try:
             # ws_root is a property in the configuration xml file
             if self.ws_root:
@@ -889,36 +918,233 @@ class ISPyBClient2(HardwareObject):
                 exception("Error in store_image: could not connect to server")
 
 
-    def __find_sample(self, sample_ref_list, code = None, location = None):
+    def queue_image(self, image_dict):
+        """
+        Adds the image (image parameters) <image_dict> to the write-behind
+        queue and returns immediately. The images are stored in ISPyB by a
+        background greenlet, see store_image.
+
+        If the queue is full the image is dropped (and counted as such in
+        get_image_queue_info) rather than blocking the caller.
+
+        :param image_dict: A dictonary with image pramaters.
+        :type image_dict: dict
+
+        :returns: True if the image was queued, False otherwise.
+        :rtype: bool
+        """
+        if self.__disabled:
+            return False
+
+        if self.__image_queue is None:
+            self.__image_queue = gevent.queue.JoinableQueue(_IMAGE_QUEUE_SIZE)
+
+        try:
+            self.__image_queue.put_nowait((time.time(), image_dict))
+        except gevent.queue.Full:
+            self.__image_queue_info['dropped'] += 1
+            logging.getLogger("ispyb_client").warning("Image queue full " + \
+                "(%d images), image %s not stored in ISPyB" % \
+                (self.__image_queue.qsize(), image_dict.get('fileName')))
+            return False
+
+        self.__image_queue_info['queued'] += 1
+
+        if self.__image_queue_task is None or self.__image_queue_task.ready():
+            self.__image_queue_task = gevent.spawn(self.__image_queue_loop)
+
+        return True
+
+
+    def flush_image_queue(self, timeout=None):
         """
-        Returns the sample with the matching "search criteria" <code> and/or
-        <location> with-in the list sample_ref_list.
+        Waits until all the queued images have been handled.
+
+        :param timeout: Maximum time to wait in seconds, None waits forever.
+        :type timeout: float
+
+        :returns: True if the queue is empty, False if timeout occured.
+        :rtype: bool
+        """
+        if self.__image_queue is None:
+            return True
+
+        flushed = self.__image_queue.join(timeout)
+        if not flushed:
+            logging.getLogger("ispyb_client").warning("Image queue not " + \
+                "flushed after %s s, %d images pending" % \
+                (timeout, self.__image_queue.qsize()))
+        return flushed
+
+
+    def get_image_queue_info(self):
+        """
+        Returns the state of the image write-behind queue: number of pending
+        images (depth), counters for queued, stored, failed, dropped images
+        and retries, last and maximum latency (seconds between queue_image
+        and the image being stored).
+
+        :rtype: dict
+        """
+        info = dict(self.__image_queue_info)
+        if self.__image_queue is not None:
+            info['depth'] = self.__image_queue.qsize()
+        else:
+            info['depth'] = 0
+        return info
+
+
+    def __image_queue_loop(self):
+        """
+        Consumes the image queue, stores up to image_batch_size images per
+        iteration. Ends when the queue is empty, queue_image starts it
+        again when needed.
+        """
+        while not self.__image_queue.empty():
+            batch = []
+            while len(batch) < self.__image_batch_size:
+                try:
+                    batch.append(self.__image_queue.get_nowait())
+                except gevent.queue.Empty:
+                    break
+
+            for queued_time, image_dict in batch:
+                try:
+                    if self.__store_queued_image(image_dict) is not None:
+                        latency = time.time() - queued_time
+                        self.__image_queue_info['stored'] += 1
+                        self.__image_queue_info['last_latency'] = latency
+                        self.__image_queue_info['max_latency'] = \
+                            max(latency, self.__image_queue_info['max_latency'] or 0)
+                    else:
+                        self.__image_queue_info['failed'] += 1
+                except:
+                    self.__image_queue_info['failed'] += 1
+                    logging.getLogger("ispyb_client").\
+                        exception("ISPyBClient: exception in image queue")
+                finally:
+                    self.__image_queue.task_done()
+            gevent.sleep(0)
+
+
+    def __store_queued_image(self, image_dict):
+        """
+        Stores one queued image, retries with an increasing delay when
+        the server can not be reached.
+
+        :returns: The image id or None if the image could not be stored.
+        """
+        if self.__disabled or not self.__collection:
+            return None
+
+        if 'dataCollectionId' not in image_dict:
+            logging.getLogger("ispyb_client").error("Error in store_image: " + \
+                 "data_collection_id missing, could not store image in ISPyB")
+            return None
+
+        for attempt in range(self.__image_store_retries + 1):
+            try:
+                return self.__collection.service.storeOrUpdateImage(image_dict)
+            except WebFault:
+                logging.getLogger("ispyb_client").\
+                    exception("ISPyBClient: exception in store_image")
+                return None
+            except URLError:
+                if attempt == self.__image_store_retries:
+                    logging.getLogger("ispyb_client").\
+                        exception(_CONNECTION_ERROR_MSG)
+                    return None
+                self.__image_queue_info['retries'] += 1
+                gevent.sleep(0.5 * (attempt + 1))
+
+
+    def __index_samples(self, sample_ref_list):
+        """
+        Indexes the sample_refs in sample_ref_list by code and by
+        (basket, vial) location. Each index entry is a list of sample_refs
+        in the order of sample_ref_list.
 
         The sample_ref object is defined in the head of the file.
 
-        :param sample_ref_list: The list of sample_refs to search.
+        :param sample_ref_list: The list of sample_refs to index.
         :type sample_ref: list
 
+        :returns: A tuple (code index, location index)
+        :rtype: tuple
+        """
+        code_index = {}
+        location_index = {}
+
+        for sample_ref in sample_ref_list:
+            code_index.setdefault(sample_ref.code, []).append(sample_ref)
+            location_index.setdefault((sample_ref.container_reference,
+                                       sample_ref.sample_reference),
+                                      []).append(sample_ref)
+
+        return code_index, location_index
+
+
+    def __get_inventory_references(self, sample_changer):
+        """
+        Returns the sample_refs of the present samples of the sample
+        changer, built from its inventory, and their index. Both are
+        reused while the inventory generation does not change.
+
+        :param sample_changer: The sample changer hardware object.
+        :type sample_changer: SampleChanger
+
+        :returns: A tuple (list of sample_refs, sample index)
+        :rtype: tuple
+        """
+        generation = sample_changer.getInventoryGeneration()
+        cached = self.__inventory_references
+        if cached is None or cached[0] is not sample_changer or \
+           cached[1] != generation:
+            inventory = sample_changer.getInventory()
+            basket_codes = dict((basket.basket, basket.code) for basket \
+                                in inventory.baskets)
+            sample_references = [SampleReference(sample.code, sample.basket,
+                 sample.vial, basket_codes.get(sample.basket, '')) \
+                 for sample in inventory.samples if sample.present]
+            cached = (sample_changer, inventory.generation, sample_references,
+                      self.__index_samples(sample_references))
+            self.__inventory_references = cached
+
+        return cached[2], cached[3]
+
+
+    def __find_sample(self, sample_index, matched, code = None, location = None):
+        """
+        Returns the first sample, not already matched, with the matching
+        "search criteria" <code> and/or <location> in sample_index.
+
+        :param sample_index: The indexes returned by __index_samples.
+        :type sample_index: tuple
+
+        :param matched: The ids of the sample_refs already matched.
+        :type matched: set
+
         :param code: The vial datamatrix code (or bar code)
         :param type: str
 
         :param location: A tuple (<basket>, <vial>) to search for.
         :type location: tuple
         """
-        for sample_ref in sample_ref_list:
+        code_index, location_index = sample_index
 
-            if code and location:
-                if sample_ref.code == code and \
-                        sample_ref.container_reference == location[0] and \
-                        sample_ref.sample_reference == location[1]:
-                    return sample_ref
-            elif code:
-                if sample_ref.code == code:
-                    return sample_ref
-            elif location:
-                if sample_ref.container_reference == location[0] and \
-                       sample_ref.sample_reference == location[1]:
-                    return sample_ref
+        if location:
+            candidates = location_index.get(tuple(location), ())
+        elif code:
+            candidates = code_index.get(code, ())
+        else:
+            candidates = ()
+
+        for sample_ref in candidates:
+            if id(sample_ref) in matched:
+                continue
+            if code and location and sample_ref.code != code:
+                continue
+            return sample_ref
 
         return None
 
@@ -961,20 +1187,26 @@ class ISPyBClient2(HardwareObject):
 
         :param sample_refs: The list of samples currently in the
                             sample changer. As a list of sample_ref
-                            objects
-        :type sample_refs: list (of sample_ref objects).
+                            objects, or the sample changer hardware
+                            object, its inventory is then used
+        :type sample_refs: list (of sample_ref objects) or SampleChanger
 
         :returns: A list with sample_ref objects.
         :rtype: list
         """
         if self.__tools_ws:
-            sample_references = []
             session = self.get_session(session_id)
             response_samples = []
 
-            for sample_ref in sample_refs:
-                sample_reference = SampleReference(*sample_ref)
-                sample_references.append(sample_reference)
+            if hasattr(sample_refs, 'getInventory'):
+                sample_references, sample_index = \
+                    self.__get_inventory_references(sample_refs)
+            else:
+                sample_references = [SampleReference(*sample_ref) \
+                                     for sample_ref in sample_refs]
+                # Index the sample changer samples once, matched samples
+                # are flagged instead of being removed from the list
+                sample_index = self.__index_samples(sample_references)
 
             try:
                 response_samples = self.__tools_ws.service.\
@@ -986,8 +1218,10 @@ class ISPyBClient2(HardwareObject):
             except URLError:
                 logging.getLogger("ispyb_client").exception(_CONNECTION_ERROR_MSG)
 
+            matched = set()
+
             samples = []
-            for sample in response_samples:
+            for sample in response_samples or []:
                 try:
                     loc = [None, None]
                     try:
@@ -1008,51 +1242,47 @@ class ISPyBClient2(HardwareObject):
                     # with the sample changer.
                     elif sample.code and sample.sampleLocation:
                         sc_sample = \
-                            self.__find_sample(sample_references,
+                            self.__find_sample(sample_index, matched,
                                                code = sample.code,
                                                location = loc)
 
                         # The sample codes dose not match
                         if not sc_sample:
-                            sc_sample = self.__find_sample(sample_references,
+                            sc_sample = self.__find_sample(sample_index,
+                                                           matched,
                                                            location = loc)
 
-                            if sc_sample.code != '':
+                            if sc_sample and sc_sample.code != '':
                                 sample.code = sc_sample.code
 
-                        sample_references.remove(sc_sample)
+                        if sc_sample:
+                            matched.add(id(sc_sample))
 
 
                     # Only location was found, update with the code
                     # from sample changer if it exists.
                     elif sample.sampleLocation:
                         sc_sample = \
-                            self.__find_sample(sample_references,
+                            self.__find_sample(sample_index, matched,
                                                location = loc)
                         if sc_sample:
                             sample.sampleCode = sc_sample.code
-                            sample_references.remove(sc_sample)
+                            matched.add(id(sc_sample))
 
                     # Sample code was found in ISPyB but dosent match with
                     # the samplechanger at given location
                     #
                     # Use the information from the sample changer.
                     else:
-                        #Use sample changer code for sample  ?
-                        sample.containerSampleChangerLocation = \
-                            sample_references.containter_referance
-                        sample.sampleLocation = \
-                            sample_references.sample_reference
-
-                        loc = (int(sample.containerSampleChangerLocation),
-                               int(sample.sampleLocation))
-
                         sc_sample = \
-                            self.__find_sample(sample_references,
-                                               location = loc)
+                            self.__find_sample(sample_index, matched,
+                                               code = sample.code)
                         if sc_sample:
-                            sample.code = sc_sample.code
-                            sample_references.remove(sc_sample)
+                            sample.containerSampleChangerLocation = \
+                                sc_sample.container_reference
+                            sample.sampleLocation = \
+                                sc_sample.sample_reference
+                            matched.add(id(sc_sample))
 
 
                     samples.append(utf_encode(asdict(sample)))
@@ -1064,11 +1294,15 @@ class ISPyBClient2(HardwareObject):
 #                              utf_encode(asdict(sample.diffractionPlan)),
 #                          'Protein': utf_encode(asdict(sample.protein))})
                 except:
-                    pass
+                    logging.getLogger("ispyb_client").\
+                        exception("Error in get_session_samples: could not " + \
+                                  "match sample %s" % getattr(sample, 'code', ''))
 
 
             # Add the unmatched samples to the result from ISPyB
             for sample_ref in sample_references:
+                if id(sample_ref) in matched:
+                    continue
                 samples.append(
                     {'code': sample_ref.code,
                      'location': sample_ref.sample_reference,
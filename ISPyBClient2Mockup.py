@@ -216,6 +216,35 @@ class ISPyBClient2Mockup(HardwareObject):
         """
         pass
 
+
+    def queue_image(self, image_dict):
+        """
+        Adds the image (image parameters) <image_dict> to the write-behind
+        queue.
+
+        :param image_dict: A dictonary with image pramaters.
+        :type image_dict: dict
+
+        :returns: True if the image was queued
+        """
+        return True
+
+
+    def flush_image_queue(self, timeout=None):
+        """
+        Waits until all the queued images have been handled.
+        """
+        return True
+
+
+    def get_image_queue_info(self):
+        """
+        Returns the state of the image write-behind queue.
+        """
+        return {'depth': 0, 'queued': 0, 'stored': 0, 'failed': 0,
+                'dropped': 0, 'retries': 0, 'last_latency': None,
+                'max_latency': None}
+
     
     def __find_sample(self, sample_ref_list, code = None, location = None):
         """
@@ -572,3 +601,104 @@ class ISPyBClient2Mockup(HardwareObject):
     storeImage = store_image
     storeEnergyScan = store_energy_scan
     storeXfeSpectrum = store_xfe_spectrum
+
+
+def make_test_proposal(number_of_samples=2000, vials_per_basket=10):
+    """
+    Descript. : synthetic proposal and sample changer contents. Sample i
+                is in basket i // vials_per_basket + 1, vial
+                i % vials_per_basket + 1 of the sample changer, and is in
+                turn registered in ISPyB with its code and location, with
+                a wrong code, with the location only, with the code only
+                and without code and location
+    Return.   : (ISPyB samples (dicts), sample_refs (code, basket, vial,
+                basket code), expected (code, basket, vial) of the samples
+                returned by get_session_samples)
+    """
+    ispyb_samples = []
+    sample_refs = []
+    expected = []
+    for index in range(number_of_samples):
+        basket = index // vials_per_basket + 1
+        vial = index % vials_per_basket + 1
+        code = "sc%d_%02d" % (basket, vial)
+        sample_refs.append((code, basket, vial, "basket%d" % basket))
+        expected.append((code, basket, vial))
+
+        sample = {"sampleId": index + 1,
+                  "sampleName": "sample%d" % (index + 1),
+                  "code": None,
+                  "containerSampleChangerLocation": None,
+                  "sampleLocation": None}
+        case = index % 5
+        if case in (0, 3):
+            sample["code"] = code
+        elif case == 1:
+            sample["code"] = "lims%d" % (index + 1)
+        if case in (0, 1, 2):
+            sample["containerSampleChangerLocation"] = str(basket)
+            sample["sampleLocation"] = str(vial)
+        if case == 4:
+            # not matched, returned as is, the sample changer sample is
+            # added to the result
+            expected.append((None, None, None))
+        ispyb_samples.append(sample)
+    return ispyb_samples, sample_refs, expected
+
+
+class MockupToolsWebService(object):
+    """
+    Descript. : stands for the ISPyB tools web service client, serving the
+                samples of a synthetic proposal as suds objects
+    """
+    def __init__(self, ispyb_samples):
+        self.service = self
+        self._ispyb_samples = ispyb_samples
+
+    def findSampleInfoLightForProposal(self, proposal_id, beamline_name):
+        from suds.sudsobject import Factory
+        return [Factory.object("SampleInfo", dict(sample)) \
+                for sample in self._ispyb_samples]
+
+
+def check_session_samples(number_of_samples=2000):
+    """
+    Descript. : matches a synthetic proposal of number_of_samples samples
+                (make_test_proposal) against the sample changer contents
+                with ISPyBClient2.get_session_samples
+    Return.   : (number of wrong or missing samples, matching time [s])
+    """
+    import time
+    from collections import Counter
+    from ISPyBClient2 import ISPyBClient2
+
+    ispyb_samples, sample_refs, expected = \
+         make_test_proposal(number_of_samples)
+    lims_client = ISPyBClient2("check_session_samples")
+    lims_client.beamline_name = "mockup"
+    # private attribute of ISPyBClient2, set by init from the wsdl
+    lims_client._ISPyBClient2__tools_ws = \
+         MockupToolsWebService(ispyb_samples)
+    lims_client.get_session = lambda session_id: {}
+
+    start = time.time()
+    result = lims_client.get_session_samples(1, 1, sample_refs)
+    matching_time = time.time() - start
+
+    samples = []
+    for sample in result["loaded_sample"]:
+        location = sample.get("sampleLocation", sample.get("location"))
+        code = sample.get("code") or sample.get("sampleCode")
+        try:
+            samples.append((code,
+                            int(sample["containerSampleChangerLocation"]),
+                            int(location)))
+        except (TypeError, ValueError):
+            samples.append((code, None, None))
+
+    errors = sum(((Counter(expected) - Counter(samples)) + \
+                  (Counter(samples) - Counter(expected))).values())
+    logging.getLogger("HWR").info("get_session_samples: %d samples " \
+         % number_of_samples + "matched in %.3f s, %d wrong" \
+         % (matching_time, errors))
+    return errors, matching_time
@@ -14,6 +14,8 @@ import os
 import time
 import logging
 import gevent
+import numpy
+import video_utils
 
 from Lima import Core 
 from Lima import Prosilica
@@ -23,6 +25,19 @@ from HardwareRepository.BaseHardwareObjects import Device
 from HardwareRepository.HardwareObjects.Camera import JpegType, BayerType, \
      MmapType, RawType, RGBType
 
+class VideoImageCallback(Core.CtVideo.ImageCallback):
+    """
+    Descript. : keeps the number of the last frame pushed by Lima, the
+                polling loop then only converts new frames
+    """
+    def __init__(self):
+        Core.CtVideo.ImageCallback.__init__(self)
+        self.frame_number = None
+
+    def newImage(self, image):
+        self.frame_number = image.frameNumber()
+
+
 class LimaVideo(Device):
     """
     Descript. : 
@@ -54,6 +69,8 @@ class LimaVideo(Device):
         self.video = None 
 
         self.image_polling = None
+        self.image_callback = None
+        self.frame_poller = None
 
     def init(self):
         """
@@ -262,9 +279,32 @@ class LimaVideo(Device):
         Descript. :
         """
         self.do_scaling = True 
+        self.frame_poller = video_utils.FramePoller(sleep_time)
+        try:
+            self.image_callback = VideoImageCallback()
+            self.video.registerImageCallback(self.image_callback)
+        except:
+            logging.getLogger().debug("LimaVideo: image callback not " + \
+                                      "available, polling last image")
+            self.image_callback = None
+
         while self.video.getLive():
-            self.get_new_image()
-            time.sleep(sleep_time)
+            if self.image_callback is not None:
+                if self.frame_poller.is_new_frame(self.image_callback.frame_number):
+                    self.get_new_image()
+            else:
+                image = self.video.getLastImage()
+                if self.frame_poller.is_new_frame(image.frameNumber()):
+                    self.get_new_image(image)
+            time.sleep(self.frame_poller.interval)
+
+    def get_frame_statistics(self):
+        """
+        Descript. : counters of polled, converted and dropped frames
+        """
+        if self.frame_poller is None:
+            return {}
+        return self.frame_poller.get_statistics()
 	     	
     def connectNotify(self, signal):
         """
@@ -281,11 +321,12 @@ class LimaVideo(Device):
         """
         self.do_scaling = True
 
-    def get_new_image(self):
+    def get_new_image(self, image=None):
         """
         Descript. :
         """
-        image = self.video.getLastImage()
+        if image is None:
+            image = self.video.getLastImage()
         if image.frameNumber() > -1:
             raw_buffer = image.buffer()	
             if self.do_scaling:
@@ -297,10 +338,39 @@ class LimaVideo(Device):
             if valid_flag:
                 if self.cam_mirror is not None:
                     qimage = qimage.mirror(self.cam_mirror[0], self.cam_mirror[1])     
+                if self.frame_poller is not None:
+                    self.frame_poller.frame_converted()
                 self.emit("imageReceived", qimage, qimage.width(),
                           qimage.height(), self.force_update)
                 return qimage
 
+    def get_frame_array(self):
+        """
+        Descript. : returns the last frame as a greyscale numpy array (uint8)
+                    without converting it to a QImage
+        """
+        image = self.video.getLastImage()
+        if image.frameNumber() < 0:
+            return
+        raw_buffer = image.buffer()
+        width, height = image.width(), image.height()
+        if self.scaling_type == pixmaptools.LUT.Scaling.Y8:
+            frame = video_utils.grey_buffer_to_array(raw_buffer, width, height)
+        elif self.scaling_type == pixmaptools.LUT.Scaling.BAYER_RG8:
+            frame = video_utils.bayer_to_grey(raw_buffer, width, height,
+                                              numpy.uint8)
+        elif self.scaling_type == pixmaptools.LUT.Scaling.BAYER_RG16:
+            frame = video_utils.bayer_to_grey(raw_buffer, width, height)
+        elif self.scaling_type == pixmaptools.LUT.Scaling.RGB24:
+            frame = video_utils.rgb_to_grey(raw_buffer, width, height)
+        else:
+            logging.getLogger().error("LimaVideo: frame array not " + \
+                                      "available for this image type")
+            return
+        if self.cam_mirror is not None:
+            frame = video_utils.mirror(frame, self.cam_mirror[0], self.cam_mirror[1])
+        return frame
+
     def take_snapshot(self, filename, bw=False):
         """
         Descript. :
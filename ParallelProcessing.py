@@ -23,6 +23,9 @@ from XSDataCommon import XSDataFile
 from XSDataCommon import XSDataInteger
 from XSDataCommon import XSDataString
 
+from dozor_utils import DozorChunkReader, DozorResultWatcher, \
+     DOZOR_CHUNK_TEMPLATE
+
 
 class ParallelProcessing(HardwareObject):
     def __init__(self, name):
@@ -38,6 +41,7 @@ class ParallelProcessing(HardwareObject):
         self.processing_start_command = None
         self.processing_results = None
         self.processing_done_event = None
+        self.result_emit_period = None
 
     def init(self):
         self.processing_done_event = gevent.event.Event()
@@ -53,6 +57,8 @@ class ParallelProcessing(HardwareObject):
             logging.info("ParallelProcessing: No beamstop hwobj defined")
 
         self.processing_start_command = str(self.getProperty("processing_command"))        
+        # min. time (sec.) between two processingSetResult during processing
+        self.result_emit_period = float(self.getProperty("result_emit_period") or 1.0)
 
     def create_processing_input(self, data_collection, processing_params, grid_object):
         """
@@ -209,33 +215,32 @@ class ParallelProcessing(HardwareObject):
 
         processing_input, processing_params = self.create_processing_input(\
              data_collection, processing_params, grid_object) 
-        """
+
         processing_input_file = os.path.join(processing_directory, "dozor_input.xml")
         processing_input.exportToFile(processing_input_file)
 
-        if not os.path.isfile(self.processing_start_command):
-            self.processing_done_event.set()
-            msg = "ParallelProcessing: Start command %s is not executable" % self.processing_start_command
-            logging.getLogger("queue_exec").error(msg)
-            self.emit("processingFailed")
-            return       
+        simulate = not os.path.isfile(self.processing_start_command)
+        if simulate:
+            msg = "ParallelProcessing: Start command %s is not executable, " % \
+                  self.processing_start_command + "simulated results are used"
+            logging.getLogger("queue_exec").warning(msg)
         else:
             msg = "ParallelProcessing: Starting processing using xml file %s" % processing_input_file
             logging.getLogger("queue_exec").info(msg)
-            line_to_execute = self.processing_start_command + ' ' + \
-                              processing_input_file + ' ' + \
-                              processing_directory
-        subprocess.Popen(str(line_to_execute), shell = True,
-                         stdin = None, stdout = None, stderr = None,
-                         close_fds = True)
-        """
-
-        self.do_processing_result_polling(processing_params, file_wait_timeout, grid_object)
+            subprocess.Popen([self.processing_start_command,
+                              processing_input_file,
+                              processing_directory],
+                             stdin = None, stdout = None, stderr = None,
+                             close_fds = True)
+
+        self.do_processing_result_polling(processing_params, file_wait_timeout,
+                                          grid_object, simulate)
         
-    def do_processing_result_polling(self, processing_params, wait_timeout, grid_object):
+    def do_processing_result_polling(self, processing_params, wait_timeout,
+                                     grid_object, simulate=False):
         """Method polls processing results. Based on the polling of edna 
-           result files. After each result file results are aligned to match 
-           the diffractometer configuration.
+           result files. Result files are read while they are written and
+           new results are merged and emitted as they arrive.
            If processing succed (files appear before timeout) then a heat map 
            is created and results are stored in ispyb.
            If processing was executed for helical line then heat map as a 
@@ -253,82 +258,18 @@ class ParallelProcessing(HardwareObject):
                         "score" : numpy.zeros(processing_params["images_num"])}
 
         processing_params["status"] = "Success"
-        failed = False
 
-        """
-        do_polling = True
-        result_file_index = 0
-        _result_place = []
-        _first_frame_timout = 5 * 60 / 10
-        _time_out = _first_frame_timout
-        _start_time = time.time()
-       
-        while _result_place == [] and time.time() - _start_time < _time_out :
-           _result_place = glob.glob(os.path.join(processing_params["directory"],"EDApplication*/"))
-           gevent.sleep(0.2)
-        if _result_place == [] : 
-           msg = "ParallelProcessing: Failed to read dozor result directory %s" % processing_params["directory"]
-           logging.error(msg)
-           processing_params["status"] = "Failed"
-           processing_params["comments"] += "Failed: " + msg
-           self.emit("processingFailed")
-           self.processing_done_event.set()
-           failed = True
-
-        while do_polling and not failed:
-            file_appeared = False
-            result_file_name = os.path.join(_result_place[0],"ResultControlDozor_Chunk_%06d.xml" % result_file_index)
-            wait_file_start = time.time()
-            logging.debug('ParallelProcessing: Waiting for Dozor result file: %s' % result_file_name)
-            while not file_appeared and time.time() - wait_file_start < wait_timeout:
-                if os.path.exists(result_file_name) and os.stat(result_file_name).st_size > 0:
-                    file_appeared = True
-                    _time_out = wait_timeout
-                    logging.debug('ParallelProcessing: Dozor file is there, size={0}'.format(os.stat(result_file_name).st_size))
-                else:
-                    os.system("ls %s > /dev/null" %_result_place[0])
-                    gevent.sleep(0.2)
-            if not file_appeared:
-                failed = True
-                msg = 'ParallelProcessing: Dozor result file ({0}) failed to appear after {1} seconds'.\
-                      format(result_file_name, wait_timeout)
-                logging.error(msg)
-                processing_params["status"] = "Failed"
-                processing_params["comments"] += "Failed: " + msg
-                self.emit("processingFailed")
-                
-            # poll while the size increasing:
-            _oldsize = -1 
-            _newsize =  0
-            while _oldsize < _newsize :
-                _oldsize = _newsize
-                _newsize = os.stat(result_file_name).st_size
-                gevent.sleep(0.1)
-                                
-            dozor_output_file = XSDataResultControlDozor.parseFile(result_file_name)
-            #this method could be improved with xml parsing
-            for dozor_image in dozor_output_file.getImageDozor():
-                image_index = dozor_image.getNumber().getValue() - 1
-                processing_result["image_num"][image_index] = image_index
-                processing_result["spots_num"][image_index] = dozor_image.getSpots_num_of().getValue()
-                processing_result["spots_int_aver"][image_index] = dozor_image.getSpots_int_aver().getValue()   
-                processing_result["spots_resolution"][image_index] = dozor_image.getSpots_resolution().getValue()
-                processing_result["score"][image_index] = dozor_image.getScore().getValue()
-                image_index += 1
-                do_polling = (dozor_image.getNumber().getValue() != processing_params["images_num"])
-
-            aligned_result = self.align_processing_results(dozor_result, processing_params)
-            self.emit("processingSetResult", (aligned_result, processing_params, False))
-            result_file_index += 1
-        """
-
-        gevent.sleep(10)
-        #This is for test...
-
-        for key in list(processing_result.keys()):
-            processing_result[key] = numpy.linspace(0, 
-                 processing_params["images_num"], 
-                 processing_params["images_num"]).astype('uint8')
+        if simulate:
+            gevent.sleep(10)
+            #This is for test...
+            for key in list(processing_result.keys()):
+                processing_result[key] = numpy.linspace(0, 
+                     processing_params["images_num"], 
+                     processing_params["images_num"]).astype('uint8')
+        elif not self.read_processing_results(processing_result,
+                  processing_params, wait_timeout, grid_object):
+            self.processing_done_event.set()
+            return
 
         self.processing_results = self.align_processing_results(\
              processing_result, processing_params, grid_object)
@@ -449,10 +390,114 @@ class ParallelProcessing(HardwareObject):
         plt.close(fig)
         self.processing_done_event.set()
 
+    def read_processing_results(self, processing_result, processing_params,
+                                wait_timeout, grid_object):
+        """
+        Descript. : Reads dozor result chunks while they are written and
+                    merges them into the preallocated result arrays.
+                    The grid score is updated after each read, the
+                    aligned results of all cells are emitted with
+                    processingSetResult at most every result_emit_period
+                    sec. and when all images are processed
+        Args.     : processing_result (dict of numpy arrays),
+                    wait_timeout (sec. without new results before failing)
+        Return.   : True if all images were processed
+        """
+        result_place = []
+        first_frame_timeout = 5 * 60 / 10
+        start_time = time.time()
+        while not result_place and time.time() - start_time < first_frame_timeout:
+            result_place = glob.glob(os.path.join(processing_params["directory"],
+                                                  "EDApplication*/"))
+            if not result_place:
+                gevent.sleep(0.2)
+        if not result_place:
+            self.set_processing_failed(processing_params,
+                 "ParallelProcessing: Failed to read dozor result directory %s" % \
+                 processing_params["directory"])
+            return False
+
+        cell_index = self.get_cell_index(processing_params, grid_object)
+        result_dir = result_place[0]
+        watcher = DozorResultWatcher(result_dir)
+        chunk_index = 0
+        chunk_reader = DozorChunkReader(os.path.join(result_dir,
+             DOZOR_CHUNK_TEMPLATE % chunk_index))
+        logging.getLogger("HWR").debug("ParallelProcessing: Reading dozor results from %s" % \
+             result_dir)
+        images_done = 0
+        last_result_time = time.time()
+        last_emit_time = 0
+        emit_pending = False
+        try:
+            while images_done < processing_params["images_num"]:
+                records = chunk_reader.read()
+                if records:
+                    last_result_time = time.time()
+                    images_done = max(images_done, self.merge_processing_chunk(\
+                         records, processing_result))
+                    if cell_index is not None:
+                        grid_object.set_score(processing_result["score"])
+                    emit_pending = True
+                if emit_pending and (images_done >= processing_params["images_num"] or \
+                   time.time() - last_emit_time > self.result_emit_period):
+                    self.emit("processingSetResult", (self.align_processing_results(\
+                         processing_result, processing_params, grid_object,
+                         cell_index), processing_params, False))
+                    last_emit_time = time.time()
+                    emit_pending = False
+                if chunk_reader.is_finished():
+                    chunk_index += 1
+                    chunk_reader = DozorChunkReader(os.path.join(result_dir,
+                         DOZOR_CHUNK_TEMPLATE % chunk_index))
+                elif time.time() - last_result_time > wait_timeout:
+                    self.set_processing_failed(processing_params,
+                         "ParallelProcessing: Dozor result file (%s) failed to appear after %d seconds" % \
+                         (chunk_reader.filename, wait_timeout))
+                    return False
+                elif not records:
+                    watcher.wait()
+        except:
+            logging.getLogger("HWR").exception("")
+            self.set_processing_failed(processing_params,
+                 "ParallelProcessing: Could not read dozor result file %s" % \
+                 chunk_reader.filename)
+            return False
+        finally:
+            watcher.close()
+        return True
+
+    def merge_processing_chunk(self, records, processing_result):
+        """
+        Descript. : Copies dozor records into the result arrays
+        Return.   : number of the last processed image
+        """
+        records = numpy.array(records)
+        image_index = records[:, 0].astype(int) - 1
+        valid = (image_index >= 0) & \
+                (image_index < processing_result["score"].size)
+        records = records[valid]
+        image_index = image_index[valid]
+        if image_index.size == 0:
+            return 0
+
+        for column, key in enumerate(("spots_num", "spots_int_aver",
+                                      "spots_resolution", "score"), 1):
+            processing_result[key][image_index] = records[:, column]
+        processing_result["image_num"][image_index] = image_index
+        return int(image_index.max()) + 1
+
+    def set_processing_failed(self, processing_params, msg):
+        logging.getLogger("HWR").error(msg)
+        processing_params["status"] = "Failed"
+        processing_params["comments"] += "Failed: " + msg
+        self.emit("processingFailed")
+
     def is_running(self):
         return not self.processing_done_event.is_set()
 
-    def align_processing_results(self, results_dict, processing_params, grid_object):
+    def align_processing_results(self, results_dict, processing_params,
+                                 grid_object, cell_index=None):
         """
         Descript. : Realigns all results. Each results (one dimensional numpy array)
                     is converted to 2d numpy array according to diffractometer
@@ -461,51 +506,72 @@ class ParallelProcessing(HardwareObject):
         Args.     : resuld_dict contains 5 one dimensional numpy arrays
         Return    : Dictionary with realigned results and best positions         
         """
-        #Each result array is realigned
+        #Each result array is realigned with the same cell index
+        if cell_index is None:
+            cell_index = self.get_cell_index(processing_params, grid_object)
         aligned_results = {}
         for result_array_key in results_dict.keys():
             aligned_results[result_array_key] = self.align_result_array(\
-              results_dict[result_array_key], processing_params, grid_object)
+              results_dict[result_array_key], processing_params, grid_object,
+              cell_index)
         if processing_params['lines_num'] > 1:
             grid_object.set_score(results_dict['score'])       
 
         #Best positions are extracted
         best_positions_list = []
-        index_arr = (-results_dict["score"]).argsort()[:10]
-        if len(index_arr) > 0:
-           for index in index_arr:
-               if results_dict["score"][index] > 0:
-                   best_position = {}
-                   best_position["index"] = index
-                   best_position["index_serial"] = processing_params["first_image_num"] + index
-                   best_position["score"] = float(results_dict["score"][index])
-                   best_position["spots_num"] = int(results_dict["spots_num"][index])
-                   best_position["spots_int_aver"] = float(results_dict["spots_int_aver"][index])
-                   best_position["spots_resolution"] = float(results_dict["spots_resolution"][index])
-                   best_position["filename"] = os.path.basename(processing_params["template"] % \
-                        (processing_params["run_number"], processing_params["first_image_num"] + index))
-
-                   cpos = None
-                   if processing_params["lines_num"] > 1: 
-                       col, row = grid_object.get_col_row_from_image_serial(\
-                            index + processing_params["first_image_num"])  
-                       cpos = grid_object.get_motor_pos_from_col_row(\
-                            col, row, as_cpos = True)
-                       #entred_position = processing_params["associated_grid"].get_motor_pos_from_col_row(col, row)
-                   else:
-                       col = index
-                       row = 0
-                       #cpos = processing_params["associated_data_collection"].get_motor_pos(index, as_cpos=True)
-                       cpos = None
-                       #TODO Add best position for helical line
-                   best_position["col"] = col + 1
-                   best_position["row"] = processing_params["steps_y"] - row
-                   best_position['cpos'] = cpos
-                   best_positions_list.append(best_position) 
+        score = results_dict["score"]
+        num_best = min(10, len(score))
+        if num_best > 0:
+            neg_score = -numpy.asarray(score, float)
+            index_arr = numpy.argpartition(neg_score, num_best - 1)[:num_best]
+            index_arr = index_arr[numpy.argsort(neg_score[index_arr])]
+            index_arr = index_arr[score[index_arr] > 0]
+        else:
+            index_arr = []
+
+        for index in index_arr:
+            index = int(index)
+            best_position = {}
+            best_position["index"] = index
+            best_position["index_serial"] = processing_params["first_image_num"] + index
+            best_position["score"] = float(score[index])
+            best_position["spots_num"] = int(results_dict["spots_num"][index])
+            best_position["spots_int_aver"] = float(results_dict["spots_int_aver"][index])
+            best_position["spots_resolution"] = float(results_dict["spots_resolution"][index])
+            best_position["filename"] = os.path.basename(processing_params["template"] % \
+                 (processing_params["run_number"], processing_params["first_image_num"] + index))
+
+            cpos = None
+            if processing_params["lines_num"] > 1: 
+                col = int(cell_index[0][index])
+                row = int(cell_index[1][index])
+                cpos = grid_object.get_motor_pos_from_col_row(\
+                     col, row, as_cpos = True)
+            else:
+                col = index
+                row = 0
+                #cpos = processing_params["associated_data_collection"].get_motor_pos(index, as_cpos=True)
+                cpos = None
+                #TODO Add best position for helical line
+            best_position["col"] = col + 1
+            best_position["row"] = processing_params["steps_y"] - row
+            best_position['cpos'] = cpos
+            best_positions_list.append(best_position) 
         aligned_results["best_positions"] = best_positions_list
         return aligned_results
 
-    def align_result_array(self, result_array, processing_params, grid_object):
+    def get_cell_index(self, processing_params, grid_object):
+        """
+        Descript. : returns (cols, rows) index arrays mapping result index
+                    to grid cell. None for helical lines
+        """
+        if processing_params["lines_num"] == 1:
+            return None
+        return grid_object.get_col_row_index(\
+             processing_params["first_image_num"])
+
+    def align_result_array(self, result_array, processing_params,
+                           grid_object, cell_index=None):
         """
         Descript. : realigns result array based on the grid
                     Result array is numpy 2d array
@@ -517,19 +583,101 @@ class ParallelProcessing(HardwareObject):
         num_images_per_line = processing_params["images_per_line"]
         num_colls = processing_params["steps_x"]
         num_rows = processing_params["steps_y"]
-        first_image_number = processing_params["first_image_num"]
 
         aligned_result_array = numpy.zeros(num_lines * num_images_per_line).\
                         reshape(num_colls, num_rows)        
 
-        for cell_index in range(aligned_result_array.size):
-           
-            col, row = grid_object.get_col_row_from_image_serial(\
-                cell_index + first_image_number)
-            if (col < aligned_result_array.shape[0] and 
-                row < aligned_result_array.shape[1]):
-                aligned_result_array[col][row] = result_array[cell_index]
+        if cell_index is None:
+            cell_index = self.get_cell_index(processing_params, grid_object)
+        cols, rows = cell_index
+        num_cells = min(aligned_result_array.size, len(cols), len(result_array))
+        cols = cols[:num_cells]
+        rows = rows[:num_cells]
+        valid = (cols < num_colls) & (rows < num_rows)
+        aligned_result_array[cols[valid], rows[valid]] = \
+            numpy.asarray(result_array)[:num_cells][valid]
         return numpy.transpose(aligned_result_array)
 
     def get_last_processing_results(self):
         return self.processing_results 
+
+
+def align_result_array_per_cell(result_array, processing_params, grid_object):
+    """
+    Descript. : reference for align_result_array, realigns the result
+                array cell by cell with get_col_row_from_image_serial
+    """
+    num_colls = processing_params["steps_x"]
+    num_rows = processing_params["steps_y"]
+    aligned_result_array = numpy.zeros(processing_params["lines_num"] * \
+         processing_params["images_per_line"]).reshape(num_colls, num_rows)
+
+    for cell_index in range(aligned_result_array.size):
+        col, row = grid_object.get_col_row_from_image_serial(\
+            cell_index + processing_params["first_image_num"])
+        if (col < aligned_result_array.shape[0] and
+            row < aligned_result_array.shape[1]):
+            aligned_result_array[col][row] = result_array[cell_index]
+    return numpy.transpose(aligned_result_array)
+
+
+def check_result_alignment(grid_sizes=((3, 4), (7, 1), (1, 5), (20, 13)),
+                           first_image_nums=(1, 3)):
+    """
+    Descript. : compares the grid col/row index and align_result_array with
+                the per cell conversion (get_col_row_from_image_serial), for
+                snake (reversing rotation) and non-snake grids, several
+                grid directions, sizes and first image numbers
+    Return.   : list of (grid direction, reversing rotation, cols, rows,
+                first image number) with a wrong index or alignment
+    """
+    from Qt4_GraphicsLib import GraphicsItemGrid, make_test_grid
+
+    grid_directions = ({"fast": [0, 1], "slow": [1, 0]},
+                       {"fast": [1, 0], "slow": [0, -1]},
+                       {"fast": [0, -1], "slow": [-1, 0]})
+    processing = ParallelProcessing.__new__(ParallelProcessing)
+    saved_grid_direction = getattr(GraphicsItemGrid, "grid_direction", None)
+    failed = []
+    try:
+        for grid_direction in grid_directions:
+            for reversing_rotation in (True, False):
+                for num_cols, num_rows in grid_sizes:
+                    grid_object = make_test_grid(grid_direction,
+                         reversing_rotation, num_cols, num_rows)
+                    properties = grid_object.get_properties()
+                    if properties["num_lines"] < 2:
+                        # helical line, results are not aligned
+                        continue
+                    for first_image_num in first_image_nums:
+                        processing_params = {
+                             "lines_num": properties["num_lines"],
+                             "images_per_line": \
+                                  properties["num_images_per_line"],
+                             "steps_x": num_cols,
+                             "steps_y": num_rows,
+                             "first_image_num": first_image_num}
+                        result_array = numpy.random.rand(num_cols * num_rows)
+                        cols, rows = grid_object.get_col_row_index(\
+                             first_image_num)
+                        index_ok = [(int(col), int(row)) for col, row \
+                                    in zip(cols, rows)] == \
+                             [grid_object.get_col_row_from_image_serial(\
+                                  index + first_image_num) \
+                              for index in range(num_cols * num_rows)]
+                        alignment_ok = numpy.array_equal(\
+                             processing.align_result_array(result_array,
+                                  processing_params, grid_object),
+                             align_result_array_per_cell(result_array,
+                                  processing_params, grid_object))
+                        if not (index_ok and alignment_ok):
+                            failed.append((grid_direction, reversing_rotation,
+                                           num_cols, num_rows, first_image_num))
+    finally:
+        if saved_grid_direction is not None:
+            GraphicsItemGrid.set_grid_direction(saved_grid_direction)
+
+    if failed:
+        logging.getLogger("HWR").error("ParallelProcessing: wrong result " + \
+             "alignment for %s" % str(failed))
+    return failed
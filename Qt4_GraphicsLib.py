@@ -40,6 +40,7 @@ Graphics item library:
 import copy
 import math
 import logging
+import numpy
 
 from PyQt4 import QtGui
 from PyQt4 import QtCore
@@ -442,6 +443,11 @@ class GraphicsItemGrid(GraphicsItem):
         self.__automatic = False
         self.__fill_alpha = 120
         self.__display_overlay = True
+        self.__col_row_index = None
+        self.__col_row_index_key = None
+        self.__score_version = 0
+        self.__overlay = None
+        self.__overlay_key = None
         
         self.update_item()
 
@@ -620,7 +626,13 @@ class GraphicsItemGrid(GraphicsItem):
         return self.__centred_position
 
     def set_score(self, score):
+        """
+        Descript. : sets score array (in image order). Has to be called
+                    again if the array is updated in place, to refresh
+                    the overlay
+        """
         self.__score = score
+        self.__score_version += 1
 
     def get_snapshot(self):
         return self.__snapshot
@@ -668,49 +680,18 @@ class GraphicsItemGrid(GraphicsItem):
                                  draw_start_x + self.__num_cols * self.__cell_size_pix[0],
                                  draw_start_y + offset)    
 
-            #Draws beam shape and displays number of image if 
-            #less than 1000 cells and size is greater than 20px
-            cell_index = 0
-            if self.__num_cols * self.__num_rows < 1000 and self.__cell_size_pix[1] > 20:
-                for col in range(self.__num_cols):
-                    for row in range(self.__num_rows):
-                        #Estimate area where frame number or score will be displayed
-                        line, image = self.get_line_image_num(cell_index + self.__first_image_num)
-                        pos_x, pos_y = self.get_coord_from_line_image(line, image)
-                        paint_rect = QtCore.QRect(\
-                            pos_x - self.__cell_size_pix[0] / 2, 
-                            pos_y - self.__cell_size_pix[1] / 2,
-                            self.__cell_size_pix[0], 
-                            self.__cell_size_pix[1])
-
-                        #If score exists overlay color may change
-                        cell_score = None
-                        brush_color = QtGui.QColor(70, 70, 165, self.__fill_alpha)
-                        if self.__display_overlay: 
-                            #painter.setBrush(QtGui.QColor(70, 70, 165))
-                            if self.__score is not None:
-                                cell_score = self.__score[cell_index]
-                                if self.__score.max() > 0:
-                                    cell_score = float(cell_score) / self.__score.max()
-                                    brush_color.setHsv(0 + 60 * cell_score, 255, 255 * cell_score, self.__fill_alpha)
-                            self.custom_brush.setColor(brush_color)
-                            painter.setBrush(self.custom_brush)
-                        else:
-                            painter.setBrush(QtCore.Qt.transparent)
-
-                        if self.beam_is_rectangle:
-                            painter.drawRect(pos_x - self.beam_size_pix[0] / 2,
-                                             pos_y - self.beam_size_pix[1] / 2,
-                                             self.beam_size_pix[0],
-                                             self.beam_size_pix[1])
-                        else:
-                            painter.drawEllipse(pos_x - self.beam_size_pix[0] / 2,
-                                                pos_y - self.beam_size_pix[1] / 2,
-                                                self.beam_size_pix[0],
-                                                self.beam_size_pix[1])
-                        painter.drawText(paint_rect, QtCore.Qt.AlignCenter, \
-                              str(cell_index + self.__first_image_num))
-                        cell_index += 1
+            #Cells are drawn from a cached overlay: beam shapes and image
+            #numbers if less than 1000 cells and size is greater than 20px,
+            #otherwise a heat map of the score
+            overlay = self.get_overlay()
+            if isinstance(overlay, QtGui.QPixmap):
+                painter.drawPixmap(QtCore.QPointF(draw_start_x, draw_start_y),
+                                   overlay)
+            elif overlay is not None:
+                painter.drawImage(QtCore.QRectF(draw_start_x, draw_start_y,
+                                                self.__grid_size_pix[0],
+                                                self.__grid_size_pix[1]),
+                                  overlay)
 
         #Draws x in the middle of the grid
         painter.drawLine(self.__center_coord.x() - 5, self.__center_coord.y() - 5,
@@ -729,6 +710,108 @@ class GraphicsItemGrid(GraphicsItem):
                          "%d x %d" % (self.__num_lines, self.__num_images_per_line))
  
             
+    def get_overlay(self):
+        """
+        Descript. : returns cached cell overlay (QPixmap with cells or QImage
+                    heat map with one pixel per cell). It is rebuilt only
+                    if geometry, score, alpha or pen changed
+        """
+        detailed = self.__num_cols * self.__num_rows < 1000 and \
+                   self.__cell_size_pix[1] > 20
+        overlay_key = (detailed, self.__num_cols, self.__num_rows,
+                       self.__num_lines, self.__num_images_per_line,
+                       self.__first_image_num, self.__reversing_rotation,
+                       tuple(self.__cell_size_pix), tuple(self.beam_size_pix),
+                       tuple(self.__grid_range_pix.items()),
+                       tuple(self.grid_direction['fast']),
+                       tuple(self.grid_direction['slow']),
+                       self.beam_is_rectangle, self.__fill_alpha,
+                       self.__display_overlay, self.__score_version,
+                       self.custom_pen.color().rgba(), self.custom_pen.style())
+        if overlay_key != self.__overlay_key:
+            if detailed:
+                self.__overlay = self.build_cells_pixmap()
+            elif self.__display_overlay and self.__score is not None:
+                self.__overlay = self.build_heat_map()
+            else:
+                self.__overlay = None
+            self.__overlay_key = overlay_key
+        return self.__overlay
+
+    def get_cell_colors(self):
+        """
+        Descript. : returns cell fill colors (rgba uint8 array, image order).
+                    Score is normalized once for all cells
+        """
+        num_cells = self.__num_lines * self.__num_images_per_line
+        colors = numpy.empty((num_cells, 4), numpy.uint8)
+        colors[:] = (70, 70, 165, self.__fill_alpha)
+        if not self.__display_overlay:
+            colors[:, 3] = 0
+        elif self.__score is not None:
+            score = numpy.asarray(self.__score, float)[:num_cells]
+            if score.size and score.max() > 0:
+                score = numpy.clip(score / score.max(), 0, 1)
+                #Same color as QColor.setHsv(60 * score, 255, 255 * score)
+                colors[:score.size, 0] = 255 * score
+                colors[:score.size, 1] = 255 * score * score
+                colors[:score.size, 2] = 0
+        return colors
+
+    def build_heat_map(self):
+        cols, rows = self.get_col_row_index()
+        colors = self.get_cell_colors()
+        valid = (cols >= 0) & (cols < self.__num_cols) & \
+                (rows >= 0) & (rows < self.__num_rows)
+        #QImage.Format_ARGB32 is stored as BGRA
+        image_array = numpy.zeros((self.__num_rows, self.__num_cols, 4),
+                                  numpy.uint8)
+        image_array[rows[valid], cols[valid]] = colors[valid][:, [2, 1, 0, 3]]
+        heat_map = QtGui.QImage(image_array.tobytes(), self.__num_cols,
+                                self.__num_rows, self.__num_cols * 4,
+                                QtGui.QImage.Format_ARGB32)
+        return heat_map.copy()
+
+    def build_cells_pixmap(self):
+        colors = self.get_cell_colors()
+        pixmap = QtGui.QPixmap(int(math.ceil(self.__grid_size_pix[0])) + 1,
+                               int(math.ceil(self.__grid_size_pix[1])) + 1)
+        pixmap.fill(QtCore.Qt.transparent)
+
+        #Cells are painted relative to the top left corner of the grid
+        offset_x = self.__center_coord.x() - self.__grid_size_pix[0] / 2.0
+        offset_y = self.__center_coord.y() - self.__grid_size_pix[1] / 2.0
+
+        painter = QtGui.QPainter(pixmap)
+        painter.setPen(self.custom_pen)
+        for cell_index in range(self.__num_lines * self.__num_images_per_line):
+            line, image = self.get_line_image_num(cell_index + self.__first_image_num)
+            pos_x, pos_y = self.get_coord_from_line_image(line, image)
+            pos_x -= offset_x
+            pos_y -= offset_y
+            #Estimate area where frame number or score will be displayed
+            paint_rect = QtCore.QRectF(\
+                pos_x - self.__cell_size_pix[0] / 2, 
+                pos_y - self.__cell_size_pix[1] / 2,
+                self.__cell_size_pix[0], 
+                self.__cell_size_pix[1])
+            painter.setBrush(QtGui.QColor(*colors[cell_index]))
+
+            if self.beam_is_rectangle:
+                painter.drawRect(QtCore.QRectF(pos_x - self.beam_size_pix[0] / 2,
+                                               pos_y - self.beam_size_pix[1] / 2,
+                                               self.beam_size_pix[0],
+                                               self.beam_size_pix[1]))
+            else:
+                painter.drawEllipse(QtCore.QRectF(pos_x - self.beam_size_pix[0] / 2,
+                                                  pos_y - self.beam_size_pix[1] / 2,
+                                                  self.beam_size_pix[0],
+                                                  self.beam_size_pix[1]))
+            painter.drawText(paint_rect, QtCore.Qt.AlignCenter, \
+                  str(cell_index + self.__first_image_num))
+        painter.end()
+        return pixmap
+
     def move_by_pix(self, move_direction):
         move_delta_x = 0
         move_delta_y = 0
@@ -833,6 +916,63 @@ class GraphicsItemGrid(GraphicsItem):
         line, image = self.get_line_image_num(image_serial)
         return self.get_col_row_from_line_image(line, image)
 
+    def get_col_row_index(self, first_image_num=None):
+        """
+        Descript. : returns two int arrays (cols, rows) giving for each
+                    image index (image serial - first_image_num) the col and
+                    row of the cell. Same result as calling
+                    get_col_row_from_image_serial for every image, but
+                    computed with numpy and only rebuilt when the grid
+                    geometry changes
+        """
+        if first_image_num is None:
+            first_image_num = self.__first_image_num
+        key = (self.__num_cols, self.__num_rows, self.__num_lines,
+               self.__num_images_per_line, self.__reversing_rotation,
+               self.__first_image_num, first_image_num,
+               tuple(self.grid_direction['fast']),
+               tuple(self.grid_direction['slow']))
+        if key != self.__col_row_index_key:
+            self.__col_row_index = self.build_col_row_index(first_image_num)
+            self.__col_row_index_key = key
+        return self.__col_row_index
+
+    def build_col_row_index(self, first_image_num):
+        num_images = self.__num_lines * self.__num_images_per_line
+        if num_images == 0:
+            return numpy.zeros(0, int), numpy.zeros(0, int)
+
+        #Same as get_line_image_num
+        serial = numpy.arange(num_images) + \
+                 (first_image_num - self.__first_image_num)
+        line = numpy.trunc(serial / float(self.__num_images_per_line)).\
+               astype(int)
+        image = serial - line * self.__num_images_per_line
+
+        #Same as get_coord_ref_from_line_image
+        if self.__num_images_per_line > 1:
+            ref_fast = 0.5 - image.astype(float) / \
+                       (self.__num_images_per_line - 1)
+        else:
+            ref_fast = numpy.ones(num_images) * 0.5
+        if self.__reversing_rotation:
+            ref_fast = numpy.where(line % 2, -ref_fast, ref_fast)
+        if self.__num_lines > 1:
+            ref_slow = 0.5 - line.astype(float) / (self.__num_lines - 1)
+        else:
+            ref_slow = numpy.ones(num_images) * 0.5
+
+        #Same as get_col_row_from_line_image
+        cols = self.__num_cols / 2.0 + (self.__num_images_per_line - 1) * \
+               self.grid_direction['fast'][0] * ref_fast + \
+               (self.__num_lines - 1) * \
+               self.grid_direction['slow'][0] * ref_slow
+        rows = self.__num_rows / 2.0 + (self.__num_images_per_line - 1) * \
+               self.grid_direction['fast'][1] * ref_fast + \
+               (self.__num_lines - 1) * \
+               self.grid_direction['slow'][1] * ref_slow
+        return numpy.trunc(cols).astype(int), numpy.trunc(rows).astype(int)
+
     def get_col_row_from_line_image(self, line, image):
         """
         Descript. :  converts frame grid coordinates from scan grid 
@@ -1375,3 +1515,29 @@ class GraphicsCameraFrame(QtGui.QGraphicsPixmapItem):
         self.scene().mouseReleasedSignal.emit(position.x(), position.y())
         self.update()
         self.setSelected(True)
+
+
+def make_test_grid(grid_direction, reversing_rotation, num_cols, num_rows,
+                   first_image_num=1):
+    """
+    Descript. : grid of num_cols x num_rows cells scanned along
+                grid_direction, as defined at the end of the grid drawing,
+                to check the image serial to col/row conversions.
+                grid_direction is set for all grids (set_grid_direction)
+    """
+    GraphicsItemGrid.set_grid_direction(grid_direction)
+    grid = GraphicsItemGrid(None, {"size_x": 0.01, "size_y": 0.01},
+                            [0, 0], [1, 1])
+    grid.index = 0
+    #Same as set_draw_end_position
+    grid._GraphicsItemGrid__num_cols = num_cols
+    grid._GraphicsItemGrid__num_rows = num_rows
+    grid._GraphicsItemGrid__num_lines = \
+         abs(grid_direction['fast'][1] * num_cols) + \
+         abs(grid_direction['slow'][1] * num_rows)
+    grid._GraphicsItemGrid__num_images_per_line = \
+         abs(grid_direction['fast'][0] * num_cols) + \
+         abs(grid_direction['slow'][0] * num_rows)
+    grid._GraphicsItemGrid__reversing_rotation = reversing_rotation
+    grid._GraphicsItemGrid__first_image_num = first_image_num
+    return grid
@@ -1211,19 +1211,15 @@ class Qt4_GraphicsManager(HardwareObject):
         """Updates grid corner positions
         """
        
-        grid_center_x, grid_center_y = grid_object.get_center_coord()
-        motor_pos = self.diffractometer_hwobj.get_centred_point_from_coord(\
-            grid_center_x, grid_center_y, return_by_names=True)
+        coord_list = [grid_object.get_center_coord()]
+        for corner_coord in grid_object.get_corner_coord():
+            coord_list.append((corner_coord.x(), corner_coord.y()))
+
+        motor_pos_list = self.diffractometer_hwobj.\
+             get_centred_points_from_coord(coord_list, return_by_names=True)
         grid_object.set_centred_position(queue_model_objects.\
-            CentredPosition(motor_pos))
-
-        motor_pos_corner = []
-        for index, corner_coord in enumerate(grid_object.get_corner_coord()):
-            motor_pos_corner.append(self.diffractometer_hwobj.\
-                 get_centred_point_from_coord(corner_coord.x(),
-                                              corner_coord.y(),
-                                              return_by_names=True))
-        grid_object.set_motor_pos_corner(motor_pos_corner)
+            CentredPosition(motor_pos_list[0]))
+        grid_object.set_motor_pos_corner(motor_pos_list[1:])
 
     def refresh_camera(self):
         """To be deleted
@@ -22,6 +22,7 @@ import time
 import logging
 import gevent
 import numpy as np
+import video_utils
 
 from PyQt4 import QtGui
 from PyQt4 import QtCore
@@ -205,6 +206,19 @@ class Qt4_LimaVideo(Device):
             else:
                 return qimage
 
+    def get_frame_array(self):
+        """
+        Descript. : returns the last frame as a greyscale numpy array (uint8)
+                    without converting it to a QImage
+        """
+        image = self.video.getLastImage()
+        if image.frameNumber() < 0:
+            return
+        frame = video_utils.rgb_to_grey(image.buffer(), image.width(), image.height())
+        if self.cam_mirror is not None:
+            frame = video_utils.mirror(frame, self.cam_mirror[0], self.cam_mirror[1])
+        return frame
+
     def get_contrast(self):
         return
 
@@ -6,13 +6,26 @@ XML configuration for more details.
 The Queue manager acts as both the controller of execution and as the root/
 container of the queue, note the inheritance from QueueEntryContainer. See the
 documentation for the queue_entry module for more information.
+
+With <sample_prefetch>True</sample_prefetch>, the load of the next enabled
+sample is prepared by the sample changer (prepare_load, if the sample
+changer implements it) while the collections of the current sample are
+executed, and the exchange waits for the preparation. The mount time
+(time of the sample changer load) and the time of the centring after the
+mount of every sample are kept, see get_sample_turnaround_statistics.
+
+The mount times and the durations of the tasks are used by get_estimate
+to calibrate the queue_estimator costs and estimate the time left.
 """
 import os
 import sys
+import time
 import logging
+import collections
 from logging.handlers import TimedRotatingFileHandler
 import gevent
 import queue_entry
+import queue_estimator
 
 from HardwareRepository.BaseHardwareObjects import HardwareObject
 from queue_entry import QueueEntryContainer
@@ -39,6 +52,13 @@ logger = logging.getLogger('queue_exec').\
          info("Module load, probably application start")
 
 
+SampleTurnaround = collections.namedtuple('SampleTurnaround',
+                                          ('location', 'mount_time', 'prefetched',
+                                           'centring_time'))
+
+TaskDuration = collections.namedtuple('TaskDuration', ('node', 'duration'))
+
+
 class QueueManager(HardwareObject, QueueEntryContainer):
     def __init__(self, name):
         HardwareObject.__init__(self, name)
@@ -51,11 +71,17 @@ class QueueManager(HardwareObject, QueueEntryContainer):
         self._running = False
         self._disable_collect = False
         self._is_stopped = False
+        self._prefetch_task = None
+        self._prefetch_entry = None
+        self._sample_turnarounds = []
+        self._task_durations = []
 
     def __getstate__(self):
         d = dict(self.__dict__)
         d['_root_task'] = None
         d['_paused_event'] = None  
+        d['_prefetch_task'] = None
+        d['_prefetch_entry'] = None
         return d      
 
     def __setstate__(self, d):
@@ -81,6 +107,8 @@ class QueueManager(HardwareObject, QueueEntryContainer):
         """
         if not self.is_disabled():
             self._is_stopped = False
+            self._sample_turnarounds = []
+            self._task_durations = []
             self._root_task = gevent.spawn(self.__execute_task)
 
     def is_executing(self, node_id=None):
@@ -130,6 +158,10 @@ class QueueManager(HardwareObject, QueueEntryContainer):
                 raise ex
         finally:
           self._running = False
+          self._prefetch_task = None
+          self._prefetch_entry = None
+          if self._sample_turnarounds:
+              self._log_sample_turnaround_statistics()
           self.emit('queue_execution_finished', (None,))
           self.emit('centringAllowed', (True, ))
 
@@ -154,9 +186,22 @@ class QueueManager(HardwareObject, QueueEntryContainer):
         try:
             # Procedure to be done before main implementation
             # of task.
+            is_sample_entry = isinstance(entry, queue_entry.SampleQueueEntry)
+            if is_sample_entry:
+                prefetched = self._wait_sample_prefetch(entry)
+            execute_start = time.time()
+
             entry.pre_execute()
             entry.execute()
 
+            if is_sample_entry:
+                # time of the sample changer load and of the centring
+                if entry.sample_load_time is not None:
+                    self._add_sample_turnaround(entry, entry.sample_load_time,
+                                                prefetched,
+                                                entry.sample_centring_time)
+                self._start_sample_prefetch(entry)
+
             for child in entry._queue_entry_list:
                 self.__execute_entry(child)
 
@@ -174,6 +219,9 @@ class QueueManager(HardwareObject, QueueEntryContainer):
             raise ex
         else:
             entry.post_execute()
+            if not (is_sample_entry or entry._queue_entry_list):
+                self._task_durations.append(TaskDuration(entry.get_data_model(),
+                                                         time.time() - execute_start))
 
         self._current_queue_entries.remove(entry)
         print('END OF ENTRY')
@@ -185,6 +233,8 @@ class QueueManager(HardwareObject, QueueEntryContainer):
         :returns: None
         :rtype: NoneType
         """
+        self._stop_sample_prefetch()
+
         if self._queue_entry_list:
             for qe in self._current_queue_entries:
                 try:
@@ -203,6 +253,200 @@ class QueueManager(HardwareObject, QueueEntryContainer):
         self.emit('centringAllowed', (True, )) 
         self._is_stopped = True
 
+    def _get_sample_changer(self):
+        """
+        :returns: The sample changer, None in plate mode
+        """
+        beamline_setup = self.getObjectByRole('beamline_setup')
+        try:
+            if beamline_setup.diffractometer_hwobj.in_plate_mode():
+                return None
+            return beamline_setup.sample_changer_hwobj
+        except AttributeError:
+            return None
+
+    def _get_sample_entries(self, container, sample_entries):
+        """
+        Appends the enabled SampleQueueEntry objects of <container> to
+        <sample_entries>, in execution order.
+        """
+        for entry in container._queue_entry_list:
+            if entry.is_enabled():
+                if isinstance(entry, queue_entry.SampleQueueEntry):
+                    sample_entries.append(entry)
+                self._get_sample_entries(entry, sample_entries)
+
+    def _get_next_sample_entry(self, current_entry):
+        """
+        :returns: The next enabled SampleQueueEntry mounting a sample with
+                  the sample changer after <current_entry>, or None
+        :rtype: SampleQueueEntry
+        """
+        sample_entries = []
+        self._get_sample_entries(self, sample_entries)
+        current_location = current_entry.get_data_model().location
+        found = False
+        for entry in sample_entries:
+            data_model = entry.get_data_model()
+            if found and data_model.get_children() and \
+               not data_model.free_pin_mode and \
+               data_model.location != current_location:
+                return entry
+            if entry is current_entry:
+                found = True
+
+    def _start_sample_prefetch(self, current_entry):
+        """
+        Starts the preparation of the load of the next sample, while the
+        collections of <current_entry> are executed.
+        """
+        if not self.getProperty('sample_prefetch') or self._is_stopped or \
+           not self._running:
+            return
+        sample_changer = self._get_sample_changer()
+        try:
+            if not sample_changer.can_prepare_load():
+                return
+        except AttributeError:
+            return
+        next_entry = self._get_next_sample_entry(current_entry)
+        if next_entry is None:
+            return
+
+        data_model = next_entry.get_data_model()
+        logging.getLogger('queue_exec').info('Preparing load of sample ' + \
+                                             data_model.loc_str)
+        try:
+            self._prefetch_task = sample_changer.prepare_load(
+                '%d:%02d' % data_model.location, wait=False)
+        except Exception:
+            logging.getLogger('queue_exec').exception('Could not prepare ' + \
+                 'load of sample ' + data_model.loc_str)
+        else:
+            self._prefetch_entry = next_entry
+
+    def _wait_sample_prefetch(self, entry):
+        """
+        Waits for the end of the preparation of a load, the sample changer
+        is then ready for the exchange.
+
+        :returns: True if the load of the sample of <entry> was prepared
+        :rtype: bool
+        """
+        prefetch_task = self._prefetch_task
+        prefetch_entry = self._prefetch_entry
+        self._prefetch_task = None
+        self._prefetch_entry = None
+        if prefetch_task is None:
+            return False
+        try:
+            prefetch_task.get()
+        except Exception:
+            logging.getLogger('queue_exec').exception('Preparation of the ' + \
+                 'load failed, loading the sample without it')
+            return False
+        return prefetch_entry is entry
+
+    def _stop_sample_prefetch(self):
+        """
+        Aborts the preparation of a load that is still running.
+        """
+        prefetch_task = self._prefetch_task
+        self._prefetch_task = None
+        self._prefetch_entry = None
+        if prefetch_task is not None and not prefetch_task.ready():
+            try:
+                self._get_sample_changer().abort()
+            except Exception:
+                logging.getLogger('queue_exec').exception('Could not abort ' + \
+                     'the preparation of the load')
+
+    def _add_sample_turnaround(self, entry, mount_time, prefetched,
+                               centring_time):
+        location = entry.get_data_model().loc_str
+        self._sample_turnarounds.append(SampleTurnaround(location, mount_time,
+                                                         prefetched,
+                                                         centring_time))
+        msg = 'Sample %s mounted in %.1f s%s' % (location, mount_time,
+              prefetched and ' (prepared)' or '')
+        if centring_time is not None:
+            msg += ', centred in %.1f s' % centring_time
+        logging.getLogger('queue_exec').info(msg)
+
+    def get_sample_turnarounds(self):
+        """
+        :returns: The SampleTurnaround (location, mount time in s, prepared
+                  during the previous sample, centring time in s or None)
+                  of the samples mounted by the last queue execution.
+        :rtype: list
+        """
+        return list(self._sample_turnarounds)
+
+    def get_sample_turnaround_statistics(self):
+        """
+        :returns: Number of samples and mean mount time (s) for the samples
+                  mounted with and without preparation, and the total
+                  mount time of the last queue execution.
+        :rtype: dict
+        """
+        statistics = {'total_mount_time': sum(turnaround.mount_time for \
+                      turnaround in self._sample_turnarounds)}
+        for key, prefetched in (('prefetched', True), ('not_prefetched', False)):
+            mount_times = [turnaround.mount_time for turnaround in \
+                           self._sample_turnarounds \
+                           if turnaround.prefetched == prefetched]
+            statistics[key] = {'samples': len(mount_times),
+                               'mean_mount_time': mount_times and \
+                               sum(mount_times) / len(mount_times) or None}
+        return statistics
+
+    def get_task_durations(self):
+        """
+        :returns: The TaskDuration (task node, duration in s) of the tasks
+                  without children executed by the last queue execution.
+        :rtype: list
+        """
+        return list(self._task_durations)
+
+    def get_estimate(self, model_root):
+        """
+        Estimates the time needed to execute the enabled tasks of
+        <model_root> that are not executed yet, with the costs of the
+        queue_estimator module (cost_<name> properties) calibrated on
+        the last queue execution.
+
+        :param model_root: The root of the queue model.
+        :type model_root: RootNode
+
+        :returns: The duration in s and the timeline (list of
+                  queue_estimator.TimelineItem).
+        :rtype: tuple
+        """
+        beamline_setup = self.getObjectByRole('beamline_setup')
+        costs = queue_estimator.get_costs(self,
+             getattr(beamline_setup, 'collect_hwobj', None))
+        costs = queue_estimator.calibrate_costs(costs, self._sample_turnarounds,
+                                                self._task_durations)
+        try:
+            mounted_location = self._get_sample_changer().getLoadedSample().getCoords()
+        except AttributeError:
+            mounted_location = None
+        estimator = queue_estimator.QueueEstimator(costs,
+             prefetch=bool(self.getProperty('sample_prefetch')),
+             mounted_location=mounted_location)
+        return estimator.estimate(model_root)
+
+    def _log_sample_turnaround_statistics(self):
+        statistics = self.get_sample_turnaround_statistics()
+        msg = '%d samples mounted in %.1f s' % (len(self._sample_turnarounds),
+                                                statistics['total_mount_time'])
+        for key, label in (('prefetched', 'prepared'),
+                           ('not_prefetched', 'not prepared')):
+            if statistics[key]['samples']:
+                msg += ', %d %s (mean %.1f s)' % (statistics[key]['samples'],
+                       label, statistics[key]['mean_mount_time'])
+        logging.getLogger('queue_exec').info(msg)
+
     def set_pause(self, state):
         """
         Sets the queue in paused state <state>. Emits the signal queue_paused
@@ -3,6 +3,7 @@ Handels interaction with the data model(s). Adding, removing and
 retreiving nodes are all done via this object. It is possbile to
 handle several models by using register_model and select_model.
 """
+import os
 import queue_entry
 import queue_model_objects_v1 as queue_model_objects
 
@@ -84,6 +85,7 @@ class QueueModel(HardwareObject):
         :rtype: NoneType
         """
         self._models[name] = queue_model_objects.RootNode()
+        self._models[name]._node_id = 0
         self.queue_hwobj.clear()
 
     def register_model(self, name, root_node):
@@ -131,6 +133,7 @@ class QueueModel(HardwareObject):
             child._node_id = self._selected_model._total_node_count
             parent._children.append(child)
             child._set_name(child._name)
+            self._register_node(child)
             self.emit('child_added', (parent, child))
         else:
             raise TypeError("Expected type TaskNode, got %s "\
@@ -170,6 +173,9 @@ class QueueModel(HardwareObject):
         """
         if parent is None:
             parent = self._selected_model 
+            node = parent._node_index.get(_id)
+            if node is not None:
+                return node
 
         for node in parent._children:
             if node._node_id == _id:
@@ -192,8 +198,40 @@ class QueueModel(HardwareObject):
         """
         if child in parent._children:
             parent._children.remove(child)
+            self._unregister_node(child)
             self.emit('child_removed', (parent, child))
 
+    def _register_node(self, node, root = None):
+        """
+        Adds <node> and its children to the node id and path template
+        indexes of the model <root> (the selected model by default).
+        """
+        if root is None:
+            root = self._selected_model
+
+        root._node_index[node._node_id] = node
+        if node.get_path_template():
+            root.add_path_template_node(node)
+
+        for child_node in node.get_children():
+            self._register_node(child_node, root)
+
+    def _unregister_node(self, node, root = None):
+        """
+        Removes <node> and its children from the indexes of the
+        model <root> (the selected model by default).
+        """
+        if root is None:
+            root = self._selected_model
+
+        if root._node_index.get(node._node_id) is node:
+            del root._node_index[node._node_id]
+
+        root.remove_path_template_node(node._node_id)
+
+        for child_node in node.get_children():
+            self._unregister_node(child_node, root)
+
     def _detach_child(self, parent, child):
         """
         Detaches the child <child>
@@ -223,6 +261,8 @@ class QueueModel(HardwareObject):
         else:
             child._parent = parent
 
+        self._register_node(child)
+
     def view_created(self, view_item, task_model):
         """
         Method that should be called by the routine that adds
@@ -257,9 +297,9 @@ class QueueModel(HardwareObject):
 
     def get_next_run_number(self, new_path_template, exclude_current = True):
         """
-        Iterates through all the path templates of the tasks
-        in the model and returns the next available run number
-        for the path template <new_path_template>.
+        Looks up the path templates of the tasks in the model with
+        the same directory and prefix and returns the next available
+        run number for the path template <new_path_template>.
 
         :param new_path_template: PathTempalte to match with.
         :type new_path_template: PathTemplate
@@ -270,17 +310,12 @@ class QueueModel(HardwareObject):
         :returns: The next available run number for the given path_template.
         :rtype: int
         """
-        all_path_templates = self.get_path_templates()
         conflicting_path_templates = [0]
 
-        for pt in all_path_templates:
-            if exclude_current:
-                if pt[1] is not new_path_template:
-                    if pt[1] == new_path_template:
-                        conflicting_path_templates.append(pt[1].run_number)
-            else:
-                if pt[1] == new_path_template:
-                    conflicting_path_templates.append(pt[1].run_number)
+        for pt in self._get_matching_path_templates(new_path_template):
+            if exclude_current and pt is new_path_template:
+                continue
+            conflicting_path_templates.append(pt.run_number)
 
         return max(conflicting_path_templates) + 1
 
@@ -288,26 +323,19 @@ class QueueModel(HardwareObject):
         """
         Retrievies a list of all the path templates in the model.
         """
-        return self._get_path_templates_rec(self.get_model_root())
+        return [(entry[0], entry[0].get_path_template()) for entry in \
+                self.get_model_root()._path_template_nodes.values()]
 
-    def _get_path_templates_rec(self, parent_node):
+    def _get_matching_path_templates(self, path_template):
         """
-        Recursive part of get_path_templates.
+        Returns the path templates in the model that have the same
+        directory and prefix as <path_template> (PathTemplate.__eq__).
         """
-        path_template_list = []
-
-        for child_node in parent_node.get_children():
-            path_template = child_node.get_path_template()
-
-            if path_template:
-                path_template_list.append((child_node, path_template))
-
-            child_path_template_list = self._get_path_templates_rec(child_node)
-
-            if child_path_template_list:
-                path_template_list.extend(child_path_template_list)
-
-        return path_template_list
+        key = (os.path.normpath(path_template.directory),
+               path_template.get_prefix())
+        nodes = self.get_model_root()._path_template_index.get(key, {})
+        return [pt for pt in [node.get_path_template() for node in \
+                nodes.values()] if pt == path_template]
 
     def check_for_path_collisions(self, new_path_template):
         """
@@ -316,15 +344,12 @@ class QueueModel(HardwareObject):
 
         :returns: True if there is a potential path collision.
         """
-        result = False
-        path_template_list = self.get_path_templates()
-        
-        for pt in path_template_list:
-            if pt[1] is not new_path_template:
-                if new_path_template.intersection(pt[1]):
-                    result = True
+        for pt in self._get_matching_path_templates(new_path_template):
+            if pt is not new_path_template and \
+               new_path_template.intersection(pt):
+                return True
 
-        return result
+        return False
 
     def copy_node(self, node):
         """
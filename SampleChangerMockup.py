@@ -1,3 +1,5 @@
+import gevent
+import gevent.event
 from sample_changer.GenericSampleChanger import *
 
 """
@@ -47,6 +49,12 @@ class SampleChangerMockup(SampleChanger):
         self._selected_sample = 1
         self._selected_basket = 1
         self._scIsCharging = None
+        # simulated time (s) of a load, the preparation of a load (pin
+        # pick) does prepare_time of it while the loaded sample is in use
+        self._load_time = float(self.getProperty("load_time") or 4.0)
+        self._prepare_time = float(self.getProperty("prepare_time") or 2.5)
+        self._prepared_sample = None
+        self._abort_event = gevent.event.Event()
 
         for i in range(5):
             basket = Basket(self,i+1)
@@ -56,14 +64,7 @@ class SampleChangerMockup(SampleChanger):
         SampleChanger.init(self)
 
     def load_sample(self, holder_length, sample_location, wait):
-        return
-
-    def load(self, sample, wait):
-        self._setState(SampleChangerState.Ready)  
-        return sample
-
-    def unload(self, sample_slot, wait):
-        return
+        self.load(Pin.getSampleAddress(*sample_location), wait)
 
     def getBasketList(self):
         basket_list = []
@@ -72,9 +73,6 @@ class SampleChangerMockup(SampleChanger):
                 basket_list.append(basket)
         return basket_list
 
-    def _doAbort(self):
-        return
-
     def _doChangeMode(self):
         return
 
@@ -90,14 +88,31 @@ class SampleChangerMockup(SampleChanger):
     def _doScan(self,component,recursive):
         return
 
+    def _doPrepareLoad(self, sample):
+        self._prepared_sample = None
+        self._abort_event.clear()
+        try:
+            if self._abort_event.wait(self._prepare_time):
+                raise Exception("Preparation of the load aborted")
+            self._prepared_sample = sample
+        finally:
+            self._setState(SampleChangerState.Ready)
+
     def _doLoad(self,sample=None):
-        return
+        load_time = self._load_time
+        if sample is not None and sample is self._prepared_sample:
+            load_time -= self._prepare_time
+        self._prepared_sample = None
+        gevent.sleep(max(load_time, 0))
+        self._setLoadedSample(sample)
+        self._setState(SampleChangerState.Ready)
 
     def _doUnload(self,sample_slot=None):
-        return
+        self._resetLoadedSample()
+        self._setState(SampleChangerState.Ready)
 
     def _doAbort(self):
-        return
+        self._abort_event.set()
 
     def _doReset(self):
         return
@@ -14,6 +14,7 @@ import PyTango
 from PyTango.gevent import DeviceProxy
 import numpy
 import struct
+import video_utils
 
 class TangoLimaVideo(BaseHardwareObjects.Device):
     def __init__(self, name):
@@ -23,7 +24,11 @@ class TangoLimaVideo(BaseHardwareObjects.Device):
         self.__gainExists = False
         self.__gammaExists = False
         self.__polling = None
+        self.__image_counter_exists = False
+        self.__image_counter_events = False
+        self.__event_frame_number = None
         self.scaling = pixmaptools.LUT.Scaling()
+        self.frame_poller = None
         
     def init(self):
         self.device = None
@@ -47,12 +52,22 @@ class TangoLimaVideo(BaseHardwareObjects.Device):
     def imageType(self):
         return BayerType("RG16")
 
-    def _get_last_image(self):
+    def _get_last_video_image(self):
+        """Returns frame number, width, height and raw buffer of the
+           last video image, None if there is no image
+        """
         img_data = self.device.video_last_image
         if img_data[0]=="VIDEO_IMAGE":
             header_fmt = ">IHHqiiHHHH"
             _, ver, img_mode, frame_number, width, height, _, _, _, _ = struct.unpack(header_fmt, img_data[1][:struct.calcsize(header_fmt)])
-            raw_buffer = numpy.fromstring(img_data[1][32:], numpy.uint16)
+            raw_buffer = numpy.frombuffer(img_data[1][32:], numpy.uint16)
+            return frame_number, width, height, raw_buffer
+
+    def _get_last_image(self, video_image=None):
+        if video_image is None:
+            video_image = self._get_last_video_image()
+        if video_image is not None:
+            frame_number, width, height, raw_buffer = video_image
             self.scaling.autoscale_min_max(raw_buffer, width, height, pixmaptools.LUT.Scaling.BAYER_RG16)
             validFlag, qimage = pixmaptools.LUT.raw_video_2_image(raw_buffer,
                                                                   width, height,
@@ -61,12 +76,68 @@ class TangoLimaVideo(BaseHardwareObjects.Device):
             if validFlag:
                 return qimage
 
+    def get_frame_array(self):
+        """Returns the last frame as a greyscale numpy array (uint8)"""
+        video_image = self._get_last_video_image()
+        if video_image is not None:
+            frame_number, width, height, raw_buffer = video_image
+            return video_utils.bayer_to_grey(raw_buffer, width, height)
+
+    def _image_counter_changed(self, event):
+        """Change event callback of video_last_image_counter"""
+        if not event.err:
+            self.__event_frame_number = event.attr_value.value
+
+    def _init_image_counter(self):
+        """Uses video_last_image_counter change events if the device pushes
+           them, polls the counter otherwise. If the device has no counter
+           the frame number is taken from the image header
+        """
+        try:
+            self.device.video_last_image_counter
+        except (PyTango.DevFailed, AttributeError):
+            logging.getLogger("HWR").debug("%s: no image counter, " + \
+                "frame number read from image header", self.name())
+            return
+        self.__image_counter_exists = True
+
+        try:
+            self.device.subscribe_event("video_last_image_counter",
+                                        PyTango.EventType.CHANGE_EVENT,
+                                        self._image_counter_changed)
+        except PyTango.DevFailed:
+            logging.getLogger("HWR").debug("%s: image counter change " + \
+                "events not available, polling the counter", self.name())
+        else:
+            self.__image_counter_events = True
+
     def _do_polling(self, sleep_time):
-        while True:
-            qimage = self._get_last_image()
-   	    self.emit("imageReceived", qimage, qimage.width(), qimage.height(), False)
+        self._init_image_counter()
+        self.frame_poller = video_utils.FramePoller(sleep_time)
 
-            time.sleep(sleep_time)
+        while True:
+            video_image = None
+            if self.__image_counter_events:
+                frame_number = self.__event_frame_number
+            elif self.__image_counter_exists:
+                frame_number = self.device.video_last_image_counter
+            else:
+                video_image = self._get_last_video_image()
+                frame_number = video_image[0] if video_image else None
+
+            if self.frame_poller.is_new_frame(frame_number):
+                qimage = self._get_last_image(video_image)
+                if qimage is not None:
+                    self.frame_poller.frame_converted()
+                    self.emit("imageReceived", qimage, qimage.width(), qimage.height(), False)
+
+            time.sleep(self.frame_poller.interval)
+
+    def get_frame_statistics(self):
+        """Counters of polled, converted and dropped (already seen) frames"""
+        if self.frame_poller is None:
+            return {}
+        return self.frame_poller.get_statistics()
 
     def connectNotify(self, signal):
         if signal=="imageReceived":
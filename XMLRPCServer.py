@@ -3,6 +3,13 @@ XMLRPC-Server that makes it possbile to access core features of MXCuBE like
 the queue from external applications. The Server is implemented as a
 hardware object and is configured with an XML-file. See the example
 configuration XML for more information.
+
+Requests are handled concurrently, each in its own greenlet; the methods
+that are not read only share one slot, so only one of them runs at a time
+(method_limits property).
+system.multicall batches several calls in one request. The transports
+property ("json", "msgpack") also accepts JSON or msgpack requests on the
+/json and /msgpack paths of the same port.
 """
 
 import logging
@@ -11,12 +18,21 @@ import inspect
 import pkgutil
 import types
 import gevent
+import gevent.lock
+import gevent.pool
 import socket
 import time
 import json
+import http.client
+import xmlrpc.client
 
 from HardwareRepository.BaseHardwareObjects import HardwareObject
-from xmlrpc.server import SimpleXMLRPCServer
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 __author__ = "Marcus Oskarsson, Matias Guijarro"
@@ -29,6 +45,149 @@ __email__ = "marcus.oscarsson@esrf.fr"
 __status__ = "Draft"
 
 
+# Methods only reading state, they run concurrently. All the other
+# methods (moving hardware, executing the queue, the functions of the
+# <apis> modules...) share the "hardware" slot and wait for each other, as
+# with the former serial server
+READ_ONLY_METHODS = ("is_queue_executing",
+                     "beamline_setup_read",
+                     "cryo_temperature",
+                     "flux",
+                     "log_message")
+READ_ONLY_PREFIXES = ("get_", "system.")
+
+# Max. number of simultaneous calls of the "hardware" group or of a
+# method. Overridden by the method_limits property, for example
+# "hardware:1 save_snapshot:2" or "shape_history_get_grid:0" (0 means no
+# limit, a method given its own limit leaves the hardware group)
+DEFAULT_METHOD_LIMITS = {"hardware": 1}
+
+# Transports served on the same port as XML-RPC, by url path:
+# path -> (content type, loads, dumps)
+RPC_TRANSPORTS = {"json": ("/json", "application/json",
+                           lambda data: json.loads(data.decode("utf-8")),
+                           lambda obj: json.dumps(obj, separators=(",", ":")).encode("utf-8"))}
+if msgpack is not None:
+    RPC_TRANSPORTS["msgpack"] = ("/msgpack", "application/msgpack",
+                                 lambda data: msgpack.unpackb(data, raw=False),
+                                 lambda obj: msgpack.packb(obj, use_bin_type=True))
+
+
+def get_method_limits(limits_property):
+    """Returns DEFAULT_METHOD_LIMITS updated with the "name:limit ..."
+       string limits_property, name is a method or the "hardware" group"""
+    method_limits = dict(DEFAULT_METHOD_LIMITS)
+    for method_limit in (limits_property or "").split():
+        method, _, limit = method_limit.partition(":")
+        method_limits[method] = int(limit)
+    return method_limits
+
+
+def is_read_only_method(method):
+    return method in READ_ONLY_METHODS or method.startswith(READ_ONLY_PREFIXES)
+
+
+class GeventXMLRPCRequestHandler(SimpleXMLRPCRequestHandler):
+    """
+    XML-RPC requests on the rpc paths, requests of the other transports of
+    the server (JSON-RPC like: {"method": ..., "params": [...],
+    "id": ...}, or a list of them for a batch) on their path
+    """
+
+    def do_POST(self):
+        codec = self.server.codecs.get(self.path)
+        if codec is None:
+            return SimpleXMLRPCRequestHandler.do_POST(self)
+        content_type, loads, dumps = codec
+        try:
+            data = self.rfile.read(int(self.headers["content-length"]))
+            response = dumps(self.server._dispatch_rpc_request(loads(data)))
+        except Exception:
+            self.send_response(400)
+            self.send_header("Content-length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+class GeventXMLRPCServer(SimpleXMLRPCServer):
+    """
+    SimpleXMLRPCServer handling each request in its own greenlet (with the
+    gevent monkey patched socket module, as in mxcube), so a slow call does
+    not block the other clients. Calls of the methods in method_limits wait
+    for a free slot of their method, calls of the other methods that are
+    not read only wait for a free slot of the "hardware" group.
+    """
+
+    # connections waiting to be accepted (5 in SimpleXMLRPCServer)
+    request_queue_size = 64
+
+    def __init__(self, address, method_limits=None, transports=(), **kwargs):
+        SimpleXMLRPCServer.__init__(self, address,
+                                    requestHandler=GeventXMLRPCRequestHandler,
+                                    **kwargs)
+        self.method_semaphores = {}
+        for name, limit in (method_limits or {}).items():
+            self.method_semaphores[name] = limit > 0 and \
+                gevent.lock.BoundedSemaphore(limit) or None
+        self.hardware_semaphore = self.method_semaphores.pop("hardware", None)
+        self.codecs = {}
+        for transport in transports:
+            path, content_type, loads, dumps = RPC_TRANSPORTS[transport]
+            self.codecs[path] = (content_type, loads, dumps)
+        self.request_tasks = gevent.pool.Group()
+
+    def process_request(self, request, client_address):
+        self.request_tasks.spawn(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def _dispatch(self, method, params):
+        if method in self.method_semaphores:
+            semaphore = self.method_semaphores[method]
+        elif is_read_only_method(method):
+            semaphore = None
+        else:
+            semaphore = self.hardware_semaphore
+        if semaphore is None:
+            return SimpleXMLRPCServer._dispatch(self, method, params)
+        with semaphore:
+            return SimpleXMLRPCServer._dispatch(self, method, params)
+
+    def _dispatch_rpc_request(self, request):
+        if isinstance(request, list):
+            return [self._dispatch_rpc_call(call) for call in request]
+        return self._dispatch_rpc_call(request)
+
+    def _dispatch_rpc_call(self, call):
+        if not isinstance(call, dict) or \
+           not isinstance(call.get("method"), str) or \
+           not isinstance(call.get("params") or [], list):
+            return {"id": isinstance(call, dict) and call.get("id") or None,
+                    "error": {"code": -32600, "message": "Invalid request"}}
+        try:
+            result = self._dispatch(call["method"], call.get("params") or [])
+        except Exception as ex:
+            return {"id": call.get("id"),
+                    "error": {"code": -32000,
+                              "message": "%s: %s" % (type(ex).__name__, ex)}}
+        return {"id": call.get("id"), "result": result}
+
+    def server_close(self):
+        self.request_tasks.kill()
+        SimpleXMLRPCServer.server_close(self)
+
+
 class XMLRPCServer(HardwareObject):
     def __init__(self, name):
         HardwareObject.__init__(self, name)
@@ -75,12 +234,21 @@ class XMLRPCServer(HardwareObject):
         if hasattr(self, "_server" ):
           return
         self.xmlrpc_prefixes = set()
-        self._server = SimpleXMLRPCServer((self.host, int(self.port)), logRequests = False, allow_none = True)
+        # <transports>json msgpack</transports> to accept other transports
+        transports = [transport for transport in \
+                      (self.getProperty("transports") or "").split() \
+                      if transport in RPC_TRANSPORTS]
+        self._server = GeventXMLRPCServer((self.host, int(self.port)),
+             method_limits = get_method_limits(self.getProperty("method_limits")),
+             transports = transports, logRequests = False, allow_none = True)
 
         msg = 'XML-RPC server listening on: %s:%s' % (self.host, self.port)
+        if transports:
+            msg += ' (also %s)' % ", ".join(transports)
         logging.getLogger("HWR").info(msg)
 
         self._server.register_introspection_functions()
+        self._server.register_multicall_functions()
         self._server.register_function(self.start_queue)
         self._server.register_function(self.log_message)
         self._server.register_function(self.is_queue_executing)
@@ -421,3 +589,58 @@ class XMLRPCServer(HardwareObject):
                 except StopIteration:
                     pass
 
+
+def get_percentile(sorted_values, percentile):
+    return sorted_values[int(round((len(sorted_values) - 1) * percentile / 100.))]
+
+
+def load_test(host, port, clients=50, calls=20, method="system.listMethods",
+              params=(), transport=None):
+    """
+    Descript. : calls method from clients concurrent greenlets, calls times
+                each (needs the gevent monkey patched socket module)
+    Args.     : transport (None for XML-RPC, or a key of RPC_TRANSPORTS)
+    Return.   : dict with the number of calls, calls per second and
+                latency percentiles (s)
+    """
+    latencies = []
+
+    def client():
+        if transport is None:
+            proxy = xmlrpc.client.ServerProxy("http://%s:%d" % (host, port),
+                                              allow_none=True)
+            call = lambda: getattr(proxy, method)(*params)
+        else:
+            path, content_type, loads, dumps = RPC_TRANSPORTS[transport]
+
+            def call():
+                connection = http.client.HTTPConnection(host, port)
+                try:
+                    connection.request("POST", path, dumps({"method": method,
+                         "params": list(params), "id": 1}),
+                         {"Content-type": content_type})
+                    response = loads(connection.getresponse().read())
+                finally:
+                    connection.close()
+                if "error" in response:
+                    raise RuntimeError(response["error"]["message"])
+
+        for i in range(calls):
+            start = time.time()
+            call()
+            latencies.append(time.time() - start)
+
+    start = time.time()
+    gevent.joinall([gevent.spawn(client) for i in range(clients)],
+                   raise_error=True)
+    elapsed = time.time() - start
+    latencies.sort()
+    result = {"calls": len(latencies),
+              "calls_per_second": len(latencies) / elapsed,
+              "p50": get_percentile(latencies, 50),
+              "p99": get_percentile(latencies, 99),
+              "max": latencies[-1]}
+    logging.getLogger("HWR").info("XML-RPC load test %s: %d calls, " % (method,
+         result["calls"]) + "%.0f calls/s, p50 %.4f s, p99 %.4f s" % \
+         (result["calls_per_second"], result["p50"], result["p99"]))
+    return result
@@ -6,6 +6,8 @@ import time
 import types
 import gevent.event
 import gevent
+from attenuation_search import find_transmission, linear_search, \
+     DEFAULT_TRANSMISSION_TABLE
 
 class XRFSpectrum(Equipment):
     def init(self):
@@ -359,45 +361,57 @@ class XRFSpectrum(Equipment):
             for i in table.split(","):
                 tf.append(float(i))
         except:
-            tf = [0.1, 0.2, 0.3, 0.9, 1.3, 1.9, 2.6, 4.3, 6, 8, 12, 24, 36, 50]
+            tf = DEFAULT_TRANSMISSION_TABLE
 
         min_cnt = self.getProperty("min_cnt")
         max_cnt = self.getProperty("max_cnt")
+        # attenuation_search: predictive (default) or linear
+        search_mode = self.getProperty("attenuation_search") or "predictive"
+        if search_mode == "linear":
+            probe_time = ct
+        else:
+            probe_time = min(self.getProperty("probe_time") or 1., ct)
         self.mca_hwobj.set_roi(2, 15, channel=1)
-        print(self.spectrumInfo["filename"])
-        self.mca_hwobj.set_presets(erange=1, ctime=ct, fname=self.spectrumInfo["filename"])
+        self.mca_hwobj.set_presets(erange=1, ctime=probe_time, fname=self.spectrumInfo["filename"])
+
+        def measure(transmission):
+            self.mca_hwobj.clear_spectrum()
+            logging.getLogger("user_level_log").info("Setting transmission to %g"% transmission)
+            self.transmission_hwobj.setTransmission(transmission)
+            self.mca_hwobj.start_acq()
+            time.sleep(probe_time)
+            return sum(self.mca_hwobj.read_roi_data())/probe_time
 
         # put in max attenuation
-        self.transmission_hwobj.setTransmission(0)
-        
         self.ctrl_hwobj.diffractometer.msopen()
-        self.mca_hwobj.start_acq()
-        time.sleep(ct)
-        ic = sum(self.mca_hwobj.read_roi_data())/ct
-        print(ic)
+        ic = measure(0)
         if ic > max_cnt:
             self.ctrl_hwobj.diffractometer.msclose()
             logging.getLogger("user_level_log").exception('The detector is saturated, giving up.')
             return False
 
-        for i in tf:
+        if search_mode == "linear":
+            transmission, probes = linear_search(measure, tf, min_cnt)
+        else:
+            transmission, probes = find_transmission(measure, tf, min_cnt, max_cnt, ic)
+        logging.getLogger("HWR").debug("XRFSpectrum: %s attenuation search, " % search_mode + \
+             "%d probes of %g s" % (len(probes), probe_time))
+
+        if transmission is None:
+            self.ctrl_hwobj.diffractometer.msclose()
+            self.spectrumInfo["beamTransmission"] =  self.transmission_hwobj.get_value()
+            logging.getLogger("user_level_log").exception('Could not find satisfactory attenuation (is the mca properly set up?), giving up.')
+            return False
+
+        if probes[-1][0] != transmission or probe_time != ct:
+            # spectrum with the full count time
+            self.mca_hwobj.set_presets(erange=1, ctime=ct, fname=self.spectrumInfo["filename"])
             self.mca_hwobj.clear_spectrum()
-            logging.getLogger("user_level_log").info("Setting transmission to %g"% i)
-            self.transmission_hwobj.setTransmission(i)
+            self.transmission_hwobj.setTransmission(transmission)
             self.mca_hwobj.start_acq()
             time.sleep(ct)
-            ic = sum(self.mca_hwobj.read_roi_data())/ct
-            print(ic)
-            if ic >  min_cnt:
-                self.ctrl_hwobj.diffractometer.msclose()
-                self.spectrumInfo["beamTransmission"] =  self.transmission_hwobj.get_value()
-                logging.getLogger("user_level_log").info("Transmission used for spectra: %g"% self.spectrumInfo["beamTransmission"])
-                break
 
-        self.spectrumInfo["beamTransmission"] =  self.transmission_hwobj.get_value()
         self.ctrl_hwobj.diffractometer.msclose()
-        if ic < min_cnt:
-            logging.getLogger("user_level_log").exception('Could not find satisfactory attenuation (is the mca properly set up?), giving up.')
-            return False
-
+        self.spectrumInfo["beamTransmission"] =  self.transmission_hwobj.get_value()
+        logging.getLogger("user_level_log").info("Transmission used for spectra: %g"% self.spectrumInfo["beamTransmission"])
         return True
@@ -0,0 +1,196 @@
+"""
+Search of the transmission used for XRF spectra.
+
+The spectrum is recorded at the lowest transmission of the table giving
+more than min_cnt counts/s in the mca roi. Below saturation the count
+rate is about linear in transmission (background + slope * transmission),
+so find_transmission predicts the needed transmission from the rates
+already measured and jumps close to it, instead of trying the table
+values one after the other. When no prediction can be made (no signal
+above background, saturated detector) or the prediction is wrong, it
+bisects the part of the table not excluded yet.
+
+SimulatedTransmission and SimulatedMCA have the interface used by
+XRFSpectrum, so the search can be tried and benchmarked offline
+(benchmark_search).
+"""
+
+import random
+import bisect
+import logging
+
+
+DEFAULT_TRANSMISSION_TABLE = [0.1, 0.2, 0.3, 0.9, 1.3, 1.9, 2.6, 4.3, 6,
+                              8, 12, 24, 36, 50]
+
+# Rate aimed at by the prediction, relative to min_cnt (counting noise)
+TARGET_MARGIN = 1.3
+
+
+def get_slope(probes, background, max_cnt):
+    """Least squares slope of rate - background vs transmission,
+       measurements above max_cnt (saturation) are not used"""
+    sum_xy = 0.
+    sum_xx = 0.
+    for transmission, rate in probes:
+        if transmission > 0 and rate <= max_cnt:
+            sum_xy += transmission * (rate - background)
+            sum_xx += transmission * transmission
+    if sum_xx > 0 and sum_xy > 0:
+        return sum_xy / sum_xx
+
+
+def find_transmission(measure, table, min_cnt, max_cnt, background=0.):
+    """
+    Descript. : finds the lowest transmission of table with a count rate
+                above min_cnt
+    Args.     : measure (function transmission -> count rate), table
+                (transmissions, %), background (rate at transmission 0)
+    Return.   : (transmission or None if none is high enough,
+                 list of (transmission, rate) measured)
+    """
+    table = sorted(table)
+    probes = []
+    rates = {}
+    # table[low] is known too low, table[high] high enough
+    low = -1
+    high = len(table)
+
+    while high - low > 1:
+        index = None
+        slope = get_slope(probes, background, max_cnt)
+        if slope is not None:
+            predicted = (min_cnt * TARGET_MARGIN - background) / slope
+            index = bisect.bisect_left(table, predicted)
+            index = min(max(index, low + 1), high - 1)
+            if index in rates:
+                index = None
+        if index is None:
+            index = (low + high) // 2
+
+        rate = measure(table[index])
+        rates[index] = rate
+        probes.append((table[index], rate))
+        if rate > min_cnt:
+            high = index
+            # stop when the next lower value is predicted too low
+            slope = get_slope(probes, background, max_cnt)
+            if rate <= max_cnt and slope is not None and index > low + 1 and \
+               background + slope * table[index - 1] < min_cnt:
+                break
+        else:
+            low = index
+
+    if high == len(table):
+        return None, probes
+    return table[high], probes
+
+
+def linear_search(measure, table, min_cnt):
+    """Former search: table values one after the other"""
+    probes = []
+    for transmission in sorted(table):
+        rate = measure(transmission)
+        probes.append((transmission, rate))
+        if rate > min_cnt:
+            return transmission, probes
+    return None, probes
+
+
+class SimulatedTransmission(object):
+    def __init__(self):
+        self.value = 100.
+
+    def setTransmission(self, value):
+        self.value = float(value)
+
+    def get_value(self):
+        return self.value
+
+    getValue = get_value
+
+
+class SimulatedMCA(object):
+    """
+    Mca of a sample with rate background + slope * transmission (counts/s
+    in the roi), with dead time (rate / (1 + rate * dead_time)) and
+    counting noise. Acquisitions return immediately, elapsed_time is
+    the mca time they would have taken.
+    """
+
+    def __init__(self, transmission_hwobj, slope, background=5.,
+                 dead_time=2e-6):
+        self.transmission_hwobj = transmission_hwobj
+        self.slope = slope
+        self.background = background
+        self.dead_time = dead_time
+        self.ctime = 1.
+        self.counts = 0
+        self.elapsed_time = 0.
+        self.acquisitions = 0
+
+    def set_roi(self, emin, emax, channel=1):
+        self.roi = {"chmin": emin, "chmax": emax}
+
+    def get_roi(self):
+        return self.roi
+
+    def set_presets(self, erange=1, ctime=None, fname=None):
+        if ctime is not None:
+            self.ctime = ctime
+
+    def clear_spectrum(self):
+        self.counts = 0
+
+    def get_rate(self, transmission):
+        rate = self.background + self.slope * transmission
+        return rate / (1 + rate * self.dead_time)
+
+    def start_acq(self):
+        mean = self.get_rate(self.transmission_hwobj.get_value()) * self.ctime
+        self.counts = max(0, int(random.gauss(mean, mean ** 0.5)))
+        self.elapsed_time += self.ctime
+        self.acquisitions += 1
+
+    def read_roi_data(self):
+        return [self.counts]
+
+
+def benchmark_search(slopes, ct=5, probe_time=1, min_cnt=2000,
+                     max_cnt=200000, table=DEFAULT_TRANSMISSION_TABLE):
+    """
+    Descript. : compares linear search with ct exposures (the last one
+                is the spectrum) and predictive search with probe_time
+                exposures followed by the spectrum on simulated samples
+    Return.   : list of (slope, transmission and mca time of the linear
+                search, transmission and mca time of the predictive search)
+    """
+    results = []
+    for slope in slopes:
+        result = [slope]
+        for search, exposure_time in ((linear_search, ct),
+                                      (find_transmission, probe_time)):
+            transmission_hwobj = SimulatedTransmission()
+            mca = SimulatedMCA(transmission_hwobj, slope)
+            mca.set_presets(ctime=exposure_time)
+
+            def measure(transmission):
+                transmission_hwobj.setTransmission(transmission)
+                mca.clear_spectrum()
+                mca.start_acq()
+                return sum(mca.read_roi_data()) / float(exposure_time)
+
+            if search is linear_search:
+                transmission, probes = search(measure, table, min_cnt)
+                # + background measurement
+                result.extend((transmission, mca.elapsed_time + ct))
+            else:
+                transmission, probes = search(measure, table, min_cnt,
+                     max_cnt, mca.get_rate(0))
+                # + background probe and spectrum acquisition
+                result.extend((transmission,
+                               mca.elapsed_time + probe_time + ct))
+        logging.getLogger("HWR").debug("Attenuation search, slope %g: " % slope + \
+             "linear %s in %g s, predictive %s in %g s" % tuple(result[1:]))
+        results.append(tuple(result))
+    return results
@@ -1,74 +1,280 @@
+"""
+Launching of the autoprocessing programs configured in the auto_processing
+element of the collect hardware object.
+
+Programs are started by a long-lived AutoProcessingDispatcher with a bounded
+number of workers, with argument lists instead of shell command lines.
+"image" events of the same program and collection are coalesced: while a
+notification waits to be started it is updated with the last frame, and a
+program gets at most one notification per image_cadence seconds and
+collection. submit never blocks, so a slow pipeline never holds the
+collection loop; when max_queue jobs are waiting new image notifications
+are dropped (the next one will carry the frame number anyway). Jobs of a
+key are started in submission order: an image notification still waiting
+for its cadence is released when another event of its key is submitted.
+
+Properties of the auto_processing element (all optional):
+    max_workers       programs running at the same time (4)
+    image_cadence     min. interval (s) between image notifications (1.0)
+    max_queue         max. number of waiting jobs (100)
+    detach_after      time (s) after which a running program releases its
+                      worker and keeps running in background (10)
+Properties of a program:
+    frame_option      option giving the last available frame to image
+                      notifications, for example -frame (not given if unset)
+"""
+
 import os
 import sys
+import time
 import logging
-import subprocess
+import collections
+
+import gevent
+import gevent.event
+from gevent import subprocess
+
+
+AutoProcessingJob = collections.namedtuple("AutoProcessingJob",
+     ("key", "event", "args"))
+
+
+def get_processing_options(paramsDict):
+    options = ['-residues', str(paramsDict.get('residues', 0)),
+               '-anomalous', str(paramsDict.get('anomalous', False))]
+    spacegroup = paramsDict.get('spacegroup')
+    if spacegroup:
+        options.extend(['-sg', str(spacegroup)])
+    unit_cell_constants = paramsDict.get('cell')
+    if unit_cell_constants:
+        options.extend(['-cell', str(unit_cell_constants)])
+    # + (param_dict["inverse_beam"] and ['-inverse'] or [])
+    return options
 
-def grouped_processing(processEvent, params):
-    endOfLineToExecute = ''
 
+def grouped_processing(processEvent, params):
+    """Returns the arguments of an end_multicollect command"""
+    arguments = []
     for param_dict in params:
         dataCollectionId = param_dict.get('collect_id')
-        residues = param_dict.get('residues', 0)
-        anomalous = param_dict.get('anomalous', False)
-        spacegroup = param_dict.get('spacegroup')
+        arguments.extend(['-mode', processEvent, '-collect',
+                          '%d:%s' % (dataCollectionId, param_dict["xds_dir"])])
+        arguments.extend(get_processing_options(param_dict))
+    return arguments
 
-        if spacegroup: 
-            sg_opt = ' -sg {0}'.format(spacegroup)
-        else:
-            sg_opt = ''
 
-        unit_cell_constants = param_dict.get('cell')
-        if unit_cell_constants:
-            cell_opt = ' -cell "{0}"'.format(unit_cell_constants)
+def get_command_arguments(program, processEvent, paramsDict):
+    """Returns the argument list of program for processEvent, None if the
+       program should not be started"""
+    executable = program.getProperty('executable')
+    if not os.path.isfile(executable):
+        logging.getLogger().error("No program to execute found (%s)", executable)
+        return None
+
+    if processEvent == "end_multicollect":
+        return [executable] + grouped_processing("end_multicollect", paramsDict)
+
+    if not os.path.isdir(paramsDict["xds_dir"]):
+        logging.getLogger().error("autoprocessing: %s is not a directory",
+                                  paramsDict["xds_dir"])
+        return None
+    arguments = [executable,
+                 '-path', paramsDict["xds_dir"],
+                 '-mode', processEvent,
+                 '-datacollectionID', str(paramsDict.get('datacollect_id'))] + \
+                get_processing_options(paramsDict)
+    frame_option = program.getProperty('frame_option')
+    if processEvent == "image" and frame_option and \
+       paramsDict.get("frame") is not None:
+        arguments.extend([frame_option, str(paramsDict["frame"])])
+    return arguments
+
+
+class AutoProcessingDispatcher(object):
+
+    def __init__(self, max_workers=4, image_cadence=1.0, max_queue=100,
+                 detach_after=10):
+        self.max_workers = max(int(max_workers), 1)
+        self.image_cadence = float(image_cadence)
+        self.max_queue = max(int(max_queue), 1)
+        self.detach_after = float(detach_after)
+
+        # waiting (key, event, job, submit time) in submission order,
+        # last job of the waiting image notifications by key
+        self.queue = collections.deque()
+        self.pending_images = {}
+        self.last_image_starts = {}
+        self.running = set()
+        self.detached = set()
+        self.wakeup = gevent.event.Event()
+
+        self.submitted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.started = 0
+        self.failed = 0
+        self.total_latency = 0.
+        self.max_latency = 0.
+        self.last_latency = None
+
+        self.dispatch_task = gevent.spawn(self.dispatch)
+
+    def submit(self, key, event, args):
+        """
+        Descript. : queues args (program argument list) for event, image
+                    events with the same key (program, collection) waiting
+                    to be started are replaced by the last one. Other
+                    events release the waiting image event of their key
+                    (of all collections of the program if collection is
+                    None), so it is started before them
+        Return.   : False if the job was dropped (queue full)
+        """
+        self.submitted += 1
+        job = AutoProcessingJob(key, event, args)
+        if event == "image":
+            if key in self.pending_images:
+                self.pending_images[key] = job
+                self.coalesced += 1
+                return True
+            if len(self.queue) >= self.max_queue:
+                self.dropped += 1
+                logging.getLogger("HWR").warning("autoprocessing: queue full, " + \
+                     "image notification for %s dropped" % str(key))
+                return False
+            self.pending_images[key] = job
         else:
-            cell_opt = ''
+            for image_key in self.pending_images:
+                if image_key == key or \
+                   (key[1] is None and image_key[0] == key[0]):
+                    self.last_image_starts.pop(image_key, None)
+        self.queue.append((key, event, job, time.time()))
+        self.wakeup.set()
+        return True
+
+    def get_next_job(self):
+        """Returns (job, submit time) of the first job that can be started,
+           or (None, time to wait)"""
+        now = time.time()
+        wait_time = None
+        for index, (key, event, job, submit_time) in enumerate(self.queue):
+            if event == "image":
+                start_time = self.last_image_starts.get(key, 0) + self.image_cadence
+                if start_time > now:
+                    if wait_time is None or start_time - now < wait_time:
+                        wait_time = start_time - now
+                    continue
+                job = self.pending_images.pop(key)
+                self.last_image_starts[key] = now
+            del self.queue[index]
+            return job, submit_time
+        return None, wait_time
+
+    def dispatch(self):
+        while True:
+            self.wakeup.clear()
+            wait_time = None
+            while len(self.running) < self.max_workers:
+                job, submit_time = self.get_next_job()
+                if job is None:
+                    wait_time = submit_time
+                    break
+                latency = time.time() - submit_time
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                self.last_latency = latency
+                self.started += 1
+                self.running.add(gevent.spawn(self.run_job, job))
+            self.wakeup.wait(wait_time)
+
+    def run_job(self, job):
+        logging.info("Process event %s, executing %s" % (job.event, " ".join(job.args)))
+        try:
+            try:
+                process = subprocess.Popen(job.args, stdin=None,
+                                           stdout=subprocess.DEVNULL,
+                                           stderr=None, close_fds=True)
+            except OSError:
+                self.failed += 1
+                logging.exception("autoprocessing: could not start %s" % job.args[0])
+                return
+            with gevent.Timeout(self.detach_after, False):
+                process.wait()
+            if process.poll() is None:
+                # long running program: release the worker
+                self.detached.add(process)
+                gevent.spawn(self.reap, process)
+        finally:
+            self.running.discard(gevent.getcurrent())
+            self.wakeup.set()
+
+    def reap(self, process):
+        try:
+            process.wait()
+        finally:
+            self.detached.discard(process)
+
+    def get_status(self):
+        """
+        Return.   : dict with queued, running, detached (programs running
+                    without worker), submitted, coalesced, dropped, started,
+                    failed jobs and latency (s from submission to start,
+                    mean, max and last one)
+        """
+        return {"queued": len(self.queue),
+                "running": len(self.running),
+                "detached": len(self.detached),
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+                "started": self.started,
+                "failed": self.failed,
+                "mean_latency": self.started and self.total_latency / self.started,
+                "max_latency": self.max_latency,
+                "last_latency": self.last_latency}
+
+    def stop(self):
+        self.dispatch_task.kill()
+        gevent.killall(list(self.running))
+
+
+_dispatcher = None
+
+
+def get_dispatcher(programs=None):
+    """Returns the dispatcher, created on first use with the properties
+       of programs (auto_processing element)"""
+    global _dispatcher
+    if _dispatcher is None:
+        options = {}
+        for name in ("max_workers", "image_cadence", "max_queue", "detach_after"):
+            try:
+                value = programs.getProperty(name)
+            except AttributeError:
+                value = None
+            if value is not None:
+                options[name] = value
+        _dispatcher = AutoProcessingDispatcher(**options)
+    return _dispatcher
+
+
+def get_status():
+    """Status of the dispatcher (see AutoProcessingDispatcher.get_status)"""
+    return get_dispatcher().get_status()
 
-        endOfLineToExecute += ' -mode %s -collect %d:%s' % (processEvent, dataCollectionId, param_dict["xds_dir"])
-        endOfLineToExecute += ' -residues ' + str(residues) + ' -anomalous ' + str(anomalous) + \
-                              sg_opt + cell_opt
-        # + (param_dict["inverse_beam"] and ' -inverse' or '')
-    return endOfLineToExecute
 
 def start(programs, processEvent, paramsDict):
+    dispatcher = get_dispatcher(programs)
     for program in programs["program"]:
         try:
             allowed_events = program.getProperty("event").split(" ")
             if processEvent in allowed_events:
-                executable = program.getProperty('executable')
-                
-                if os.path.isfile(executable):
+                arguments = get_command_arguments(program, processEvent, paramsDict)
+                if arguments is not None:
                     if processEvent == "end_multicollect":
-                        endOfLineToExecute = grouped_processing("end_multicollect", paramsDict)
-                    elif os.path.isdir(paramsDict["xds_dir"]):
-                        dataCollectionId = paramsDict.get('datacollect_id')
-                        residues = paramsDict.get('residues', 0)
-                        anomalous = paramsDict.get('anomalous', False)
-                        spacegroup = paramsDict.get('spacegroup')
-                        if spacegroup: 
-                            sg_opt = ' -sg {0}'.format(spacegroup)
-                        else:
-                            sg_opt = ''
-
-                        unit_cell_constants = paramsDict.get('cell')
-                        if unit_cell_constants:
-                            cell_opt = ' -cell "{0}"'.format(unit_cell_constants)
-                        else:
-                            cell_opt = ''
-
-                        endOfLineToExecute = ' -path ' + paramsDict["xds_dir"] +\
-                                             ' -mode ' + processEvent +\
-                                             ' -datacollectionID ' + str(dataCollectionId) +\
-                                             ' -residues ' + str(residues) +\
-                                             ' -anomalous ' + str(anomalous) +\
-                                             sg_opt + cell_opt #+\
-                                             #(paramsDict["inverse_beam"] and ' -inverse' or '')
-                    lineToExecute = executable + endOfLineToExecute + ' 2>&1 > /dev/null &'
-                    logging.info("Process event %s, executing %s" % (processEvent,str(lineToExecute)))
-
-                    subprocess.Popen(str(lineToExecute), shell=True, stdin=None,
-                                     stdout=None, stderr=None, close_fds=True)
-                else:
-                    logging.getLogger().error("No program to execute found (%s)",executable)
+                        key = (arguments[0], None)
+                    else:
+                        key = (arguments[0], paramsDict["xds_dir"])
+                    dispatcher.submit(key, processEvent, arguments)
         except:
             logging.exception("autoprocessing: an error occurred")
 
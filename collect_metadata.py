@@ -0,0 +1,155 @@
+"""
+Beamline metadata snapshots for the collect hardware objects.
+
+The values stored in LIMS and written in image headers are read through
+the get_xxx methods of the collect object. read_metadata calls them in
+parallel (one greenlet per value) and returns an immutable record, with
+the time spent compared to reading them one after the other.
+FrameMetadataCache keeps the per image values (intensity, machine
+current, ...) for a short time, so they are not read again for every
+frame of fast collections.
+"""
+
+import time
+import logging
+import collections
+
+import gevent
+
+
+# record field -> collect object method
+BEAMLINE_METADATA_GETTERS = collections.OrderedDict(
+    (("flux", "get_flux"),
+     ("wavelength", "get_wavelength"),
+     ("detector_distance", "get_detector_distance"),
+     ("resolution", "get_resolution"),
+     ("transmission", "get_transmission"),
+     ("beam_centre", "get_beam_centre"),
+     ("undulators_gaps", "get_undulators_gaps"),
+     ("resolution_at_corner", "get_resolution_at_corner"),
+     ("beam_size", "get_beam_size"),
+     ("beam_shape", "get_beam_shape"),
+     ("slit_gaps", "get_slit_gaps")))
+
+FRAME_METADATA_GETTERS = collections.OrderedDict(
+    (("measured_intensity", "get_measured_intensity"),
+     ("machine_current", "get_machine_current"),
+     ("machine_message", "get_machine_message"),
+     ("cryo_temperature", "get_cryo_temperature")))
+
+BeamlineMetadata = collections.namedtuple('BeamlineMetadata',
+                                          list(BEAMLINE_METADATA_GETTERS.keys()))
+
+FrameMetadata = collections.namedtuple('FrameMetadata',
+                                       list(FRAME_METADATA_GETTERS.keys()))
+
+# Values returned for pairs when the read fails
+PAIR_FIELDS = ("beam_centre", "beam_size", "slit_gaps")
+
+
+def read_metadata(collect_obj, getters, record_class):
+    """
+    Descript. : calls all getters of collect_obj in parallel
+    Return.   : (record, elapsed time, sum of the single read times)
+    """
+    read_times = {}
+
+    def read_value(field, method_name):
+        start = time.time()
+        try:
+            return getattr(collect_obj, method_name)()
+        except:
+            logging.getLogger("HWR").exception("Could not read %s" % field)
+            if field in PAIR_FIELDS:
+                return None, None
+            if field == "undulators_gaps":
+                return {}
+        finally:
+            read_times[field] = time.time() - start
+
+    start = time.time()
+    read_tasks = [gevent.spawn(read_value, field, method_name) \
+                  for field, method_name in getters.items()]
+    gevent.joinall(read_tasks)
+    record = record_class(*[read_task.value for read_task in read_tasks])
+    return record, time.time() - start, sum(read_times.values())
+
+
+def get_beamline_metadata(collect_obj):
+    """Returns BeamlineMetadata of collect_obj and logs the time it took"""
+    metadata, elapsed, sequential = read_metadata(collect_obj,
+         BEAMLINE_METADATA_GETTERS, BeamlineMetadata)
+    logging.getLogger("HWR").info("Beamline metadata read in %.3f s " % elapsed + \
+         "(%.3f s one by one, %.3f s saved)" % (sequential, sequential - elapsed))
+    return metadata
+
+
+class FrameMetadataCache(object):
+    """Per frame metadata, read again only if older than ttl seconds"""
+
+    def __init__(self, collect_obj, ttl=1.0):
+        self.collect_obj = collect_obj
+        self.ttl = ttl
+        self.metadata = None
+        self.read_time = 0
+        self.reads = 0
+        self.hits = 0
+        self.time_saved = 0
+        self.last_read_duration = 0
+
+    def get(self):
+        if self.metadata is not None and time.time() - self.read_time < self.ttl:
+            self.hits += 1
+            self.time_saved += self.last_read_duration
+            return self.metadata
+        self.metadata, elapsed, sequential = read_metadata(self.collect_obj,
+             FRAME_METADATA_GETTERS, FrameMetadata)
+        self.read_time = time.time()
+        self.last_read_duration = sequential
+        self.time_saved += sequential - elapsed
+        self.reads += 1
+        return self.metadata
+
+    def reset(self):
+        self.metadata = None
+        self.reads = 0
+        self.hits = 0
+        self.time_saved = 0
+
+    def log_statistics(self):
+        logging.getLogger("HWR").info("Frame metadata: %d reads, " % self.reads + \
+             "%d cached, %.3f s saved" % (self.hits, self.time_saved))
+
+
+def update_lims_parameters(parameters, metadata, undulators):
+    """
+    Descript. : fills data collection parameters for LIMS from metadata
+    Args.     : undulators (bl_config.undulators list)
+    """
+    parameters["flux"] = metadata.flux
+    parameters["wavelength"] = metadata.wavelength
+    parameters["detectorDistance"] = metadata.detector_distance
+    parameters["resolution"] = metadata.resolution
+    parameters["transmission"] = metadata.transmission
+    parameters["xBeam"], parameters["yBeam"] = metadata.beam_centre
+
+    und = metadata.undulators_gaps
+    i = 1
+    for jj in undulators or []:
+        key = jj.type
+        if key in und:
+            parameters["undulatorGap%d" % (i)] = und[key]
+            i += 1
+    parameters["resolutionAtCorner"] = metadata.resolution_at_corner
+    parameters["beamSizeAtSampleX"], parameters["beamSizeAtSampleY"] = \
+         metadata.beam_size
+    parameters["beamShape"] = metadata.beam_shape
+    parameters["slitGapHorizontal"], parameters["slitGapVertical"] = \
+         metadata.slit_gaps
+
+
+def get_lims_image_metadata(metadata):
+    return {'measuredIntensity': metadata.measured_intensity,
+            'synchrotronCurrent': metadata.machine_current,
+            'machineMessage': metadata.machine_message,
+            'temperature': metadata.cryo_temperature}
@@ -64,9 +64,8 @@ class Eiger:
   @task
   def prepare_acquisition(self, take_dark, start, osc_range, exptime, npass, number_of_images, comment, energy, still):
       diffractometer_positions = self.collect_obj.bl_control.diffractometer.getPositions()
-      self.start_angles = list()
-      for i in range(number_of_images):
-        self.start_angles.append("%0.4f deg." % (start+osc_range*i))
+      metadata = self.collect_obj.current_metadata or \
+                 self.collect_obj.get_beamline_metadata()
       self.header["file_comments"]=comment
       self.header["N_oscillations"]=number_of_images
       self.header["Oscillation_axis"]="omega"
@@ -82,13 +81,13 @@ class Eiger:
       self.header["Detector_2theta"]="0.0000 deg."
       self.header["Angle_increment"]="%0.4f deg." % osc_range
       #self.header["Start_angle"]="%0.4f deg." % start
-      self.header["Transmission"]=self.collect_obj.get_transmission()
-      self.header["Flux"]=self.collect_obj.get_flux()
-      self.header["Beam_xy"]="(%.2f, %.2f) pixels" % tuple([value/0.172 for value in self.collect_obj.get_beam_centre()])
+      self.header["Transmission"]=metadata.transmission
+      self.header["Flux"]=metadata.flux
+      self.header["Beam_xy"]="(%.2f, %.2f) pixels" % tuple([value/0.172 for value in metadata.beam_centre])
       self.header["Detector_Voffset"]="0.0000 m"
       self.header["Energy_range"]="(0, 0) eV"
-      self.header["Detector_distance"]="%f m" % (self.collect_obj.get_detector_distance()/1000.0)
-      self.header["Wavelength"]="%f A" % self.collect_obj.get_wavelength()
+      self.header["Detector_distance"]="%f m" % (metadata.detector_distance/1000.0)
+      self.header["Wavelength"]="%f A" % metadata.wavelength
       self.header["Trim_directory:"]="(nil)"
       self.header["Flat_field:"]="(nil)"
       self.header["Excluded_pixels:"]=" badpix_mask.tif"
@@ -128,23 +127,16 @@ class Eiger:
         egy = int(energy*1000.0)
         working_energy_chan.setValue(egy)
         
+  def get_saving_directory(self, directory):
+      if directory.startswith(os.path.sep):
+        directory = directory[len(os.path.sep):]
+      return os.path.join(self.config.getProperty("buffer"), directory)
+
   @task 
   def set_detector_filenames(self, frame_number, start, filename, jpeg_full_path, jpeg_thumbnail_full_path):
       prefix, suffix = os.path.splitext(os.path.basename(filename))
       prefix = "_".join(prefix.split("_")[:-1])+"_"
-      dirname = os.path.dirname(filename)
-      if dirname.startswith(os.path.sep):
-        dirname = dirname[len(os.path.sep):]
-     
-      saving_directory = os.path.join(self.config.getProperty("buffer"), dirname)
-      """
-      subprocess.Popen("ssh %s@%s mkdir --parents %s" % (os.environ["USER"],
-                                                         self.config.getProperty("control"),
-                                                         saving_directory),
-                                                         shell=True, stdin=None, 
-                                                         stdout=None, stderr=None, 
-                                                         close_fds=True).wait()
-      """
+      saving_directory = self.get_saving_directory(os.path.dirname(filename))
       self.wait_ready()  
    
       self.getChannelObject("saving_directory").setValue(saving_directory) 
@@ -155,19 +147,6 @@ class Eiger:
       self.getChannelObject("saving_format").setValue("HDF5")
       self.getChannelObject("saving_header_delimiter").setValue(["|", ";", ":"])
 
-      headers = list()
-      for i, start_angle in enumerate(self.start_angles):
-          header = "\n%s\n" % self.config.getProperty("serial")
-          header += "# %s\n" % time.strftime("%Y/%b/%d %T")
-          header += "# Pixel_size 172e-6 m x 172e-6 m\n"
-          header += "# Silicon sensor, thickness 0.000320 m\n"  
-          self.header["Start_angle"]=start_angle
-          for key, value in self.header.items():
-              header += "# %s %s\n" % (key, value)
-          headers.append("%d : array_data/header_contents|%s;" % (i, header))    
-      
-      #self.getCommandObject("set_image_header")(headers)
-
   @task 
   def start_acquisition(self):
       logging.getLogger("user_level_log").info("Preparing acquisition, please wait 2 minutes at least")
@@ -3,7 +3,10 @@ import time
 import subprocess
 import os
 import math
+import getpass
 from HardwareRepository.TaskUtils import task, cleanup, error_cleanup
+from detectors.cbf_header import CBFHeader, HEADER_CHUNK_SIZE
+from detectors.remote_directories import DirectoryMaker
 from PyTango import DeviceProxy
 
 class Pilatus:
@@ -12,6 +15,12 @@ class Pilatus:
       self.config = config
       self.collect_obj = collect_obj
       self.header = dict()
+      self.start_angle = 0
+      self.osc_range = 0
+      self.number_of_images = 0
+      self.header_upload_task = None
+      self.directory_maker = DirectoryMaker(["ssh", "%s@%s" % \
+           (getpass.getuser(), config.getProperty("control")), "sh"])
  
       lima_device = config.getProperty("lima_device")
       pilatus_device = config.getProperty("pilatus_device")
@@ -70,9 +79,11 @@ class Pilatus:
   @task
   def prepare_acquisition(self, take_dark, start, osc_range, exptime, npass, number_of_images, comment, energy, still):
       diffractometer_positions = self.collect_obj.bl_control.diffractometer.getPositions()
-      self.start_angles = list()
-      for i in range(number_of_images):
-        self.start_angles.append("%0.4f deg." % (start+osc_range*i))
+      metadata = self.collect_obj.current_metadata or \
+                 self.collect_obj.get_beamline_metadata()
+      self.start_angle = start
+      self.osc_range = osc_range
+      self.number_of_images = number_of_images
       self.header["file_comments"]=comment
       self.header["N_oscillations"]=number_of_images
       self.header["Oscillation_axis"]="omega"
@@ -90,13 +101,13 @@ class Pilatus:
       self.header["Detector_2theta"]="0.0000 deg."
       self.header["Angle_increment"]="%0.4f deg." % osc_range
       #self.header["Start_angle"]="%0.4f deg." % start
-      self.header["Transmission"]=self.collect_obj.get_transmission()
-      self.header["Flux"]=self.collect_obj.get_flux()
-      self.header["Beam_xy"]="(%.2f, %.2f) pixels" % tuple([value/0.172 for value in self.collect_obj.get_beam_centre()])
+      self.header["Transmission"]=metadata.transmission
+      self.header["Flux"]=metadata.flux
+      self.header["Beam_xy"]="(%.2f, %.2f) pixels" % tuple([value/0.172 for value in metadata.beam_centre])
       self.header["Detector_Voffset"]="0.0000 m"
       self.header["Energy_range"]="(0, 0) eV"
-      self.header["Detector_distance"]="%f m" % (self.collect_obj.get_detector_distance()/1000.0)
-      self.header["Wavelength"]="%f A" % self.collect_obj.get_wavelength()
+      self.header["Detector_distance"]="%f m" % (metadata.detector_distance/1000.0)
+      self.header["Wavelength"]="%f A" % metadata.wavelength
       self.header["Trim_directory:"]="(nil)"
       self.header["Flat_field:"]="(nil)"
       self.header["Excluded_pixels:"]=" badpix_mask.tif"
@@ -137,21 +148,22 @@ class Pilatus:
       
       self.getChannelObject("fill_mode").setValue("ON")
      
+  def get_saving_directory(self, directory):
+      if directory.startswith(os.path.sep):
+        directory = directory[len(os.path.sep):]
+      return os.path.join(self.config.getProperty("buffer"), directory)
+
+  def prepare_directories(self, directories):
+      """Creates saving directories of queued collections ahead of time"""
+      return self.directory_maker.make_directories_in_background(\
+           [self.get_saving_directory(directory) for directory in directories])
+
   @task 
   def set_detector_filenames(self, frame_number, start, filename, jpeg_full_path, jpeg_thumbnail_full_path):
       prefix, suffix = os.path.splitext(os.path.basename(filename))
       prefix = "_".join(prefix.split("_")[:-1])+"_"
-      dirname = os.path.dirname(filename)
-      if dirname.startswith(os.path.sep):
-        dirname = dirname[len(os.path.sep):]
-      
-      saving_directory = os.path.join(self.config.getProperty("buffer"), dirname)
-      subprocess.Popen("ssh %s@%s mkdir --parents %s" % (os.environ["USER"],
-                                                         self.config.getProperty("control"),
-                                                         saving_directory),
-                                                         shell=True, stdin=None, 
-                                                         stdout=None, stderr=None, 
-                                                         close_fds=True).wait()
+      saving_directory = self.get_saving_directory(os.path.dirname(filename))
+      self.directory_maker.make_directories([saving_directory])
       
       self.wait_ready()  
    
@@ -163,25 +175,25 @@ class Pilatus:
       self.getChannelObject("saving_format").setValue("CBF")
       self.getChannelObject("saving_header_delimiter").setValue(["|", ";", ":"])
 
-      headers = list()
-      for i, start_angle in enumerate(self.start_angles):
-          header = "\n%s\n" % self.config.getProperty("serial")
-          header += "# %s\n" % time.strftime("%Y/%b/%d %T")
-          header += "# Pixel_size 172e-6 m x 172e-6 m\n"
-          header += "# Silicon sensor, thickness 0.001 m\n"
-          self.header["Start_angle"]=start_angle
-          for key, value in self.header.items():
-              header += "# %s %s\n" % (key, value)
-          headers.append("%d : array_data/header_contents|%s;" % (i, header))    
-      
-      self.getCommandObject("set_image_header")(headers)
+      self.stop_header_upload()
+      cbf_header = CBFHeader(self.config.getProperty("serial"), "0.001",
+                             self.header, self.start_angle, self.osc_range)
+      self.header_upload_task = cbf_header.upload(\
+           self.getCommandObject("set_image_header"), self.number_of_images,
+           self.config.getProperty("header_chunk_size") or HEADER_CHUNK_SIZE)
        
   @task 
   def start_acquisition(self):
       self.getCommandObject("prepare_acq")()
       return self.getCommandObject("start_acq")()
 
+  def stop_header_upload(self):
+      if self.header_upload_task is not None:
+          self.header_upload_task.kill()
+          self.header_upload_task = None
+
   def stop(self):
+      self.stop_header_upload()
       try:
           self.getCommandObject("stop_acq")()
       except:
@@ -0,0 +1,89 @@
+"""
+Per frame cbf headers for Lima detectors (SetImageHeader).
+
+The header of a wedge is the same for every frame except the start angle
+and the timestamp. CBFHeader renders everything else once into a format
+template, so building the header of one frame is a single string format.
+Headers are sent to Lima in chunks: the first chunk before the
+acquisition is started, the others from a background task while the
+detector is already acquiring.
+"""
+
+import time
+import logging
+
+import gevent
+
+
+HEADER_CHUNK_SIZE = 1000
+
+
+class CBFHeader(object):
+
+    def __init__(self, serial, sensor_thickness, header_items,
+                 start_angle, osc_range):
+        """
+        Descript. : renders static part of the header
+        Args.     : serial (detector serial line), sensor_thickness (str, m),
+                    header_items (dict of "# key value" lines),
+                    start_angle and osc_range (deg.) of the wedge
+        """
+        self.start_angle = start_angle
+        self.osc_range = osc_range
+
+        static_part = "".join(["# %s %s\n" % (key, value) for key, value \
+                               in header_items.items() if key != "Start_angle"])
+        self.template = "%%d : array_data/header_contents|\n%s\n" % \
+                        self.escape(serial) + \
+                        "# %s\n" + \
+                        "# Pixel_size 172e-6 m x 172e-6 m\n" + \
+                        "# Silicon sensor, thickness %s m\n" % \
+                        self.escape(sensor_thickness) + \
+                        self.escape(static_part) + \
+                        "# Start_angle %0.4f deg.\n;"
+
+    @staticmethod
+    def escape(text):
+        return str(text).replace("%", "%%")
+
+    def get_frame_header(self, index, timestamp=None):
+        if timestamp is None:
+            timestamp = time.strftime("%Y/%b/%d %T")
+        return self.template % (index, timestamp,
+                                self.start_angle + self.osc_range * index)
+
+    def get_frame_headers(self, first_index, last_index, timestamp=None):
+        """Returns headers of frames first_index .. last_index - 1"""
+        if timestamp is None:
+            timestamp = time.strftime("%Y/%b/%d %T")
+        template = self.template
+        start_angle = self.start_angle
+        osc_range = self.osc_range
+        return [template % (index, timestamp, start_angle + osc_range * index) \
+                for index in range(first_index, last_index)]
+
+    def upload(self, set_image_header, number_of_images,
+               chunk_size=HEADER_CHUNK_SIZE):
+        """
+        Descript. : sends first chunk of headers and spawns a task sending
+                    the others
+        Args.     : set_image_header (SetImageHeader command object)
+        Return.   : greenlet of the remaining chunks (None if all sent)
+        """
+        chunk_size = max(int(chunk_size), 1)
+        first_chunk_end = min(chunk_size, number_of_images)
+        set_image_header(self.get_frame_headers(0, first_chunk_end))
+        if first_chunk_end < number_of_images:
+            return gevent.spawn(self.upload_chunks, set_image_header,
+                                first_chunk_end, number_of_images, chunk_size)
+
+    def upload_chunks(self, set_image_header, first_index, number_of_images,
+                      chunk_size):
+        try:
+            for chunk_start in range(first_index, number_of_images, chunk_size):
+                gevent.sleep(0)
+                set_image_header(self.get_frame_headers(chunk_start,
+                     min(chunk_start + chunk_size, number_of_images)))
+        except:
+            logging.getLogger("HWR").exception("Could not set image headers")
+            raise
@@ -0,0 +1,103 @@
+"""
+Creation of detector saving directories on the detector control computer.
+
+DirectoryMaker keeps one shell open on the control computer (ssh
+user@control sh) and sends mkdir commands through it, instead of one ssh
+connection per wedge. Directories already created are remembered, so
+wedges writing to the same directory do not wait for a round trip.
+The shell command is configurable, ["sh"] gives a local executor.
+"""
+
+import logging
+
+import gevent.lock
+from gevent import subprocess
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+
+class DirectoryMaker(object):
+
+    END_MARKER = "__directory_maker_done__"
+
+    def __init__(self, shell_command):
+        """
+        Args.     : shell_command (list), for example
+                    ["ssh", "user@control", "sh"]
+        """
+        self.shell_command = shell_command
+        self.shell = None
+        self.created_directories = set()
+        self.lock = gevent.lock.Semaphore()
+
+    def start_shell(self):
+        self.shell = subprocess.Popen(self.shell_command,
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      close_fds=True,
+                                      universal_newlines=True)
+        #Directories could have been removed while the shell was closed
+        self.created_directories.clear()
+
+    def close(self):
+        if self.shell is not None:
+            try:
+                self.shell.stdin.close()
+                self.shell.wait()
+            except:
+                pass
+        self.shell = None
+
+    def run_command(self, command):
+        """Runs command in the shell and returns its exit status"""
+        if self.shell is None or self.shell.poll() is not None:
+            self.start_shell()
+        self.shell.stdin.write("%s; echo %s $?\n" % (command, self.END_MARKER))
+        self.shell.stdin.flush()
+        while True:
+            line = self.shell.stdout.readline()
+            if not line:
+                raise IOError("Shell %s closed" % " ".join(self.shell_command))
+            if line.startswith(self.END_MARKER):
+                return int(line.split()[1])
+
+    def make_directories(self, directories):
+        """
+        Descript. : creates (mkdir --parents) directories not created yet
+        Return.   : True if all directories exist
+        """
+        with self.lock:
+            new_directories = []
+            for directory in directories:
+                if directory not in self.created_directories and \
+                   directory not in new_directories:
+                    new_directories.append(directory)
+            if not new_directories:
+                return True
+
+            command = "mkdir --parents %s" % \
+                      " ".join([quote(directory) for directory in new_directories])
+            for attempt in range(2):
+                try:
+                    status = self.run_command(command)
+                    break
+                except (IOError, OSError):
+                    #Shell died (ssh connection lost), retry with a new one
+                    self.close()
+                    if attempt:
+                        logging.getLogger("HWR").exception(\
+                            "DirectoryMaker: could not run %s" % command)
+                        return False
+
+            if status != 0:
+                logging.getLogger("HWR").error(\
+                    "DirectoryMaker: %s failed (exit status %d)" % (command, status))
+                return False
+            self.created_directories.update(new_directories)
+            return True
+
+    def make_directories_in_background(self, directories):
+        return gevent.spawn(self.make_directories, directories)
@@ -0,0 +1,165 @@
+"""
+Incremental reading of dozor result chunks (ResultControlDozor_Chunk_*.xml)
+written by the EDNA ControlDozor plugin.
+
+DozorChunkReader feeds the bytes appended to a chunk file since the last
+read to an incremental xml parser and returns the images completed so far,
+so a chunk can be consumed while it is still being written.
+DozorResultWatcher waits for changes in the result directory, with inotify
+if pyinotify is available and by polling the directory otherwise.
+"""
+
+import os
+import logging
+
+import gevent
+import gevent.select
+
+from xml.etree import ElementTree
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+DOZOR_CHUNK_TEMPLATE = "ResultControlDozor_Chunk_%06d.xml"
+
+# Order of the values in the records returned by DozorChunkReader
+DOZOR_IMAGE_FIELDS = ("number", "spots_num_of", "spots_int_aver",
+                      "spots_resolution", "score")
+
+
+class DozorChunkTarget(object):
+    """ElementTree parser target collecting one record per imageDozor"""
+
+    def __init__(self):
+        self.records = []
+        self.finished = False
+        self.depth = 0
+        self.current_image = None
+        self.current_field = None
+        self.text = []
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        if tag == "imageDozor":
+            self.current_image = {}
+        elif self.current_image is not None and tag in DOZOR_IMAGE_FIELDS:
+            self.current_field = tag
+        self.text = []
+
+    def data(self, data):
+        self.text.append(data)
+
+    def end(self, tag):
+        self.depth -= 1
+        if tag == "value" and self.current_field is not None:
+            self.current_image[self.current_field] = float("".join(self.text))
+        elif tag == self.current_field:
+            self.current_field = None
+        elif tag == "imageDozor":
+            if "number" in self.current_image:
+                self.records.append(tuple(self.current_image.get(field, 0) \
+                     for field in DOZOR_IMAGE_FIELDS))
+            self.current_image = None
+        if self.depth == 0:
+            self.finished = True
+
+    def close(self):
+        return None
+
+
+class DozorChunkReader(object):
+    """
+    Reads one chunk file incrementally. read() returns the records
+    (see DOZOR_IMAGE_FIELDS) of the images completed since the last call.
+    The file is reopened at every read, which also revalidates nfs caches
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = 0
+        self.target = DozorChunkTarget()
+        self.parser = ElementTree.XMLParser(target=self.target)
+
+    def is_finished(self):
+        return self.target.finished
+
+    def read(self):
+        if self.target.finished:
+            return []
+        try:
+            with open(self.filename, "rb") as chunk_file:
+                chunk_file.seek(self.offset)
+                data = chunk_file.read()
+        except (IOError, OSError):
+            return []
+        if data:
+            self.offset += len(data)
+            self.parser.feed(data)
+        records = self.target.records
+        self.target.records = []
+        return records
+
+
+class DozorResultWatcher(object):
+    """
+    Waits for changes in a result directory. inotify gives an immediate
+    wake up for local writes, directory polling is kept as a backstop
+    (inotify does not see writes done by other hosts on nfs)
+    """
+
+    def __init__(self, directory, poll_interval=0.2, notify_poll_interval=1.0):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.notify_poll_interval = notify_poll_interval
+        self.watch_manager = None
+        self.notifier = None
+
+        if pyinotify is not None:
+            try:
+                self.watch_manager = pyinotify.WatchManager()
+                self.watch_manager.add_watch(directory,
+                     pyinotify.IN_CREATE | pyinotify.IN_MODIFY | \
+                     pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO,
+                     quiet=False)
+                self.notifier = pyinotify.Notifier(self.watch_manager,
+                     default_proc_fun=lambda event: None, timeout=0)
+            except:
+                logging.getLogger("HWR").exception(\
+                    "DozorResultWatcher: inotify not available for %s" % directory)
+                self.close()
+
+    def wait(self, timeout=None):
+        """Returns after a change in the directory or after a poll interval"""
+        if self.notifier is not None:
+            if timeout is None:
+                timeout = self.notify_poll_interval
+            else:
+                timeout = min(timeout, self.notify_poll_interval)
+            fd = self.watch_manager.get_fd()
+            ready = gevent.select.select([fd], [], [], timeout)[0]
+            if ready:
+                self.notifier.read_events()
+                self.notifier.process_events()
+        else:
+            if timeout is None:
+                timeout = self.poll_interval
+            gevent.sleep(min(timeout, self.poll_interval))
+            try:
+                #Listing the directory refreshes the nfs attribute cache
+                os.listdir(self.directory)
+            except OSError:
+                pass
+
+    def close(self):
+        try:
+            if self.notifier is not None:
+                self.notifier.stop()
+            elif self.watch_manager is not None:
+                self.watch_manager.close()
+        except:
+            pass
+        self.notifier = None
+        self.watch_manager = None
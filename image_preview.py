@@ -0,0 +1,289 @@
+"""
+Jpeg previews (full size jpeg and thumbnail) of Pilatus CBF images.
+
+The byte offset compressed data are read from a memory mapped file and
+decoded with numpy: the deltas are int8 values, except for escaped int16
+and int32 values which are rare in diffraction images, so only these are
+handled one by one. Images are reduced by taking the maximum of blocks of
+pixels (spots stay visible), contrast stretched on a percentile of the
+counts and written with PIL.
+
+PreviewEngine converts images in a pool of processes (one per cpu by
+default) so previews do not use the time of the mxcube process; the
+calling greenlet waits for the result (cooperatively with the gevent
+monkey patched threading module, as in mxcube). benchmark_previews
+reports the number of images converted per second on synthetic CBFs
+(write_cbf).
+"""
+
+import os
+import io
+import mmap
+import time
+import logging
+import concurrent.futures
+
+import numpy
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+CBF_BINARY_START = b"\x0c\x1a\x04\xd5"
+
+JPEG_SIZE = 1024
+THUMBNAIL_SIZE = 256
+JPEG_QUALITY = 85
+
+# counts mapped to black, as percentile of the counts of the reduced image
+CONTRAST_PERCENTILE = 99.5
+
+PILATUS_6M_SHAPE = (2527, 2463)
+
+
+def parse_cbf_header(header):
+    """Returns the X-Binary-... values of a CBF binary section header"""
+    header = header.decode("ascii", "replace")
+    if "x-CBF_BYTE_OFFSET" not in header:
+        raise ValueError("CBF data are not byte offset compressed")
+    values = {}
+    for line in header.splitlines():
+        if line.startswith("X-Binary-"):
+            key, _, value = line.partition(":")
+            values[key.strip()] = value.strip()
+    return values
+
+
+def decode_byte_offset(data, number_of_elements):
+    """
+    Descript. : decodes byte offset compressed data
+    Args.     : data (numpy uint8 array), number_of_elements
+    Return.   : int32 array
+    """
+    values = data.view(numpy.int8).astype(numpy.int32)
+    keep = numpy.ones(len(data), bool)
+    position = 0
+    for index in numpy.flatnonzero(data == 0x80).tolist():
+        if index < position:
+            # byte of an escaped value
+            continue
+        value = int(data[index + 1:index + 3].view("<i2")[0])
+        length = 3
+        if value == -0x8000:
+            value = int(data[index + 3:index + 7].view("<i4")[0])
+            length = 7
+            if value == -0x80000000:
+                raise ValueError("64 bits byte offset values are not supported")
+        values[index] = value
+        keep[index + 1:index + length] = False
+        position = index + length
+    deltas = values[keep]
+    if len(deltas) < number_of_elements:
+        raise ValueError("CBF data are truncated")
+    return numpy.cumsum(deltas[:number_of_elements], dtype=numpy.int32)
+
+
+def read_cbf(filename):
+    """Returns the image (2d int32 array) of a byte offset CBF file"""
+    with open(filename, "rb") as cbf_file:
+        cbf_map = mmap.mmap(cbf_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = cbf_map.find(CBF_BINARY_START)
+            if start < 0:
+                raise ValueError("%s: no CBF binary section" % filename)
+            header = parse_cbf_header(cbf_map[max(0, start - 4096):start])
+            width = int(header["X-Binary-Size-Fastest-Dimension"])
+            height = int(header["X-Binary-Size-Second-Dimension"])
+            size = int(header["X-Binary-Size"])
+            # copy of the binary section: no buffer of the map is left
+            # (even in a traceback) when it is closed
+            data = numpy.frombuffer(cbf_map[start + 4:start + 4 + size],
+                                    numpy.uint8)
+            image = decode_byte_offset(data, width * height)
+        finally:
+            cbf_map.close()
+    return image.reshape(height, width)
+
+
+def encode_byte_offset(image):
+    """Returns the byte offset compressed data (bytes) of an int32 image"""
+    flat = image.ravel().astype(numpy.int64)
+    deltas = numpy.diff(flat, prepend=0)
+    small = numpy.abs(deltas) < 0x80
+    medium = ~small & (numpy.abs(deltas) < 0x8000)
+    large = ~small & ~medium
+    lengths = numpy.where(small, 1, numpy.where(medium, 3, 7))
+    offsets = numpy.cumsum(lengths) - lengths
+    data = numpy.empty(int(lengths.sum()), numpy.uint8)
+    data[offsets[small]] = deltas[small].astype(numpy.int8).view(numpy.uint8)
+    for mask, escape, dtype in ((medium, [0x80], "<i2"),
+                                (large, [0x80, 0x00, 0x80], "<i4")):
+        mask_offsets = offsets[mask]
+        for i, byte in enumerate(escape):
+            data[mask_offsets + i] = byte
+        value_bytes = deltas[mask].astype(dtype).view(numpy.uint8)
+        value_bytes = value_bytes.reshape(-1, numpy.dtype(dtype).itemsize)
+        for i in range(value_bytes.shape[1]):
+            data[mask_offsets + len(escape) + i] = value_bytes[:, i]
+    return data.tobytes()
+
+
+def write_cbf(filename, image):
+    """Writes image (2d int32 array) as a byte offset CBF file"""
+    data = encode_byte_offset(image)
+    height, width = image.shape
+    header = "\r\n".join(("###CBF: VERSION 1.5",
+        "", "data_%s" % os.path.basename(filename), "",
+        "_array_data.data", ";",
+        "--CIF-BINARY-FORMAT-SECTION--",
+        "Content-Type: application/octet-stream;",
+        '     conversions="x-CBF_BYTE_OFFSET"',
+        "Content-Transfer-Encoding: BINARY",
+        "X-Binary-Size: %d" % len(data),
+        "X-Binary-ID: 1",
+        'X-Binary-Element-Type: "signed 32-bit integer"',
+        "X-Binary-Element-Byte-Order: LITTLE_ENDIAN",
+        "X-Binary-Number-of-Elements: %d" % image.size,
+        "X-Binary-Size-Fastest-Dimension: %d" % width,
+        "X-Binary-Size-Second-Dimension: %d" % height,
+        "X-Binary-Size-Padding: 0", "", ""))
+    with open(filename, "wb") as cbf_file:
+        cbf_file.write(header.encode("ascii"))
+        cbf_file.write(CBF_BINARY_START)
+        cbf_file.write(data)
+        cbf_file.write(b"\r\n--CIF-BINARY-FORMAT-SECTION----\r\n;\r\n")
+
+
+def reduce_image(image, size):
+    """Maximum of blocks of pixels, the largest dimension is at most size"""
+    factor = max(1, -(-max(image.shape) // size))
+    height = image.shape[0] // factor
+    width = image.shape[1] // factor
+    image = image[:height * factor, :width * factor]
+    return image.reshape(height, factor, width, factor).max(axis=(1, 3))
+
+
+def stretch_contrast(image, percentile=CONTRAST_PERCENTILE):
+    """Returns uint8 grey levels of image, dark spots on white, masked
+       pixels (negative counts) are white"""
+    counts = numpy.clip(image, 0, None).astype(numpy.float32)
+    valid = counts[image > 0]
+    high = max(numpy.percentile(valid, percentile) if valid.size else 1, 1)
+    levels = numpy.minimum(counts * (255. / high), 255)
+    return (255 - levels).astype(numpy.uint8)
+
+
+def write_jpeg(levels, filename, quality=JPEG_QUALITY):
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    jpeg_buffer = io.BytesIO()
+    Image.fromarray(levels).save(jpeg_buffer, "JPEG", quality=quality)
+    with open(filename, "wb") as jpeg_file:
+        jpeg_file.write(jpeg_buffer.getvalue())
+
+
+def make_preview_files(filename, jpeg_path, thumbnail_path,
+                       jpeg_size=JPEG_SIZE, thumbnail_size=THUMBNAIL_SIZE):
+    """Writes the jpeg and thumbnail of a CBF file, returns the time it took"""
+    start = time.time()
+    preview = reduce_image(read_cbf(filename), jpeg_size)
+    write_jpeg(stretch_contrast(preview), jpeg_path)
+    if thumbnail_path:
+        write_jpeg(stretch_contrast(reduce_image(preview, thumbnail_size)),
+                   thumbnail_path)
+    return time.time() - start
+
+
+class PreviewEngine(object):
+
+    def __init__(self, workers=None, jpeg_size=JPEG_SIZE,
+                 thumbnail_size=THUMBNAIL_SIZE):
+        """
+        Args.     : workers (number of processes, number of cpus if None)
+        """
+        if Image is None:
+            raise RuntimeError("PIL is needed to write jpeg previews")
+        self.workers = max(int(workers or os.cpu_count() or 1), 1)
+        self.jpeg_size = jpeg_size
+        self.thumbnail_size = thumbnail_size
+        self.executor = None
+
+    def submit(self, filename, jpeg_path, thumbnail_path):
+        """Returns the concurrent.futures.Future of the conversion"""
+        if self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+        return self.executor.submit(make_preview_files, filename, jpeg_path,
+             thumbnail_path, self.jpeg_size, self.thumbnail_size)
+
+    def convert(self, filename, jpeg_path, thumbnail_path):
+        """Waits for the conversion, returns the time it took in the worker"""
+        return self.submit(filename, jpeg_path, thumbnail_path).result()
+
+    def convert_all(self, files):
+        """Converts all (filename, jpeg_path, thumbnail_path) of files"""
+        futures = [self.submit(*paths) for paths in files]
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+_engine = None
+
+
+def get_preview_engine(workers=None):
+    """Returns the preview engine, created on first use"""
+    global _engine
+    if _engine is None:
+        _engine = PreviewEngine(workers)
+    return _engine
+
+
+def make_synthetic_image(shape=PILATUS_6M_SHAPE, number_of_spots=500, seed=0):
+    """Pilatus like image: background, spots and module gaps (-1)"""
+    random_state = numpy.random.RandomState(seed)
+    image = random_state.poisson(3, shape).astype(numpy.int32)
+    rows = random_state.randint(2, shape[0] - 2, number_of_spots)
+    columns = random_state.randint(2, shape[1] - 2, number_of_spots)
+    intensities = random_state.exponential(2000, number_of_spots)
+    for row, column, intensity in zip(rows, columns, intensities):
+        image[row - 1:row + 2, column - 1:column + 2] += int(intensity)
+        image[row, column] += int(intensity * 4)
+    image[195::212, :] = -1
+    image[:, 487::494] = -1
+    return image
+
+
+def benchmark_previews(directory, number_of_images=20, workers=None):
+    """
+    Descript. : converts number_of_images synthetic CBFs written in
+                directory, with one process and with workers processes
+    Return.   : (images per second with one process, with workers)
+    """
+    files = []
+    for index in range(number_of_images):
+        filename = os.path.join(directory, "synthetic_%04d.cbf" % (index + 1))
+        if not os.path.exists(filename):
+            write_cbf(filename, make_synthetic_image(seed=index))
+        files.append((filename, filename[:-4] + ".jpeg",
+                      filename[:-4] + ".thumb.jpeg"))
+
+    results = []
+    for pool_size in (1, workers):
+        engine = PreviewEngine(pool_size)
+        try:
+            # worker processes are started by the first conversion
+            engine.convert(*files[0])
+            start = time.time()
+            engine.convert_all(files)
+            results.append(number_of_images / (time.time() - start))
+        finally:
+            engine.shutdown()
+        logging.getLogger("HWR").info("Jpeg previews: %d processes, " \
+             % engine.workers + "%.1f images/s" % results[-1])
+    return tuple(results)
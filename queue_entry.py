@@ -509,6 +509,8 @@ class SampleQueueEntry(BaseQueueEntry):
         self.diffractometer_hwobj = None
         self.plate_manipulator_hwobj = None
         self.sample_centring_result = None
+        self.sample_load_time = None
+        self.sample_centring_time = None
 
     def __getstate__(self):
         d = dict(self.__dict__)
@@ -522,6 +524,8 @@ class SampleQueueEntry(BaseQueueEntry):
         BaseQueueEntry.execute(self)
         log = logging.getLogger('queue_exec')
         sc_used = not self._data_model.free_pin_mode
+        self.sample_load_time = None
+        self.sample_centring_time = None
  
         # Only execute samples with collections and when sample changer is used
         if len(self.get_data_model().get_children()) != 0 and sc_used:
@@ -537,8 +541,10 @@ class SampleQueueEntry(BaseQueueEntry):
                 if not sample_mounted:
                     self.sample_centring_result = gevent.event.AsyncResult()
                     try:
-                        mount_sample(self.beamline_setup, self._view, self._data_model,
-                                     self.centring_done, self.sample_centring_result)
+                        self.sample_load_time, self.sample_centring_time = \
+                             mount_sample(self.beamline_setup,
+                             self._view, self._data_model, self.centring_done,
+                             self.sample_centring_result)
                     except Exception as e:
                         self._view.setText(1, "Error loading")
                         msg = "Error loading sample, please check" +\
@@ -1617,6 +1623,7 @@ def mount_sample(beamline_setup_hwobj,
     else:
         sample_mount_device = beamline_setup_hwobj.sample_changer_hwobj
 
+    load_start = time.time()
     if hasattr(sample_mount_device, '__TYPE__'):
         if sample_mount_device.__TYPE__ in ['Marvin','CATS']:
             element = '%d:%02d' % loc
@@ -1629,6 +1636,8 @@ def mount_sample(beamline_setup_hwobj,
                 # This is to preserve backward compatibility (load_sample was supposed to return None);
                 # if sample could not be loaded, but no exception is raised, let's skip the sample
                 raise QueueSkippEntryException("Sample changer could not load sample", "")
+    load_time = time.time() - load_start
+    centring_time = None
 
     if not sample_mount_device.hasLoadedSample():
         #Disables all related collections
@@ -1639,6 +1648,7 @@ def mount_sample(beamline_setup_hwobj,
         view.setText(1, "Sample loaded")
         dm = beamline_setup_hwobj.diffractometer_hwobj 
         if dm is not None:
+            centring_start = time.time()
             try:
                 dm.connect("centringAccepted", centring_done_cb)
                 centring_method = view.listView().parent().\
@@ -1671,6 +1681,11 @@ def mount_sample(beamline_setup_hwobj,
                 pass
             finally:
                 dm.disconnect("centringAccepted", centring_done_cb)
+            centring_time = time.time() - centring_start
+
+    # the load and the centring are timed separately, the centring may
+    # wait for the user
+    return load_time, centring_time
 
 def store_data_collection_in_lims(beamline_setup_hwobj, data_collection_parameters, bl_config):
     if beamline_setup_hwobj.lims_hwobj:
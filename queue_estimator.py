@@ -0,0 +1,345 @@
+"""
+Estimation of the execution time of a queue, without hardware.
+
+QueueEstimator walks the task tree of the queue model (samples, data
+collections, characterisations, energy scans, XRF spectra, interleaved
+task groups...) like the queue would execute it, applies the cost model
+of the beamline (QueueCosts: sample mount, centring, overhead of a
+collection, exposure time plus detector dead time per frame, motor
+moves) and returns the timeline of the tasks. Enabled tasks not executed
+yet are taken into account, so the estimation can be repeated during the
+execution to give the time left.
+
+The costs are the QUEUE_COST_FIELDS defaults, the cost_<field> properties
+of a hardware object and the dead time of the detector (get_costs).
+calibrate_costs fits them on the mount and centring times and the task
+durations recorded by the QueueManager (get_sample_turnarounds,
+get_task_durations).
+benchmark_estimate times the estimation of a generated queue.
+"""
+
+import time
+import logging
+import collections
+
+import queue_model_objects_v1 as queue_model_objects
+import queue_model_enumerables_v1 as queue_model_enumerables
+
+
+# cost -> default value (s, deg/s for omega_speed)
+QUEUE_COST_FIELDS = collections.OrderedDict(
+    (("sample_mount_time", 30.),        # sample changer load
+     ("prepared_mount_time", 10.),      # same, load prepared (sample_prefetch)
+     ("centring_time", 30.),            # after each mount and centring tasks
+     ("collection_overhead", 10.),      # detector, motors, LIMS
+     ("snapshots_time", 8.),
+     ("detector_deadtime", 0.0023),     # per frame, shutterless
+     ("frame_overhead", 0.5),           # per frame, with shutter
+     ("mesh_line_overhead", 1.),
+     ("omega_speed", 90.),
+     ("energy_change_time", 30.),
+     ("resolution_change_time", 10.),
+     ("characterisation_time", 60.),    # processing of the reference images
+     ("energy_scan_time", 180.),
+     ("xrf_overhead", 20.),             # attenuation search, processing
+     ("interleave_wedge_overhead", 3.),
+     ("workflow_time", 600.)))
+
+QueueCosts = collections.namedtuple('QueueCosts', list(QUEUE_COST_FIELDS.keys()))
+
+DEFAULT_QUEUE_COSTS = QueueCosts(*list(QUEUE_COST_FIELDS.values()))
+
+TimelineItem = collections.namedtuple('TimelineItem',
+                                      ('node', 'kind', 'start', 'duration'))
+
+
+def get_costs(properties_hwobj=None, collect_hwobj=None, costs=DEFAULT_QUEUE_COSTS):
+    """
+    Descript. : costs of a beamline
+    Args.     : properties_hwobj (hardware object with cost_<field>
+                properties), collect_hwobj (detector dead time)
+    Return.   : QueueCosts
+    """
+    updates = {}
+    if properties_hwobj is not None:
+        for field in QueueCosts._fields:
+            value = properties_hwobj.getProperty("cost_" + field)
+            if value is not None:
+                updates[field] = float(value)
+
+    detector = getattr(collect_hwobj, "_detector", None)
+    for detector in (detector, getattr(detector, "_detector", None)):
+        if hasattr(detector, "get_deadtime"):
+            try:
+                updates.setdefault("detector_deadtime", float(detector.get_deadtime()))
+            except:
+                logging.getLogger("HWR").exception("Could not read detector dead time")
+            break
+    return costs._replace(**updates)
+
+
+def get_median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.
+
+
+def get_frames(acquisition_parameters):
+    return acquisition_parameters.num_images * \
+           (2 if acquisition_parameters.inverse_beam else 1)
+
+
+def calibrate_costs(costs, sample_turnarounds=(), task_durations=()):
+    """
+    Descript. : fits costs on recorded durations
+    Args.     : sample_turnarounds ((location, mount time, prepared,
+                centring time)), task_durations ((task node, duration))
+    Return.   : QueueCosts
+    """
+    updates = {}
+    for field, prepared in (("prepared_mount_time", True),
+                            ("sample_mount_time", False)):
+        mount_times = [mount_time for location, mount_time, prefetched, \
+                       centring_time in sample_turnarounds \
+                       if bool(prefetched) == prepared]
+        if mount_times:
+            updates[field] = get_median(mount_times)
+
+    # time of the collections besides exposure: overhead + frames * per frame
+    collection_points = {True: [], False: []}
+    durations = collections.defaultdict(list)
+    durations["centring_time"] = [centring_time for location, mount_time, \
+         prefetched, centring_time in sample_turnarounds \
+         if centring_time is not None]
+    for node, duration in task_durations:
+        if isinstance(node, queue_model_objects.DataCollection):
+            if len(node.acquisitions) != 1 or node.experiment_type == \
+               queue_model_enumerables.EXPERIMENT_TYPE.MESH:
+                continue
+            parameters = node.acquisitions[0].acquisition_parameters
+            frames = get_frames(parameters)
+            if parameters.take_snapshots:
+                duration -= costs.snapshots_time
+            collection_points[bool(parameters.shutterless)].append(
+                (frames, duration - frames * parameters.exp_time))
+        elif isinstance(node, queue_model_objects.Characterisation):
+            # the reference images are collected by a separate entry
+            durations["characterisation_time"].append(duration)
+        elif isinstance(node, queue_model_objects.EnergyScan):
+            durations["energy_scan_time"].append(duration)
+        elif isinstance(node, queue_model_objects.XRFSpectrum):
+            durations["xrf_overhead"].append(duration - node.count_time)
+        elif isinstance(node, queue_model_objects.SampleCentring):
+            durations["centring_time"].append(duration)
+        elif isinstance(node, queue_model_objects.Workflow):
+            durations["workflow_time"].append(duration)
+    for field, values in durations.items():
+        if values:
+            updates[field] = max(get_median(values), 0)
+
+    overheads = []
+    for shutterless, points in collection_points.items():
+        if not points:
+            continue
+        per_frame_field = shutterless and "detector_deadtime" or "frame_overhead"
+        per_frame = updates.get(per_frame_field, getattr(costs, per_frame_field))
+        if len(set(frames for frames, extra_time in points)) > 1:
+            # least squares line extra time = overhead + frames * per frame
+            mean_frames = sum(frames for frames, extra_time in points) / float(len(points))
+            mean_time = sum(extra_time for frames, extra_time in points) / float(len(points))
+            covariance = sum((frames - mean_frames) * (extra_time - mean_time) \
+                             for frames, extra_time in points)
+            variance = sum((frames - mean_frames) ** 2 for frames, extra_time in points)
+            per_frame = max(covariance / variance, 0)
+            updates[per_frame_field] = per_frame
+        overheads.extend(extra_time - frames * per_frame for frames, extra_time in points)
+    if overheads:
+        updates["collection_overhead"] = max(get_median(overheads), 0)
+    return costs._replace(**updates)
+
+
+class QueueEstimator(object):
+
+    def __init__(self, costs=DEFAULT_QUEUE_COSTS, prefetch=False,
+                 skip_executed=True, mounted_location=None):
+        """
+        Args.     : prefetch (sample loads prepared, see QueueManager),
+                    skip_executed (estimation of the time left),
+                    mounted_location (location of the mounted sample)
+        """
+        self.costs = costs
+        self.prefetch = prefetch
+        self.skip_executed = skip_executed
+        self.mounted_location = mounted_location
+        self.node_estimators = ((queue_model_objects.Sample, self._estimate_sample),
+             (queue_model_objects.TaskGroup, self._estimate_task_group),
+             (queue_model_objects.DataCollection, self._estimate_collection),
+             (queue_model_objects.Characterisation, self._estimate_characterisation),
+             (queue_model_objects.EnergyScan, self._estimate_energy_scan),
+             (queue_model_objects.XRFSpectrum, self._estimate_xrf_spectrum),
+             (queue_model_objects.SampleCentring, self._estimate_centring),
+             (queue_model_objects.Workflow, self._estimate_workflow))
+        self._reset()
+
+    def _reset(self):
+        self.time = 0.
+        self.timeline = []
+        self.location = self.mounted_location
+        self.omega = None
+        self.energy = None
+        self.resolution = None
+
+    def estimate(self, root):
+        """
+        Descript. : estimates the execution of the enabled tasks of root
+        Return.   : (duration (s), list of TimelineItem)
+        """
+        self._reset()
+        self._estimate_children(root)
+        return self.time, self.timeline
+
+    def _add(self, node, kind, duration):
+        self.timeline.append(TimelineItem(node, kind, self.time, duration))
+        self.time += duration
+
+    def _get_children(self, node):
+        return [child for child in node.get_children() if child.is_enabled() \
+                and not (self.skip_executed and child.is_executed())]
+
+    def _estimate_children(self, node):
+        for child in self._get_children(node):
+            self._estimate_node(child)
+
+    def _estimate_node(self, node):
+        for node_class, estimate_method in self.node_estimators:
+            if isinstance(node, node_class):
+                return estimate_method(node)
+        self._estimate_children(node)
+
+    def _estimate_sample(self, sample):
+        if sample.get_children() and not sample.free_pin_mode and \
+           sample.location != self.location:
+            if self.prefetch and self.location is not None:
+                self._add(sample, "mount", self.costs.prepared_mount_time)
+            else:
+                self._add(sample, "mount", self.costs.sample_mount_time)
+            self._add(sample, "centring", self.costs.centring_time)
+            self.location = sample.location
+            self.omega = None
+        self._estimate_children(sample)
+
+    def _estimate_task_group(self, task_group):
+        children = self._get_children(task_group)
+        interleaved = []
+        if task_group.interleave_num_images:
+            interleaved = [child for child in children \
+                 if isinstance(child, queue_model_objects.DataCollection) and \
+                 child.acquisitions[0].acquisition_parameters.num_images > \
+                 task_group.interleave_num_images]
+        if len(interleaved) > 1:
+            duration = 0
+            for data_collection in interleaved:
+                num_images = data_collection.acquisitions[0].acquisition_parameters.num_images
+                wedges = -(-num_images // task_group.interleave_num_images)
+                duration += self._get_collection_time(data_collection) + \
+                            wedges * self.costs.interleave_wedge_overhead
+            self._add(task_group, "interleave", duration)
+            children = [child for child in children if child not in interleaved]
+        for child in children:
+            self._estimate_node(child)
+
+    def _get_move_time(self, parameters):
+        costs = self.costs
+        duration = 0
+        if self.omega is not None and costs.omega_speed > 0:
+            duration += abs(parameters.osc_start - self.omega) / costs.omega_speed
+        if self.energy is not None and parameters.energy != self.energy:
+            duration += costs.energy_change_time
+        if self.resolution is not None and parameters.resolution != self.resolution:
+            duration += costs.resolution_change_time
+        self.omega = parameters.osc_start + parameters.num_images * parameters.osc_range
+        self.energy = parameters.energy
+        self.resolution = parameters.resolution
+        return duration
+
+    def _get_collection_time(self, data_collection):
+        costs = self.costs
+        duration = 0
+        for acquisition in data_collection.acquisitions:
+            parameters = acquisition.acquisition_parameters
+            if parameters.shutterless:
+                frame_time = parameters.exp_time + costs.detector_deadtime
+            else:
+                frame_time = parameters.exp_time + costs.frame_overhead
+            duration += costs.collection_overhead + get_frames(parameters) * frame_time + \
+                        self._get_move_time(parameters)
+            if parameters.take_snapshots:
+                duration += costs.snapshots_time
+            if data_collection.experiment_type == queue_model_enumerables.EXPERIMENT_TYPE.MESH:
+                duration += parameters.num_lines * costs.mesh_line_overhead
+        return duration
+
+    def _estimate_collection(self, data_collection):
+        self._add(data_collection, "collection", self._get_collection_time(data_collection))
+
+    def _estimate_characterisation(self, characterisation):
+        self._add(characterisation, "characterisation",
+                  self._get_collection_time(characterisation.reference_image_collection) + \
+                  self.costs.characterisation_time)
+
+    def _estimate_energy_scan(self, energy_scan):
+        self._add(energy_scan, "energy_scan", self.costs.energy_scan_time)
+        self.energy = None
+
+    def _estimate_xrf_spectrum(self, xrf_spectrum):
+        self._add(xrf_spectrum, "xrf_spectrum",
+                  self.costs.xrf_overhead + xrf_spectrum.count_time)
+
+    def _estimate_centring(self, sample_centring):
+        self._add(sample_centring, "centring", self.costs.centring_time)
+        self.omega = None
+        self._estimate_children(sample_centring)
+
+    def _estimate_workflow(self, workflow):
+        self._add(workflow, "workflow", self.costs.workflow_time)
+
+
+def make_test_queue(number_of_samples=1000, collections_per_sample=2):
+    """Queue model of number_of_samples samples, each with a
+       characterisation and collections_per_sample data collections"""
+    root = queue_model_objects.RootNode()
+    for sample_index in range(number_of_samples):
+        sample = queue_model_objects.Sample()
+        sample.location = (sample_index // 10 + 1, sample_index % 10 + 1)
+        group = queue_model_objects.TaskGroup()
+        tasks = [queue_model_objects.Characterisation()]
+        for collection_index in range(collections_per_sample):
+            data_collection = queue_model_objects.DataCollection()
+            parameters = data_collection.acquisitions[0].acquisition_parameters
+            parameters.num_images = 1800
+            parameters.osc_range = 0.1
+            parameters.exp_time = 0.04
+            parameters.shutterless = True
+            parameters.resolution = 1.5 + collection_index
+            tasks.append(data_collection)
+        for parent, child in [(root, sample), (sample, group)] + \
+                             [(group, task) for task in tasks]:
+            child._parent = parent
+            parent._children.append(child)
+    return root
+
+
+def benchmark_estimate(number_of_samples=1000, costs=DEFAULT_QUEUE_COSTS):
+    """
+    Descript. : estimates a generated queue of number_of_samples samples
+    Return.   : (estimated duration (s), time taken by the estimation (s))
+    """
+    root = make_test_queue(number_of_samples)
+    start = time.time()
+    duration = QueueEstimator(costs).estimate(root)[0]
+    elapsed = time.time() - start
+    logging.getLogger("HWR").info("Queue estimate of %d samples: " % number_of_samples + \
+         "%.1f h, computed in %.3f s" % (duration / 3600., elapsed))
+    return duration, elapsed
@@ -176,6 +176,93 @@ class RootNode(TaskNode):
         TaskNode.__init__(self)
         self._name = 'root'
         self._total_node_count = 0
+        # Indexes of the model, nodes are added and removed by QueueModel:
+        # node id -> node, nodes with a path template and
+        # (normalized directory, prefix) -> {node id: node}
+        self._node_index = {}
+        self._path_template_nodes = {}
+        self._path_template_index = {}
+
+    def add_path_template_node(self, node):
+        """
+        Indexes <node> by the normalized directory and the prefix of its
+        path template, the node is moved to its new key when the
+        directory or the prefix of the path template is set or when the
+        path template is replaced.
+        """
+        self.remove_path_template_node(node._node_id)
+        path_template = node.get_path_template()
+        # [node, path template, (normalized directory, prefix)]
+        self._path_template_nodes[node._node_id] = [node, path_template, None]
+        path_template._indexed_by.append((self, node._node_id))
+        self.update_path_template_key(node._node_id)
+
+    def remove_path_template_node(self, node_id):
+        entry = self._path_template_nodes.pop(node_id, None)
+        if entry is None:
+            return
+
+        node, path_template, key = entry
+        if key is not None:
+            self._remove_from_path_template_index(key, node_id)
+        path_template._indexed_by[:] = [(root, _id) for root, _id in \
+             path_template._indexed_by if root is not self or _id != node_id]
+
+    def update_path_template_key(self, node_id):
+        entry = self._path_template_nodes.get(node_id)
+        if entry is None:
+            return
+
+        node, path_template, key = entry
+        if node.get_path_template() is not path_template:
+            # the path template of the node was replaced
+            if node.get_path_template():
+                self.add_path_template_node(node)
+            else:
+                self.remove_path_template_node(node_id)
+            return
+
+        new_key = (os.path.normpath(path_template.directory),
+                   path_template.get_prefix())
+        if new_key != key:
+            if key is not None:
+                self._remove_from_path_template_index(key, node_id)
+            entry[2] = new_key
+            self._path_template_index.setdefault(new_key, {})[node_id] = node
+
+    def _remove_from_path_template_index(self, key, node_id):
+        nodes = self._path_template_index.get(key, {})
+        nodes.pop(node_id, None)
+        if not nodes:
+            self._path_template_index.pop(key, None)
+
+
+class PathTemplateKeyAttribute(object):
+    """
+    Attribute changing the (directory, prefix) key of path templates: a
+    directory or prefix of a PathTemplate, or the path template of an
+    acquisition or task. Setting it updates the RootNode indexes of the
+    nodes of the path template.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        try:
+            return instance.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name)
+
+    def __set__(self, instance, value):
+        if isinstance(instance, PathTemplate):
+            path_template = instance
+        else:
+            path_template = instance.__dict__.get(self.name)
+        instance.__dict__[self.name] = value
+        for root, node_id in list(getattr(path_template, '_indexed_by', ())):
+            root.update_path_template_key(node_id)
 
 
 class TaskGroup(TaskNode):
@@ -789,6 +876,8 @@ class CharacterisationParameters(object):
 
 
 class EnergyScan(TaskNode):
+    path_template = PathTemplateKeyAttribute('path_template')
+
     def __init__(self, sample = None, path_template = None, cpos = None):
         TaskNode.__init__(self)
         self.element_symbol = None
@@ -890,6 +979,8 @@ class XRFSpectrum(TaskNode):
     """
     Descript. : Class represents XRF spectrum task
     """ 
+    path_template = PathTemplateKeyAttribute('path_template')
+
     def __init__(self, sample=None, path_template=None, cpos=None):
         TaskNode.__init__(self)
         self.count_time = 1
@@ -1030,6 +1121,8 @@ class SampleCentring(TaskNode):
         return self.kappa_phi
 
 class Acquisition(object):
+    path_template = PathTemplateKeyAttribute('path_template')
+
     def __init__(self):
         object.__init__(self)
 
@@ -1063,6 +1156,14 @@ class Acquisition(object):
 
 
 class PathTemplate(object):
+    # the RootNode indexes of the nodes of the path template are updated
+    # when the directory or a prefix is set
+    directory = PathTemplateKeyAttribute('directory')
+    base_prefix = PathTemplateKeyAttribute('base_prefix')
+    mad_prefix = PathTemplateKeyAttribute('mad_prefix')
+    reference_image_prefix = PathTemplateKeyAttribute('reference_image_prefix')
+    wedge_prefix = PathTemplateKeyAttribute('wedge_prefix')
+
     @staticmethod
     def set_data_base_path(base_directory):
         # os.path.abspath returns path without trailing slash, if any
@@ -1084,6 +1185,8 @@ class PathTemplate(object):
     def __init__(self):
         object.__init__(self)
 
+        # (RootNode, node id) of the nodes indexed by this path template
+        self._indexed_by = []
         self.directory = str()
         self.process_directory = str()
         # LNLS
@@ -1100,6 +1203,16 @@ class PathTemplate(object):
         self.start_num = int()
         self.num_files = int()
 
+    def __getstate__(self):
+        # copies are not in the indexes of the original
+        d = dict(self.__dict__)
+        d.pop('_indexed_by', None)
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self.__dict__['_indexed_by'] = []
+
     def as_dict(self):
         return {"directory" : self.directory,
                 "process_directory" : self.process_directory,
@@ -1387,6 +1500,8 @@ class CentredPosition(object):
         return self.kappa_phi
 
 class Workflow(TaskNode):
+    path_template = PathTemplateKeyAttribute('path_template')
+
     def __init__(self):
         TaskNode.__init__(self)
         self.path_template = PathTemplate()
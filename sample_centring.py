@@ -7,6 +7,7 @@ import logging
 import os
 import tempfile
 import collections
+import contextlib
 
 try:
   import lucid2 as lucid
@@ -27,6 +28,26 @@ USER_CLICKED_EVENT = None
 CURRENT_CENTRING = None
 SAVED_INITIAL_POSITIONS = {}
 READY_FOR_NEXT_POINT = gevent.event.Event()
+# step name -> [number of calls, total time in s], filled by auto_center
+AUTO_CENTRING_TIMING = collections.OrderedDict()
+
+@contextlib.contextmanager
+def timed_step(step):
+  t0 = time.time()
+  try:
+    yield
+  finally:
+    step_timing = AUTO_CENTRING_TIMING.setdefault(step, [0, 0.0])
+    step_timing[0] += 1
+    step_timing[1] += time.time() - t0
+
+def get_auto_centring_timing():
+  return dict([(step, tuple(timing)) for step, timing in AUTO_CENTRING_TIMING.items()])
+
+def log_auto_centring_timing():
+  total = sum([timing[1] for timing in AUTO_CENTRING_TIMING.values()])
+  logging.getLogger("HWR").info("Auto centring timing (total %.2f s): %s", total,
+     ", ".join(["%s %d x %.3f s" % (step, n, t) for step, (n, t) in AUTO_CENTRING_TIMING.items()]))
 
 class CentringMotor:
   def __init__(self, motor, reference_position=None, direction=1):
@@ -316,11 +337,26 @@ def start_auto(camera,  centring_motors_dict,
                                     msg_cb, new_point_cb)
     return CURRENT_CENTRING
 
-def find_loop(camera, pixelsPerMm_Hor, chi_angle, msg_cb, new_point_cb):
-  snapshot_filename = os.path.join(tempfile.gettempdir(), "mxcube_sample_snapshot.png")
+def get_frame(camera):
+  """Returns the last camera frame, as a greyscale numpy array if the
+     camera provides it, as an image filename otherwise"""
+  if hasattr(camera, "get_frame_array"):
+    frame = camera.get_frame_array()
+    if frame is not None:
+      return frame
+  # one file per process, so that two applications do not overwrite
+  # each other snapshots
+  snapshot_filename = os.path.join(tempfile.gettempdir(),
+                                   "mxcube_sample_snapshot_%d.png" % os.getpid())
   camera.takeSnapshot(snapshot_filename, bw=True)
-  
-  info, x, y = lucid.find_loop(snapshot_filename,IterationClosing=6)
+  return snapshot_filename
+
+def find_loop(camera, pixelsPerMm_Hor, chi_angle, msg_cb, new_point_cb):
+  with timed_step("image acquisition"):
+    frame = get_frame(camera)
+
+  with timed_step("loop finding"):
+    info, x, y = lucid.find_loop(frame,IterationClosing=6)
   
   try:
     x = float(x)
@@ -343,13 +379,31 @@ def auto_center(camera,
                 chi_angle, 
                 n_points,
                 msg_cb, new_point_cb):
+    AUTO_CENTRING_TIMING.clear()
+    try:
+      return _auto_center(camera, phi, phiy, phiz, sampx, sampy,
+                          pixelsPerMm_Hor, pixelsPerMm_Ver,
+                          beam_xc, beam_yc, chi_angle, n_points,
+                          msg_cb, new_point_cb)
+    finally:
+      log_auto_centring_timing()
+
+def _auto_center(camera, 
+                 phi, phiy, phiz,
+                 sampx, sampy, 
+                 pixelsPerMm_Hor, pixelsPerMm_Ver, 
+                 beam_xc, beam_yc, 
+                 chi_angle, 
+                 n_points,
+                 msg_cb, new_point_cb):
     imgWidth = camera.getWidth()
     imgHeight = camera.getHeight()
  
     #check if loop is there at the beginning
     i = 0
     while -1 in find_loop(camera, pixelsPerMm_Hor, chi_angle, msg_cb, new_point_cb):
-        phi.syncMoveRelative(90)
+        with timed_step("phi move"):
+          phi.syncMoveRelative(90)
         i+=1
         if i>4:
             if isinstance(msg_cb, collections.Callable):
@@ -375,7 +429,8 @@ def auto_center(camera,
             if x < 0 or y < 0:
               for i in range(1,18):
                 #logging.info("loop not found - moving back %d" % i)
-                phi.syncMoveRelative(5)
+                with timed_step("phi move"):
+                  phi.syncMoveRelative(5)
                 x, y = find_loop(camera, pixelsPerMm_Hor, chi_angle, msg_cb, new_point_cb)
                 if -1 in (x, y):
                     continue
@@ -384,23 +439,28 @@ def auto_center(camera,
                     y = 0
                     if isinstance(new_point_cb, collections.Callable):
                         new_point_cb((x,y))
-                    user_click(x,y,wait=True)
+                    with timed_step("phi move"):
+                      user_click(x,y,wait=True)
                     break
                   else:
                     y = imgHeight
                     if isinstance(new_point_cb, collections.Callable):
                         new_point_cb((x,y))
-                    user_click(x,y,wait=True)
+                    with timed_step("phi move"):
+                      user_click(x,y,wait=True)
                     break
               if -1 in (x,y):
                 centring_greenlet.kill()
                 raise RuntimeError("Could not centre sample automatically.")
-              phi.syncMoveRelative(-i*5)
+              with timed_step("phi move"):
+                phi.syncMoveRelative(-i*5)
             else:
-              user_click(x,y,wait=True)
+              with timed_step("phi move"):
+                user_click(x,y,wait=True)
 
-      centred_pos = centring_greenlet.get()
-      end(centred_pos)
+      with timed_step("centring calculation"):
+        centred_pos = centring_greenlet.get()
+      with timed_step("move to centred position"):
+        end(centred_pos)
                  
     return centred_pos
-    
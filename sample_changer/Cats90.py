@@ -11,6 +11,7 @@ Derived from Michael Hellmig's implementation for the BESSY CATS sample changer
 """
 from GenericSampleChanger import *
 import time
+import gevent.event
 import qt
 
 __author__ = "Jie Nan"
@@ -64,6 +65,12 @@ class Cats90(SampleChanger):
     __TYPE__ = "CATS"    
     NO_OF_LIDS = 3
     NO_OF_BASKETS = 9
+    # full update period (in periods of 100 ms) when the contents are updated from events
+    EVENTS_UPDATE_INTERVAL = 50
+    # max. time (s) between the transfer command and the rise of PathRunning
+    PATH_START_TIMEOUT = 5.0
+    # period (s) of the PathRunning reads done in case a change event is missed
+    PATH_BACKSTOP_PERIOD = 1.0
 
     def __init__(self, *args, **kwargs):
         super(Cats90, self).__init__(self.__TYPE__,False, *args, **kwargs)
@@ -73,6 +80,16 @@ class Cats90(SampleChanger):
         self._selected_basket = None
         self._scIsCharging = None
         self._startLoad =False # add flag to disable Load or UnLoad/Exchange Button immediately after 1 click (Avoid Click multiple times)
+        self._pathRunning = False
+        self._pathStarted = gevent.event.Event()
+        self._pathFinished = gevent.event.Event()
+        self._pathFinished.set()
+
+        # use_events: contents and state are updated from the channel update signals
+        # (Tango change events), the periodic full update is only a backstop.
+        # Only for channels polled or with change events configured
+        self._useEvents = self.getProperty("use_events") or False
+        self._eventsUpdateCounter = 0
 
         # add support for CATS dewars with variable number of lids
         # assumption: each lid provides access to three baskets
@@ -122,6 +139,9 @@ class Cats90(SampleChanger):
 
         self._initSCContents()
 
+        if self._useEvents:
+            self._connectChannelEvents()
+
         # SampleChanger.init must be called _after_ initialization of the Cats because it starts the update methods which access
         # the device server's status attributes
         SampleChanger.init(self)   
@@ -376,6 +396,78 @@ class Cats90(SampleChanger):
     def _updateOperationMode(self, value):
         self._scIsCharging = not value
 
+    def _connectChannelEvents(self):
+        """
+        Connects the update signals of the state, path running, loaded sample
+        and basket presence channels, so only what changed is updated.
+
+        :returns: None
+        :rtype: None
+        """
+        self._chnState.connectSignal("update", self._onStateChanged)
+        self._chnPathRunning.connectSignal("update", self._onPathRunningChanged)
+        self._chnSampleIsDetected.connectSignal("update", self._onStateChanged)
+        self._chnNumLoadedSample.connectSignal("update", self._onLoadedSampleChanged)
+        self._chnLidLoadedSample.connectSignal("update", self._onLoadedSampleChanged)
+        for basket_index in range(Cats90.NO_OF_BASKETS):
+            channel = getattr(self, "_chnBasket%dState" % (basket_index + 1))
+            channel.connectSignal("update", self._getBasketStateHandler(basket_index))
+
+    def _getBasketStateHandler(self, basket_index):
+        def basket_state_changed(value):
+            self._updateInfoWith(self._updateBasketPresence, basket_index, value)
+        return basket_state_changed
+
+    def _onStateChanged(self, value):
+        self._updateState()
+
+    def _onLoadedSampleChanged(self, value):
+        self._updateInfoWith(self._updateLoadedSample)
+        self._updateState()
+
+    def _onPathRunningChanged(self, value):
+        running = str(value).lower() == 'true'
+        if running and not self._pathRunning:
+            self._pathFinished.clear()
+            self._pathStarted.set()
+        elif not running:
+            self._pathFinished.set()
+        self._pathRunning = running
+        self._updateState()
+
+    def _onTimerUpdate(self):
+        # with events the full update is only a backstop, done every
+        # EVENTS_UPDATE_INTERVAL timer periods
+        if self._useEvents:
+            self._eventsUpdateCounter += 1
+            if self._eventsUpdateCounter < Cats90.EVENTS_UPDATE_INTERVAL:
+                return
+            self._eventsUpdateCounter = 0
+        SampleChanger._onTimerUpdate(self)
+
+    def _isPathRunning(self):
+        return str(self._chnPathRunning.getValue()).lower() == 'true'
+
+    def _waitPathFinished(self):
+        """
+        Waits for the rise and the fall of PathRunning after a transfer command
+
+        :returns: None
+        :rtype: None
+        """
+        # events set _pathStarted and _pathFinished, the channel is only read
+        # every PATH_BACKSTOP_PERIOD s in case an event is missed
+        start_time = time.time()
+        while not self._pathStarted.wait(Cats90.PATH_BACKSTOP_PERIOD):
+            if self._isPathRunning():
+                break
+            if time.time() - start_time > Cats90.PATH_START_TIMEOUT:
+                logging.getLogger("HWR").warning("Cats90: PathRunning did not rise %s s after the command" % Cats90.PATH_START_TIMEOUT)
+                break
+        while not self._pathFinished.wait(Cats90.PATH_BACKSTOP_PERIOD):
+            if not self._isPathRunning():
+                break
+
     def _executeServerTask(self, method, *args):
         """
         Executes a task on the CATS Tango device server
@@ -384,6 +476,8 @@ class Cats90(SampleChanger):
         :rtype: None
         """
         self._waitDeviceReady(3.0)
+        self._pathStarted.clear()
+        self._pathFinished.clear()
         task_id = method(*args)
         print("Cats90._executeServerTask", task_id)
         ret=None
@@ -391,11 +485,14 @@ class Cats90(SampleChanger):
             while self._isDeviceBusy():
                 gevent.sleep(0.1)
         else:
-            # introduced wait because it takes some time before the attribute PathRunning is set
-            # after launching a transfer
-            time.sleep(2.0)
-            while str(self._chnPathRunning.getValue()).lower() == 'true': 
-                gevent.sleep(0.1)            
+            if self._useEvents:
+                self._waitPathFinished()
+            else:
+                # introduced wait because it takes some time before the attribute PathRunning is set
+                # after launching a transfer
+                time.sleep(2.0)
+                while self._isPathRunning():
+                    gevent.sleep(0.1)            
             ret = True
         return ret
 
@@ -604,36 +701,42 @@ class Cats90(SampleChanger):
         for basket_index in range(Cats90.NO_OF_BASKETS):            
             # get presence information from the device server
             newBasketPresence = getattr(self, "_chnBasket%dState" % (basket_index + 1)).getValue()
-            # get saved presence information from object's internal bookkeeping
-            basket=self.getComponents()[basket_index]
-           
-            # check if the basket was newly mounted or removed from the dewar
-            if newBasketPresence ^ basket.isPresent():
-                # import pdb; pdb.set_trace()
-                # a mounting action was detected ...
-                if newBasketPresence:
-                    # basket was mounted
-                    present = True
-                    scanned = False
-                    datamatrix = None
-                    basket._setInfo(present, datamatrix, scanned)
+            self._updateBasketPresence(basket_index, newBasketPresence)
+
+    def _updateBasketPresence(self, basket_index, newBasketPresence):
+        """
+        Updates the presence of one basket and of its samples.
+
+        :returns: None
+        :rtype: None
+        """
+        # get saved presence information from object's internal bookkeeping
+        basket=self.getComponents()[basket_index]
+       
+        # check if the basket was newly mounted or removed from the dewar
+        if bool(newBasketPresence) ^ basket.isPresent():
+            # a mounting action was detected ...
+            if newBasketPresence:
+                # basket was mounted
+                present = True
+                scanned = False
+                datamatrix = None
+                basket._setInfo(present, datamatrix, scanned)
+            else:
+                # basket was removed
+                present = False
+                scanned = False
+                datamatrix = None
+                basket._setInfo(present, datamatrix, scanned)
+            # set the information for all dependent samples
+            present = basket.isPresent()
+            for sample in basket.getComponents():
+                if present:
+                    datamatrix = '          '   
                 else:
-                    # basket was removed
-                    present = False
-                    scanned = False
                     datamatrix = None
-                    basket._setInfo(present, datamatrix, scanned)
-                # set the information for all dependent samples
-                for sample_index in range(Basket.NO_OF_SAMPLES_PER_PUCK):
-                    sample = self.getComponentByAddress(Pin.getSampleAddress((basket_index + 1), (sample_index + 1)))
-                    present = sample.getContainer().isPresent()
-                    if present:
-                        datamatrix = '          '   
-                    else:
-                        datamatrix = None
-                    scanned = False
-                    sample._setInfo(present, datamatrix, scanned)
-                    # forget about any loaded state in newly mounted or removed basket)
-                    loaded = has_been_loaded = False
-                    sample._setLoaded(loaded, has_been_loaded)
-
+                scanned = False
+                sample._setInfo(present, datamatrix, scanned)
+                # forget about any loaded state in newly mounted or removed basket)
+                loaded = has_been_loaded = False
+                sample._setLoaded(loaded, has_been_loaded)
@@ -0,0 +1,141 @@
+"""
+Simulated CATS device server, emitting channel updates like Tango change
+events, to check the Cats90 hardware object without the robot.
+"""
+import logging
+import time
+import gevent
+
+from Cats90 import Cats90
+
+
+class SimulatedChannel(object):
+    """Channel counting its reads, update signal emitted on value change"""
+    def __init__(self, device, value):
+        self._device = device
+        self._value = value
+        self._callbacks = []
+
+    def getValue(self):
+        self._device.reads += 1
+        return self._value
+
+    def connectSignal(self, signal, callback):
+        self._callbacks.append(callback)
+        callback(self._value)
+
+    def setValue(self, value):
+        changed = value != self._value
+        self._value = value
+        if changed:
+            for callback in self._callbacks:
+                callback(value)
+
+
+class SimulatedCats(object):
+    """
+    Descript. : transfers raise PathRunning start_delay s after the command,
+                the sample is loaded transfer_time s later
+    """
+    def __init__(self, number_of_baskets=Cats90.NO_OF_BASKETS,
+                 start_delay=0.3, transfer_time=1.0):
+        self.start_delay = start_delay
+        self.transfer_time = transfer_time
+        self.reads = 0
+        self.channels = {}
+        for channel_name, value in (("_chnState", "ON"),
+                                    ("_chnPowered", True),
+                                    ("_chnNumLoadedSample", -1),
+                                    ("_chnLidLoadedSample", -1),
+                                    ("_chnSampleBarcode", ""),
+                                    ("_chnPathRunning", False),
+                                    ("_chnSampleIsDetected", False),
+                                    ("_chnCurrentPhase", "Centring"),
+                                    ("_chnTransferMode", "SAMPLE_CHANGER"),
+                                    ("_chnTotalLidState", True)):
+            self.channels[channel_name] = SimulatedChannel(self, value)
+        for basket_index in range(number_of_baskets):
+            self.channels["_chnBasket%dState" % (basket_index + 1)] = \
+                 SimulatedChannel(self, True)
+        self.commands = {"_cmdLoad": self.load,
+                         "_cmdUnload": self.unload,
+                         "_cmdChainedLoad": self.load,
+                         "_cmdAbort": self.abort,
+                         "_cmdRestartMD2": self.abort}
+
+    def _transfer(self, lid, sample):
+        gevent.sleep(self.start_delay)
+        self.channels["_chnState"].setValue("RUNNING")
+        self.channels["_chnPathRunning"].setValue(True)
+        gevent.sleep(self.transfer_time)
+        self.channels["_chnLidLoadedSample"].setValue(lid)
+        self.channels["_chnNumLoadedSample"].setValue(sample)
+        self.channels["_chnSampleIsDetected"].setValue(sample != -1)
+        self.channels["_chnPathRunning"].setValue(False)
+        self.channels["_chnState"].setValue("ON")
+
+    def load(self, argin):
+        gevent.spawn(self._transfer, int(argin[1]), int(argin[2]))
+        return 1
+
+    def unload(self, argin):
+        gevent.spawn(self._transfer, -1, -1)
+        return 1
+
+    def abort(self, *args):
+        return None
+
+
+class SimulatedCats90(Cats90):
+    """Cats90 reading its channels and commands from a SimulatedCats"""
+    def __init__(self, device, use_events, *args, **kwargs):
+        Cats90.__init__(self, "simulated_cats", *args, **kwargs)
+        self.device = device
+        self.tangoname = "simulated"
+        self._properties = {"use_events": use_events}
+
+    def getProperty(self, name, default_value=None):
+        return self._properties.get(name, default_value)
+
+    def getChannelObject(self, name):
+        return self.device.channels.get(name)
+
+    def getCommandObject(self, name):
+        return self.device.commands.get(name)
+
+    def addCommand(self, *args, **kwargs):
+        return None
+
+    def addChannel(self, *args, **kwargs):
+        return None
+
+
+def benchmark_cats_events(idle_time=5.0, start_delay=0.3, transfer_time=1.0):
+    """
+    Descript. : loads a sample on a simulated CATS with polling and with
+                use_events, then counts the channel reads while idle
+    Return.   : dict use_events: (load cycle time [s], loaded sample
+                address, channel reads in idle_time)
+    """
+    results = {}
+    for use_events in (False, True):
+        device = SimulatedCats(start_delay=start_delay,
+                               transfer_time=transfer_time)
+        sample_changer = SimulatedCats90(device, use_events)
+        sample_changer.init()
+        try:
+            start = time.time()
+            sample_changer._executeServerTask(device.load, ["2", "1", "14"])
+            cycle_time = time.time() - start
+            gevent.sleep(0.3)
+            loaded_sample = sample_changer.getLoadedSample()
+            device.reads = 0
+            gevent.sleep(idle_time)
+            results[use_events] = (cycle_time,
+                 loaded_sample and loaded_sample.getAddress(), device.reads)
+        finally:
+            sample_changer.isEnabled = lambda: False
+        logging.getLogger("HWR").info("Cats90 use_events=%s: load cycle " \
+             % use_events + "%.2f s, %d channel reads in %.1f s idle" \
+             % (cycle_time, results[use_events][2], idle_time))
+    return results
@@ -10,6 +10,13 @@ class Container(Component):
         super().__init__(container, address, scannable)
         self.type = type
         self.components = []     
+        # lookup caches over all components under this container: built on
+        # first use, reset by _addComponent/_removeComponent (structure)
+        # and _setDirty (ids and presence)
+        self._componentsByAddress = None
+        self._componentsById = None
+        self._sampleList = None
+        self._presentSamples = None
     
     
     #########################           PUBLIC           #########################
@@ -44,13 +51,18 @@ class Container(Component):
         Returns the list of all Sample objects under of this container (recursivelly)
         :rtype: list 
         """        
-        samples=[]
-        for c in self.getComponents():
-            if isinstance(c,Sample):
-                samples.append(c)
-            else:
-                samples.extend(c.getSampleList())
-        return samples
+        return list(self._getSampleList())
+
+    def _getSampleList(self):
+        if self._sampleList is None:
+            samples=[]
+            for c in self.getComponents():
+                if isinstance(c,Sample):
+                    samples.append(c)
+                else:
+                    samples.extend(c.getSampleList())
+            self._sampleList = samples
+        return self._sampleList
 
     def getBasketList(self):
         basket_list = []
@@ -64,34 +76,26 @@ class Container(Component):
         Returns the list of all Sample objects under of this container (recursivelly) tagged as present
         :rtype: list 
         """        
-        ret = []
-        for sample in self.getSampleList():
-            if sample.isPresent():
-                ret.append(sample)
+        if self._presentSamples is None:
+            self._presentSamples = [sample for sample in self._getSampleList() \
+                                    if sample.isPresent()]
+        return list(self._presentSamples)
 
     def isEmpty(self):
         """
         Returns true if there is no sample present sample under this container
         :rtype: bool 
         """        
-        for s in self.getSampleList():
-            if s.isPresent():
-                return False
-        return True
+        return len(self.getPresentSamples()) == 0
 
     def getComponentByAddress(self, address):
         """
         Returns a component through its slot address or None if address is invalid
         :rtype: Component 
         """        
-        for c in self.getComponents():
-            if c.getAddress() == address:
-                return c            
-            if isinstance(c,Container):
-                aux=c.getComponentByAddress(address)
-                if aux is not None:
-                    return aux
-        return None
+        if self._componentsByAddress is None:
+            self._componentsByAddress = self._buildIndex(Component.getAddress)
+        return self._componentsByAddress.get(address)
 
     def hasComponentAddress(self, address):
         """
@@ -105,14 +109,9 @@ class Container(Component):
         Returns a component through its id or None if id is invalid
         :rtype: Component 
         """        
-        for c in self.getComponents():
-            if c.getID() == id:
-                return c            
-            if  isinstance(c,Container):
-                aux=c.getComponentById(id)
-                if aux is not None:
-                    return aux
-        return None
+        if self._componentsById is None:
+            self._componentsById = self._buildIndex(Component.getID)
+        return self._componentsById.get(id)
 
 
     def hasComponentId(self, id):
@@ -123,7 +122,7 @@ class Container(Component):
         return self.getComponentById(id) is not None
     
     def getSelectedSample(self):
-        for s in self.getSampleList():
+        for s in self._getSampleList():
             if s.isSelected():
                 return s
         return None
@@ -143,12 +142,46 @@ class Container(Component):
     
     def _addComponent(self, c):
         self.components.append(c)
+        self._resetStructureCache()
 
     def _removeComponent(self, c):
         self.components.remove(c)
+        self._resetStructureCache()
 
     def _clearComponents(self):
         self.components = []     
+        self._resetStructureCache()
+
+    def _buildIndex(self, key):
+        """
+        Returns key(component) -> component for all components under this
+        container, first one in depth first order if keys are not unique
+        """
+        index = {}
+        for c in self.getComponents():
+            index.setdefault(key(c), c)
+            if isinstance(c,Container):
+                for k, component in c._buildIndex(key).items():
+                    index.setdefault(k, component)
+        return index
+
+    def _resetStructureCache(self):
+        container = self
+        while isinstance(container, Container):
+            container._resetCaches()
+            container = container.getContainer()
+
+    def _resetCaches(self):
+        self._componentsByAddress = None
+        self._componentsById = None
+        self._sampleList = None
+        self._presentSamples = None
+
+    def _setDirty(self):
+        # ids or presence of a component under this container changed
+        self._componentsById = None
+        self._presentSamples = None
+        Component._setDirty(self)
 
     def _resetDirty(self):
         Component._resetDirty(self)
@@ -8,6 +8,7 @@ import logging
 import time
 import gevent
 import types
+import collections
 
 class SampleChangerState:
     """
@@ -63,6 +64,16 @@ class SampleChangerMode:
     Disabled    = 11
 
 
+# Inventory snapshot (see SampleChanger.getInventory)
+InventorySample = collections.namedtuple("InventorySample",
+     ("basket", "vial", "code", "present", "loaded", "scanned",
+      "has_been_loaded", "address", "coords"))
+InventoryBasket = collections.namedtuple("InventoryBasket",
+     ("basket", "code", "present", "scanned", "address"))
+Inventory = collections.namedtuple("Inventory",
+     ("generation", "baskets", "samples"))
+
+
 class SampleChanger(Container, Equipment, metaclass=abc.ABCMeta):
     """
     Abstract base class for sample changers
@@ -94,6 +105,8 @@ class SampleChanger(Container, Equipment, metaclass=abc.ABCMeta):
         self._token=None
         self._timer_update_inverval = 5 # defines the interval in periods of 100 ms
         self._timer_update_counter = 0            
+        self._inventoryGeneration = 0
+        self._inventory = None
 
     def init(self):
         use_update_timer = self.getProperty("useUpdateTimer")
@@ -258,6 +271,50 @@ class SampleChanger(Container, Equipment, metaclass=abc.ABCMeta):
         """           
         return self.getLoadedSample() is not None
 
+    def getInventoryGeneration(self):
+        """
+        Returns a counter incremented at every change of the contents
+        (structure, ids, presence, loaded state). Clients can compare it
+        with the generation of their last Inventory to skip unchanged contents.
+        :rtype: int
+        """
+        return self._inventoryGeneration
+
+    def getInventory(self):
+        """
+        Returns an immutable snapshot of the contents, built from the internal
+        bookkeeping (no hardware access) and only rebuilt after a change:
+        Inventory(generation, baskets, samples), baskets is a tuple of
+        InventoryBasket and samples a tuple of InventorySample (basket and vial
+        are the first and last coordinates).
+        :rtype: Inventory
+        """
+        if self._inventory is None or \
+           self._inventory.generation != self._inventoryGeneration:
+            baskets = []
+            samples = []
+            for index, component in enumerate(self.getComponents()):
+                if isinstance(component, Container):
+                    baskets.append(InventoryBasket(index + 1, component.getID(),
+                         component.isPresent(), component.isScanned(),
+                         component.getAddress()))
+            self._addInventorySamples(self, (), samples)
+            self._inventory = Inventory(self._inventoryGeneration,
+                                        tuple(baskets), tuple(samples))
+        return self._inventory
+
+    def _addInventorySamples(self, container, coords, samples):
+        for index, component in enumerate(container.getComponents()):
+            component_coords = coords + (index + 1,)
+            if isinstance(component, Sample):
+                samples.append(InventorySample(component_coords[0],
+                     component_coords[-1], component.getID(),
+                     component.isPresent(), component.isLoaded(),
+                     component.isScanned(), component.hasBeenLoaded(),
+                     component.getAddress(), component_coords))
+            elif isinstance(component, Container):
+                self._addInventorySamples(component, component_coords, samples)
+
     
     def is_mounted_sample(self, sample_location):
         try:
@@ -283,8 +340,15 @@ class SampleChanger(Container, Equipment, metaclass=abc.ABCMeta):
     def updateInfo(self):
         """
         """
+        self._updateInfoWith(self._doUpdateInfo)
+
+    def _updateInfoWith(self, update_method, *args):
+        """
+        Runs update_method (full or partial update of the contents) and
+        emits the events of what it changed
+        """
         former_loaded = self.getLoadedSample()
-        self._doUpdateInfo()        
+        update_method(*args)
         if self._isDirty():
             self._triggerInfoChangedEvent()
         
@@ -357,6 +421,26 @@ class SampleChanger(Container, Equipment, metaclass=abc.ABCMeta):
         self.waitReady(timeout=3)
         return self.load(sample_to_load)
 
+    def can_prepare_load(self):
+        """
+        True if the sample changer implements _doPrepareLoad
+        """
+        return self._doPrepareLoad is not None
+
+    def prepare_load(self, sample, wait=True):
+        """
+        Prepares the load of sample (dewar side motions, pin pick...) while
+        the loaded sample is still in use. The sample is then mounted by
+        load, with a chained load if a sample is loaded.
+        Does nothing (returns None) if the sample changer cannot prepare
+        loads.
+        """
+        if not self.can_prepare_load():
+            return None
+        sample = self._resolveComponent(sample)
+        self.assertNotCharging()
+        return self._executeTask(SampleChangerState.Selecting,wait,self._doPrepareLoad,sample)
+
     def load(self, sample=None, wait=True):    
         """
         Load a sample. 
@@ -396,6 +480,10 @@ class SampleChanger(Container, Equipment, metaclass=abc.ABCMeta):
 
     def _unload(self,sample_slot=None):
         self._doUnload(sample_slot)
+
+    # Preparation of a load, _doPrepareLoad(self, sample), implemented by
+    # the sample changers able to stage the next sample (pin pick...)
+    _doPrepareLoad = None
     
     def _resolveComponent(self, component):
         if component is not None and isinstance(component, str):
@@ -535,6 +623,14 @@ class SampleChanger(Container, Equipment, metaclass=abc.ABCMeta):
         if cur != component:
             Container._setSelectedComponent(self,component)  
             self._triggerSelectionChangedEvent()      
+    def _setDirty(self):
+        self._inventoryGeneration += 1
+        Container._setDirty(self)
+
+    def _resetCaches(self):
+        self._inventoryGeneration += 1
+        Container._resetCaches(self)
+
 #########################           PRIVATE           #########################
 
     def _triggerStateChangedEvent(self,former):
@@ -0,0 +1,78 @@
+"""
+Output stage shared by energy scans and XRF spectra.
+
+Raw data are loaded and calibrated with numpy, the "x,y" text of the
+points is formatted once and written to the local and archive files in a
+single write each, and figures are rendered once to png bytes in the
+gevent thread pool, then written to all destinations. The caller can emit
+its result signals while the png is being rendered.
+"""
+
+import io
+import os
+import logging
+
+import numpy
+import gevent
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+def load_raw_scan(filename, skip_lines=2):
+    """Returns (x, y) arrays from a two columns (tab or space separated)
+       text file, the first skip_lines lines are headers"""
+    data = numpy.loadtxt(filename, skiprows=skip_lines, usecols=(0, 1),
+                         ndmin=2)
+    return data[:, 0], data[:, 1]
+
+
+def calibrate_channels(number_of_channels, calib):
+    """Energies (keV) of mca channels, calib is (a, b, c) of
+       energy (eV) = a * n * n + b * n + c"""
+    channels = numpy.arange(number_of_channels, dtype=numpy.float64)
+    return (calib[2] + calib[1] * channels + calib[0] * channels * channels) / 1000
+
+
+def format_points(x, y):
+    """Text of the points, one "x,y" line (\\r\\n) per point"""
+    points = numpy.empty(2 * len(x), numpy.float64)
+    points[0::2] = x
+    points[1::2] = y
+    return ("%f,%f\r\n" * len(x)) % tuple(points.tolist())
+
+
+def write_copies(content, filenames, mode="w"):
+    """Writes content to every file of filenames in a single write"""
+    for filename in filenames:
+        with open(filename, mode) as output_file:
+            output_file.write(content)
+
+
+def render_png(fig, dpi=80):
+    """Returns the png bytes of a matplotlib figure"""
+    png_buffer = io.BytesIO()
+    FigureCanvasAgg(fig).print_figure(png_buffer, dpi=dpi, format="png")
+    return png_buffer.getvalue()
+
+
+def write_png(fig, filenames, dpi=80):
+    """Renders fig once in the gevent thread pool and writes the png
+       to all filenames"""
+    try:
+        png_data = gevent.get_hub().threadpool.apply(render_png, (fig, dpi))
+    except:
+        logging.getLogger("HWR").exception("could not render figure")
+        return
+    for filename in filenames:
+        try:
+            logging.getLogger("HWR").info("Saving png file : %s" % filename)
+            directory = os.path.dirname(filename)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            write_copies(png_data, [filename], "wb")
+        except:
+            logging.getLogger("HWR").exception("could not save figure %s" % filename)
+
+
+def write_png_in_background(fig, filenames, dpi=80):
+    """Same as write_png, returns the greenlet doing it"""
+    return gevent.spawn(write_png, fig, filenames, dpi)
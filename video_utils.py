@@ -0,0 +1,134 @@
+"""
+Helpers to convert raw video buffers to greyscale numpy arrays.
+Used by the camera hardware objects (get_frame_array) to hand frames
+to image analysis (lucid loop finding, sample_centring) without going
+through QImage or an image file, and frame book-keeping shared by the
+video polling loops (FramePoller).
+"""
+
+import time
+import numpy
+
+
+def bayer_to_grey(raw_buffer, width, height, dtype=numpy.uint16):
+    """Returns a (height, width) greyscale array from a bayer buffer.
+       Each pixel is the mean of the 2x2 bayer cell starting at it, which
+       averages out the colour filter pattern without changing the image
+       geometry (coordinates stay valid for the full size image)
+    """
+    if isinstance(raw_buffer, numpy.ndarray):
+        raw = raw_buffer.astype(numpy.float32).reshape(height, width)
+    else:
+        raw = numpy.frombuffer(raw_buffer, dtype, width * height).\
+              astype(numpy.float32).reshape(height, width)
+    grey = numpy.empty_like(raw)
+    grey[:-1, :-1] = (raw[:-1, :-1] + raw[1:, :-1] + \
+                      raw[:-1, 1:] + raw[1:, 1:]) / 4.0
+    grey[-1, :] = grey[-2, :]
+    grey[:, -1] = grey[:, -2]
+    return to_uint8(grey)
+
+
+def rgb_to_grey(raw_buffer, width, height, channels=3):
+    """Returns a (height, width) greyscale array from a packed RGB buffer
+       (channels=4 for 32 bits RGB buffers, last channel is ignored)
+    """
+    if isinstance(raw_buffer, numpy.ndarray):
+        rgb = raw_buffer.reshape(height, width, channels)
+    else:
+        rgb = numpy.frombuffer(raw_buffer, numpy.uint8, \
+              width * height * channels).reshape(height, width, channels)
+    grey = numpy.dot(rgb[:, :, :3].astype(numpy.float32),
+                     numpy.array([0.299, 0.587, 0.114], numpy.float32))
+    return grey.astype(numpy.uint8)
+
+
+def grey_buffer_to_array(raw_buffer, width, height, dtype=numpy.uint8):
+    """Returns a (height, width) array from a monochrome buffer"""
+    grey = numpy.frombuffer(raw_buffer, dtype, width * height).\
+           reshape(height, width)
+    if dtype != numpy.uint8:
+        return to_uint8(grey)
+    return grey
+
+
+def to_uint8(image_array):
+    """Stretches the array min-max to the 0..255 range"""
+    image_array = numpy.asarray(image_array, numpy.float32)
+    min_value = image_array.min()
+    max_value = image_array.max()
+    if max_value <= min_value:
+        return numpy.zeros(image_array.shape, numpy.uint8)
+    return ((image_array - min_value) * (255.0 / (max_value - min_value))).\
+           astype(numpy.uint8)
+
+
+def mirror(image_array, mirror_hor, mirror_ver):
+    """Same convention as QImage.mirrored(horizontal, vertical)"""
+    if mirror_hor:
+        image_array = image_array[:, ::-1]
+    if mirror_ver:
+        image_array = image_array[::-1, :]
+    return image_array
+
+
+class FramePoller(object):
+    """
+    Book-keeping for video polling loops: tells if a polled frame is a new
+    one (by frame number), adapts the polling interval to the frame rate
+    of the camera and counts polled, converted and dropped (stale) frames.
+
+    The interval never goes below the configured one (that is the maximal
+    refresh rate wanted by the GUI). It follows the measured frame period
+    of the camera and backs off up to max_interval while no new frame
+    arrives.
+    """
+
+    def __init__(self, interval, max_interval=1.0):
+        self.min_interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.interval = interval
+        self.frame_period = None
+        self.last_frame_number = None
+        self.last_frame_time = None
+        self.polled = 0
+        self.converted = 0
+        self.dropped = 0
+
+    def is_new_frame(self, frame_number):
+        """Returns True if frame_number has not been seen yet"""
+        self.polled += 1
+        if frame_number is None or frame_number < 0 or \
+           frame_number == self.last_frame_number:
+            self.dropped += 1
+            self.interval = min(self.interval * 1.5, self.max_interval)
+            return False
+
+        now = time.time()
+        if self.last_frame_number is not None and \
+           frame_number > self.last_frame_number:
+            period = (now - self.last_frame_time) / \
+                     (frame_number - self.last_frame_number)
+            if self.frame_period is None:
+                self.frame_period = period
+            else:
+                self.frame_period = 0.8 * self.frame_period + 0.2 * period
+            self.interval = min(max(self.frame_period, self.min_interval),
+                                self.max_interval)
+        else:
+            # first frame or acquisition restarted
+            self.frame_period = None
+            self.interval = self.min_interval
+        self.last_frame_number = frame_number
+        self.last_frame_time = now
+        return True
+
+    def frame_converted(self):
+        self.converted += 1
+
+    def get_statistics(self):
+        return {"polled": self.polled,
+                "converted": self.converted,
+                "dropped": self.dropped,
+                "interval": self.interval,
+                "frame_period": self.frame_period}